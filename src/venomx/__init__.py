@@ -1,17 +1,35 @@
 """venomx package."""
 
-import importlib_metadata
+from typing import TYPE_CHECKING
 
-from venomx.model.venomx import Embedding, Index, NamedObject
-
-try:
-    __version__ = importlib_metadata.version(__name__)
-except importlib_metadata.PackageNotFoundError:
-    # package is not installed
-    __version__ = "0.0.0"  # pragma: no cover
+if TYPE_CHECKING:
+    from venomx.model.index import Index
+    from venomx.model.venomx import Embedding, NamedObject
 
 __all__ = [
     "Index",
     "Embedding",
     "NamedObject",
 ]
+
+
+def __getattr__(name: str):
+    """Import the models, and look up the version, on first access; ``import venomx`` is then cheap."""
+    if name == "Index":
+        from venomx.model.index import Index as value
+    elif name in __all__:
+        from venomx.model import venomx as model
+
+        value = getattr(model, name)
+    elif name == "__version__":
+        import importlib_metadata
+
+        try:
+            value = importlib_metadata.version(__name__)
+        except importlib_metadata.PackageNotFoundError:
+            # package is not installed
+            value = "0.0.0"  # pragma: no cover
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
@@ -1,4 +1,5 @@
 from functools import lru_cache
+from typing import Optional
 
 import pyarrow as pa
 
@@ -7,17 +8,34 @@ NAME = "name"
 VALUES = "values"
 METADATA = "metadata"
 
+VALUE_TYPES = {
+    "float32": pa.float32(),
+    "float16": pa.float16(),
+    "int8": pa.int8(),
+}
+
 
 @lru_cache
-def pyarrow_schema() -> pa.Schema:
+def pyarrow_schema(dimensions: Optional[int] = None, dtype: str = "float32") -> pa.Schema:
     """
     Schema for the embeddings table.
 
+    If dimensions is specified, values are stored as a ``fixed_size_list``, which
+    has no offsets buffer, and whose flat values can be memory mapped as a matrix.
+
+    :param dimensions: number of dimensions of a fixed size layout
+    :param dtype: storage dtype of the values, one of VALUE_TYPES
     :return:
     """
+    if dtype not in VALUE_TYPES:
+        raise ValueError(f"Unsupported values dtype: {dtype}")
+    if dimensions is None:
+        values_type = pa.list_(VALUE_TYPES[dtype])
+    else:
+        values_type = pa.list_(VALUE_TYPES[dtype], dimensions)
     return pa.schema(
         [
             (ID, pa.string()),
-            (VALUES, pa.list_(pa.float32())),
+            (VALUES, values_type),
         ]
     )
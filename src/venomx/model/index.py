@@ -0,0 +1,39 @@
+"""
+Hand-written extensions of the generated models.
+
+``venomx.py`` is generated from ``venomx.yaml`` (``make models``), so python-only
+types are added here rather than in the generated module.
+"""
+
+from typing import List, Optional, Union
+
+from pydantic import Field
+
+from venomx.model import venomx as generated
+from venomx.model.objects_pa import ObjectTable
+from venomx.model.venomx import NamedObject
+
+
+class Index(generated.Index):
+    """
+    A collection of named objects, whose objects can also be an :class:`ObjectTable`.
+
+    An object table is accepted as is: it is never iterated, so no ``NamedObject`` is
+    created for its rows.
+
+    >>> objects = ObjectTable.from_records([{"id": "HP:1"}, {"id": "HP:2"}])
+    >>> Index(objects=objects).objects is objects
+    True
+    >>> Index(objects=[{"id": "HP:1"}]).objects
+    [NamedObject(id='HP:1', label=None, metadata=[])]
+    """
+
+    # the table is checked first, and only by type; a list is validated as the generated model does
+    objects: Optional[Union[ObjectTable, List[NamedObject]]] = Field(
+        default_factory=list,
+        union_mode="left_to_right",
+        description="""The named objects. Can be an ObjectTable, whose objects are stored as columns.""",
+    )
+
+
+Index.model_rebuild()
@@ -0,0 +1,210 @@
+"""Columnar storage of the named objects of an index, as an arrow table."""
+
+import operator
+from collections.abc import Sequence
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
+from typing import Iterable, Iterator, List, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ID = "id"
+LABEL = "label"
+METADATA = "metadata"
+FIELDS = (ID, LABEL, METADATA)
+
+ITER_BATCH_SIZE = 65536
+
+
+@lru_cache
+def pyarrow_schema() -> pa.Schema:
+    """
+    Schema for the objects table.
+
+    :return:
+    """
+    return pa.schema(
+        [
+            (ID, pa.string()),
+            (LABEL, pa.string()),
+            (METADATA, pa.list_(pa.string())),
+        ]
+    )
+
+
+def _named_object(row: dict):
+    from venomx.model.venomx import NamedObject
+
+    # the table schema guarantees the field types, so the pydantic validation is skipped
+    return NamedObject.model_construct(**{k: v for k, v in row.items() if v is not None})
+
+
+class ObjectTable(Sequence):
+    """
+    The named objects of an index, stored as columns of ids, labels and metadata.
+
+    An object table behaves as a read-only sequence of ``NamedObject``, and can be
+    assigned to ``Index.objects``; pydantic objects are only created for the items
+    that are accessed. Millions of objects take a few bytes per id and label, rather
+    than a pydantic object each.
+
+    >>> objects = ObjectTable.from_records([{"id": "HP:1", "label": "heart"}, {"id": "HP:2"}])
+    >>> len(objects), objects.ids.to_pylist()
+    (2, ['HP:1', 'HP:2'])
+    >>> objects[0]
+    NamedObject(id='HP:1', label='heart', metadata=[])
+    >>> [obj.id for obj in objects[1:]]
+    ['HP:2']
+    >>> objects.to_records()
+    [{'id': 'HP:1', 'label': 'heart'}, {'id': 'HP:2'}]
+    """
+
+    def __init__(self, table: pa.Table):
+        """
+        Create an object table.
+
+        :param table: table with an id column, and optionally label and metadata columns
+        """
+        unknown = set(table.column_names) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown object fields: {sorted(unknown)}")
+        if ID not in table.column_names:
+            raise ValueError("Objects have no ids")
+        schema = pyarrow_schema()
+        columns = [
+            table.column(name) if name in table.column_names else pa.nulls(len(table), schema.field(name).type)
+            for name in FIELDS
+        ]
+        table = pa.Table.from_arrays(columns, names=list(FIELDS))
+        try:
+            self.table = table.cast(schema)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError) as e:
+            raise ValueError(f"Invalid objects: {e}") from e
+        if self.table.column(ID).null_count:
+            raise ValueError("Objects have null ids")
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source, handler):
+        """Validate object tables by type only, so that pydantic never iterates over the objects."""
+        from pydantic_core import core_schema
+
+        return core_schema.is_instance_schema(cls)
+
+    @classmethod
+    def from_records(cls, records: List[dict]) -> "ObjectTable":
+        """
+        Create an object table from dicts, e.g. the objects of a metadata yaml.
+
+        :param records: dicts with id, label and metadata keys
+        :return:
+        """
+        unknown = set(chain.from_iterable(records)) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown object fields: {sorted(unknown)}")
+        # arrow would convert a string to a list of characters
+        if any(isinstance(record.get(METADATA), str) for record in records):
+            raise ValueError("Object metadata must be a list of strings")
+        try:
+            table = pa.Table.from_pylist(records, schema=pyarrow_schema())
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f"Invalid objects: {e}") from e
+        return cls(table)
+
+    @classmethod
+    def from_objects(cls, objects: Iterable) -> "ObjectTable":
+        """
+        Create an object table from named objects.
+
+        :param objects: NamedObject instances
+        :return:
+        """
+        if isinstance(objects, ObjectTable):
+            return objects
+        return cls.from_records([obj.model_dump(exclude_unset=True) for obj in objects])
+
+    @classmethod
+    def read(cls, path: Union[str, Path]) -> "ObjectTable":
+        """
+        Read an object table from a parquet file.
+
+        :param path:
+        :return:
+        """
+        return cls(pq.read_table(str(path)))
+
+    def write(self, path: Union[str, Path]):
+        """
+        Write the object table as a parquet file.
+
+        :param path:
+        :return:
+        """
+        pq.write_table(self.table, str(path))
+
+    @property
+    def ids(self) -> pa.ChunkedArray:
+        """The ids of the objects."""
+        return self.table.column(ID)
+
+    @property
+    def labels(self) -> pa.ChunkedArray:
+        """The labels of the objects; null if not set."""
+        return self.table.column(LABEL)
+
+    def filter(self, mask: Union[np.ndarray, pa.Array]) -> "ObjectTable":
+        """
+        Select objects.
+
+        :param mask: (N,) booleans
+        :return:
+        """
+        return ObjectTable(self.table.filter(mask))
+
+    def to_records(self) -> List[dict]:
+        """
+        Convert to dicts, without the unset fields.
+
+        :return:
+        """
+        return [{k: v for k, v in row.items() if v is not None} for row in self.table.to_pylist()]
+
+    def __len__(self) -> int:
+        """Number of objects."""
+        return self.table.num_rows
+
+    def __getitem__(self, key):
+        """Get an object by position, or an object table by slice."""
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return ObjectTable(self.table.slice(start, max(0, stop - start)))
+            return ObjectTable(self.table.take(np.arange(start, stop, step)))
+        i = operator.index(key)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("object index out of range")
+        return _named_object({name: self.table.column(name)[i].as_py() for name in FIELDS})
+
+    def __iter__(self) -> Iterator:
+        """Iterate over the objects, converting them a batch at a time."""
+        for batch in self.table.to_batches(max_chunksize=ITER_BATCH_SIZE):
+            for row in batch.to_pylist():
+                yield _named_object(row)
+
+    def __eq__(self, other) -> bool:
+        """Compare with another object table, or a sequence of objects."""
+        if isinstance(other, ObjectTable):
+            return self.table.equals(other.table)
+        if isinstance(other, Sequence):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        """Show the number of objects, not the objects."""
+        return f"ObjectTable({len(self)} objects)"
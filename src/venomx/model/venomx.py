@@ -40,6 +40,7 @@ class Index(ConfiguredBaseModel):
     )
     embeddings_frame: Optional[Any] = Field(None, description="""Can be a dataframe, pyarrow object...""")
     embeddings_dimensions: Optional[int] = Field(None, description="""The number of dimensions for the embeddings""")
+    embeddings_count: Optional[int] = Field(None, description="""The number of embeddings (rows) in the index""")
     embedding_model: Optional[Model] = Field(None, description="""The embedding model for dataset""")
     embedding_input_method: Optional[ModelInputMethod] = Field(
         None, description="""The method used to generate the input for the embedding model"""
@@ -47,6 +48,33 @@ class Index(ConfiguredBaseModel):
     objects: Optional[List[NamedObject]] = Field(default_factory=list, description="""The named objects""")
     is_external: Optional[bool] = Field(None, description="""Whether the objects are external""")
     md5: Optional[str] = Field(None, description="""The md5 for the index""")
+    chunk_md5s: Optional[List[str]] = Field(
+        default_factory=list,
+        description="""The md5 of each chunk (parquet row group or arrow record batch) of the embeddings file, in order. Allows chunks to be verified independently.""",
+    )
+    embeddings_dtype: Optional[str] = Field(
+        None,
+        description="""The storage dtype of the embeddings values (float32, float16 or int8). int8 values are scalar quantized per dimension, see quantization_scale and quantization_offset.""",
+    )
+    quantization_scale: Optional[List[float]] = Field(
+        default_factory=list,
+        description="""The scale of each dimension of int8 quantized embeddings; a value is code * scale + offset""",
+    )
+    quantization_offset: Optional[List[float]] = Field(
+        default_factory=list, description="""The offset of each dimension of int8 quantized embeddings"""
+    )
+    shards: Optional[List[Shard]] = Field(
+        default_factory=list,
+        description="""The embeddings files of a sharded index, in row order. If present, the embeddings are not stored in a single file next to the metadata.""",
+    )
+    segments: Optional[List[Segment]] = Field(
+        default_factory=list,
+        description="""Delta segments applied on top of the embeddings, in order. Each segment deletes the ids in its tombstones, then adds its rows, replacing any earlier rows with the same ids. The md5 of the index chains the md5 and tombstones of each segment onto that of the embeddings files (see venomx.tools.delta.segments_md5); the chunk_md5s only describe the embeddings files, without the segments.""",
+    )
+    objects_path: Optional[str] = Field(
+        None,
+        description="""The path of a parquet file with the named objects, relative to the metadata file. If present, the objects are not listed in the metadata.""",
+    )
 
 
 class Prefix(ConfiguredBaseModel):
@@ -58,6 +86,31 @@ class Prefix(ConfiguredBaseModel):
     namespace: Optional[str] = Field(None, description="""The expansion for prefix""")
 
 
+class Shard(ConfiguredBaseModel):
+    """
+    One embeddings file of a sharded index
+    """
+
+    path: str = Field(..., description="""The path of the shard, relative to the metadata file""")
+    count: Optional[int] = Field(None, description="""The number of embeddings (rows) in the shard""")
+    min_id: Optional[str] = Field(None, description="""The smallest id in the shard""")
+    max_id: Optional[str] = Field(None, description="""The largest id in the shard""")
+    md5: Optional[str] = Field(None, description="""The md5 of the shard""")
+
+
+class Segment(ConfiguredBaseModel):
+    """
+    A delta segment of an index: an embeddings file of added or replaced rows, and tombstones for deleted ids
+    """
+
+    path: Optional[str] = Field(
+        None, description="""The path of the segment embeddings file, relative to the metadata file, if it adds rows"""
+    )
+    count: Optional[int] = Field(None, description="""The number of embeddings (rows) in the segment""")
+    md5: Optional[str] = Field(None, description="""The md5 of the segment""")
+    tombstones: Optional[List[str]] = Field(default_factory=list, description="""The ids deleted by the segment""")
+
+
 class Dataset(ConfiguredBaseModel):
     """
     A description of the dataset that the index is over. Note that this is not intended to be a comprehensive description of the dataset (use other standards for this), but enough to give context to the index.
@@ -125,6 +178,8 @@ class MetadataObject(ConfiguredBaseModel):
 # see https://pydantic-docs.helpmanual.io/usage/models/#rebuilding-a-model
 Index.model_rebuild()
 Prefix.model_rebuild()
+Shard.model_rebuild()
+Segment.model_rebuild()
 Dataset.model_rebuild()
 Model.model_rebuild()
 ModelInputMethod.model_rebuild()
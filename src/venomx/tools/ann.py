@@ -0,0 +1,381 @@
+"""Approximate nearest neighbour search using an inverted file (IVF) with optional product quantization."""
+
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+import venomx as vx
+from venomx.tools.file_io import embeddings_matrix
+from venomx.tools.search import DEFAULT_QUERY_BATCH_SIZE, ExactSearcher, SearchMetric, top_k
+
+logger = logging.getLogger(__name__)
+
+ANN_SUFFIX = ".ann.npz"
+PQ_CENTROIDS = 256
+DEFAULT_NPROBE = 8
+DEFAULT_RERANK_FACTOR = 4
+
+
+def ann_sidecar_path(metadata_path: Union[str, Path]) -> Path:
+    """
+    Get the path of the ANN sidecar for an index metadata file.
+
+    >>> str(ann_sidecar_path("tests/output/test.vx.yaml"))
+    'tests/output/test.vx.ann.npz'
+    >>> str(ann_sidecar_path("tests/output/test.json"))
+    'tests/output/test.ann.npz'
+
+    :param metadata_path: path to the metadata yaml (or all-in-one file)
+    :return:
+    """
+    path = Path(metadata_path)
+    return path.with_name(path.stem + ANN_SUFFIX)
+
+
+def _assign(x: np.ndarray, centroids: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+    """
+    Assign each row of x to its nearest centroid (L2).
+
+    :param x: (N, D) matrix
+    :param centroids: (K, D) matrix
+    :param batch_size: rows per matrix product
+    :return: (N,) centroid indexes
+    """
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), batch_size):
+        batch = x[start : start + batch_size]
+        labels[start : start + len(batch)] = np.argmin(centroid_norms[None, :] - 2 * batch @ centroids.T, axis=1)
+    return labels
+
+
+def kmeans(x: np.ndarray, k: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd's k-means, with empty clusters re-seeded from random points.
+
+    >>> x = np.array([[0.0, 0.0], [0.1, 0.0], [10.0, 10.0], [10.1, 10.0]], dtype=np.float32)
+    >>> sorted(kmeans(x, 2).round().tolist())
+    [[0.0, 0.0], [10.0, 10.0]]
+
+    :param x: (N, D) float32 matrix
+    :param k: number of centroids
+    :param n_iter: number of iterations
+    :param seed: random seed
+    :return: (k, D) centroids
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].astype(np.float32, copy=True)
+    for _ in range(n_iter):
+        labels = _assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    An inverted file over an embeddings matrix.
+
+    Rows are partitioned by their nearest coarse centroid; a query only scores the rows
+    in its ``nprobe`` closest lists. If product quantization is enabled, each row also has
+    a code of ``M`` bytes, and candidates are scored from the codes (asymmetric distance),
+    optionally re-ranked against the full vectors.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_rows: np.ndarray,
+        metric: SearchMetric = SearchMetric.COSINE,
+        codebooks: Optional[np.ndarray] = None,
+        codes: Optional[np.ndarray] = None,
+        source_md5: Optional[str] = None,
+    ):
+        """
+        Create an IVF index from its arrays.
+
+        :param centroids: (nlist, D) coarse centroids
+        :param list_offsets: (nlist + 1,) offsets of each list into list_rows
+        :param list_rows: (N,) row numbers, grouped by list
+        :param metric: metric the index was built for
+        :param codebooks: optional (M, 256, D / M) product quantization codebooks
+        :param codes: optional (N, M) uint8 codes, in row order
+        :param source_md5: md5 of the index content the ANN index was built from
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.metric = SearchMetric(metric)
+        self.codebooks = codebooks
+        self.codes = codes
+        self.source_md5 = source_md5
+
+    @property
+    def num_rows(self) -> int:
+        """Number of indexed rows."""
+        return len(self.list_rows)
+
+    @classmethod
+    def build(
+        cls,
+        matrix: np.ndarray,
+        metric: SearchMetric = SearchMetric.COSINE,
+        nlist: Optional[int] = None,
+        pq_subspaces: int = 0,
+        n_iter: int = 20,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """
+        Build an index over a matrix.
+
+        :param matrix: (N, D) embeddings
+        :param metric: metric used for searching
+        :param nlist: number of coarse lists (default ``4 * sqrt(N)``)
+        :param pq_subspaces: number of product quantization subspaces (0 for none); must divide D
+        :param n_iter: k-means iterations
+        :param seed: random seed
+        :return:
+        """
+        metric = SearchMetric(metric)
+        x = ExactSearcher(np.arange(len(matrix)), matrix, metric).matrix
+        n, d = x.shape
+        if nlist is None:
+            nlist = int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n))
+        rng = np.random.default_rng(seed)
+        sample = x[rng.choice(n, min(n, nlist * 256), replace=False)]
+        centroids = kmeans(sample, nlist, n_iter=n_iter, seed=seed)
+        labels = _assign(x, centroids)
+        list_rows = np.argsort(labels, kind="stable")
+        list_offsets = np.searchsorted(labels[list_rows], np.arange(len(centroids) + 1))
+        codebooks = None
+        codes = None
+        if pq_subspaces:
+            if d % pq_subspaces:
+                raise ValueError(f"PQ subspaces {pq_subspaces} must divide dimensions {d}")
+            sub = d // pq_subspaces
+            codebooks = np.stack(
+                [
+                    kmeans(sample[:, m * sub : (m + 1) * sub], PQ_CENTROIDS, n_iter=n_iter, seed=seed + m)
+                    for m in range(pq_subspaces)
+                ]
+            )
+            codes = np.stack(
+                [_assign(x[:, m * sub : (m + 1) * sub], codebooks[m]) for m in range(pq_subspaces)], axis=1
+            ).astype(np.uint8)
+        return cls(centroids, list_offsets, list_rows, metric, codebooks, codes)
+
+    def save(self, path: Union[str, Path]):
+        """
+        Save as an uncompressed npz sidecar.
+
+        :param path:
+        :return:
+        """
+        arrays = {
+            "centroids": self.centroids,
+            "list_offsets": self.list_offsets,
+            "list_rows": self.list_rows,
+            "metric": np.array(self.metric.value),
+        }
+        if self.source_md5:
+            arrays["source_md5"] = np.array(self.source_md5)
+        if self.codes is not None:
+            arrays["codebooks"] = self.codebooks
+            arrays["codes"] = self.codes
+        with open(path, "wb") as stream:
+            np.savez(stream, **arrays)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "IVFIndex":
+        """
+        Load from an npz sidecar.
+
+        :param path:
+        :return:
+        """
+        with np.load(str(path), allow_pickle=False) as data:
+            return cls(
+                data["centroids"],
+                data["list_offsets"],
+                data["list_rows"],
+                SearchMetric(str(data["metric"])),
+                data["codebooks"] if "codebooks" in data else None,
+                data["codes"] if "codes" in data else None,
+                str(data["source_md5"]) if "source_md5" in data else None,
+            )
+
+    def searcher(self, ids: np.ndarray, matrix: Optional[np.ndarray]) -> "IVFSearcher":
+        """
+        Create a searcher over the rows this index was built from.
+
+        :param ids:
+        :param matrix: embeddings, may be None if the index has PQ codes
+        :return:
+        """
+        return IVFSearcher(self, ids, matrix)
+
+
+class IVFSearcher:
+    """Searches an IVFIndex; has the same search interface as ExactSearcher."""
+
+    def __init__(self, ivf: IVFIndex, ids: np.ndarray, matrix: Optional[np.ndarray]):
+        """
+        Create a searcher.
+
+        :param ivf:
+        :param ids: (N,) ids
+        :param matrix: (N, D) embeddings; may be None if the index has PQ codes
+        """
+        if len(ids) != ivf.num_rows:
+            raise ValueError(f"ANN index has {ivf.num_rows} rows but there are {len(ids)} ids")
+        if matrix is None and ivf.codes is None:
+            raise ValueError("An embeddings matrix is required for an ANN index without PQ codes")
+        self.ivf = ivf
+        self.metric = ivf.metric
+        self.ids = np.asarray(ids)
+        self.exact = ExactSearcher(self.ids, matrix, self.metric) if matrix is not None else None
+        self.coarse = ExactSearcher(np.arange(len(ivf.centroids)), ivf.centroids, self.metric)
+
+    def _candidate_scores(self, query: np.ndarray, rows: np.ndarray, tables: Optional[np.ndarray]) -> np.ndarray:
+        if tables is not None:
+            m = np.arange(tables.shape[0])
+            return tables[m, self.ivf.codes[rows]].sum(axis=1)
+        return self.exact.scores(query[None, :], rows)[0]
+
+    def _pq_tables(self, query: np.ndarray) -> np.ndarray:
+        codebooks = self.ivf.codebooks
+        subs = query.reshape(codebooks.shape[0], 1, codebooks.shape[2])
+        if self.metric == SearchMetric.EUCLIDEAN:
+            return ((codebooks - subs) ** 2).sum(axis=2)
+        return np.einsum("mcd,mxd->mc", codebooks, subs)
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 10,
+        batch_size: int = DEFAULT_QUERY_BATCH_SIZE,
+        nprobe: int = DEFAULT_NPROBE,
+        rerank_factor: int = DEFAULT_RERANK_FACTOR,
+        **kwargs,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find approximately the k nearest stored vectors for each query.
+
+        :param queries: (Q, D) matrix, or a single (D,) vector
+        :param k: number of results per query
+        :param batch_size: number of queries probed per matrix product
+        :param nprobe: number of lists to scan per query
+        :param rerank_factor: with PQ codes and a matrix, re-rank ``k * rerank_factor`` candidates exactly
+        :return: tuple of (Q, k) ids and (Q, k) scores; rows with fewer than k candidates are padded
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        largest = self.metric != SearchMetric.EUCLIDEAN
+        k = min(k, len(self.ids))
+        pad = -np.inf if largest else np.inf
+        all_ids = np.full((len(queries), k), None, dtype=object)
+        all_scores = np.full((len(queries), k), pad, dtype=np.float32)
+        offsets = self.ivf.list_offsets
+        nprobe = min(nprobe, len(self.ivf.centroids))
+        prepared = ExactSearcher(np.arange(len(queries)), queries, self.metric).matrix
+        for start in range(0, len(queries), batch_size):
+            probes, _ = top_k(self.coarse.scores(queries[start : start + batch_size]), nprobe, largest=largest)
+            for q, lists in enumerate(probes, start=start):
+                rows = np.concatenate([self.ivf.list_rows[offsets[i] : offsets[i + 1]] for i in lists])
+                if not len(rows):
+                    continue
+                tables = self._pq_tables(prepared[q]) if self.ivf.codes is not None else None
+                scores = self._candidate_scores(queries[q], rows, tables)
+                if tables is not None and self.exact is not None and rerank_factor:
+                    keep, _ = top_k(scores[None, :], k * rerank_factor, largest=largest)
+                    rows = rows[keep[0]]
+                    scores = self.exact.scores(queries[q][None, :], rows)[0]
+                best, best_scores = top_k(scores[None, :], k, largest=largest)
+                all_ids[q, : best.shape[1]] = self.ids[rows[best[0]]]
+                all_scores[q, : best.shape[1]] = best_scores[0]
+        if self.metric == SearchMetric.EUCLIDEAN:
+            np.sqrt(all_scores, out=all_scores)
+        return all_ids, all_scores
+
+
+def recall_at_k(exact_ids: np.ndarray, approx_ids: np.ndarray) -> float:
+    """
+    Mean fraction of the exact top k results that are found by an approximate search.
+
+    >>> recall_at_k(np.array([["A", "B"]]), np.array([["B", "C"]]))
+    0.5
+
+    :param exact_ids: (Q, k) ids
+    :param approx_ids: (Q, k) ids
+    :return:
+    """
+    hits = [len(set(e.tolist()) & set(a.tolist())) for e, a in zip(exact_ids, approx_ids, strict=True)]
+    return float(np.sum(hits) / exact_ids.size)
+
+
+def evaluate_ann(
+    searcher: IVFSearcher,
+    matrix: np.ndarray,
+    k: int = 10,
+    nprobes: Tuple[int, ...] = (1, 4, 16),
+    sample_size: int = 200,
+    seed: int = 0,
+) -> List[Dict[str, float]]:
+    """
+    Measure recall@k against exact search, and query latency, over a sample of rows.
+
+    :param searcher: searcher to evaluate
+    :param matrix: (N, D) embeddings, used for the exact search and to sample queries
+    :param k: number of neighbours
+    :param nprobes: nprobe values to evaluate
+    :param sample_size: number of rows to use as queries
+    :param seed: random seed
+    :return: one dict per nprobe, with ``nprobe``, ``recall`` and ``ms_per_query``
+    """
+    rng = np.random.default_rng(seed)
+    queries = matrix[rng.choice(len(matrix), min(sample_size, len(matrix)), replace=False)]
+    exact_ids, _ = ExactSearcher(searcher.ids, matrix, searcher.metric).search(queries, k)
+    results = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        approx_ids, _ = searcher.search(queries, k, nprobe=nprobe)
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "nprobe": nprobe,
+                "recall": recall_at_k(exact_ids, approx_ids),
+                "ms_per_query": 1000 * elapsed / len(queries),
+            }
+        )
+    return results
+
+
+def build_ann(ix: vx.Index, metric: SearchMetric = SearchMetric.COSINE, **kwargs) -> IVFIndex:
+    """
+    Build an IVF index over the embeddings of an index.
+
+    >>> ix = vx.Index()
+    >>> ix.embeddings_frame = {"id": np.arange(100), "values": np.random.rand(100, 8)}
+    >>> ivf = build_ann(ix, nlist=4)
+    >>> ivf.num_rows
+    100
+
+    :param ix:
+    :param metric:
+    :param kwargs: passed to IVFIndex.build
+    :return:
+    """
+    _, matrix = embeddings_matrix(ix)
+    ivf = IVFIndex.build(matrix, metric, **kwargs)
+    ivf.source_md5 = ix.md5
+    return ivf
@@ -0,0 +1,411 @@
+"""Benchmarks of loading, saving, converting, validating and searching synthetic indexes."""
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import importlib_metadata
+import numpy as np
+import pyarrow as pa
+
+import venomx as vx
+from venomx.model.embeddings_pa import ID
+from venomx.model.objects_pa import ObjectTable
+from venomx.tools.ann import ann_sidecar_path, build_ann
+from venomx.tools.constants import (
+    DEFAULT_NUM_QUERIES,
+    DEFAULT_REGRESSION_THRESHOLD,
+    OPERATIONS,
+    SEARCH_PATHS,
+)
+from venomx.tools.file_io import (
+    SUFFIX_MAP,
+    EmbeddingFormat,
+    LoadMode,
+    load_index,
+    save_index,
+    validate_file,
+)
+from venomx.tools.quantization import StorageDtype
+from venomx.tools.search import search
+
+logger = logging.getLogger(__name__)
+
+_SCALE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)([kKmM]?)\s*x\s*(\d+)\s*$")
+_MULTIPLIERS = {"": 1, "k": 1_000, "m": 1_000_000}
+
+
+def parse_scale(scale: str) -> Tuple[int, int]:
+    """
+    Parse a scale of the form ROWSxDIMS, with an optional k or M suffix on the rows.
+
+    >>> parse_scale("10kx128"), parse_scale("1.5Mx768"), parse_scale("500x8")
+    ((10000, 128), (1500000, 768), (500, 8))
+
+    :param scale:
+    :return: tuple of number of rows, number of dimensions
+    """
+    match = _SCALE_PATTERN.match(scale)
+    if not match:
+        raise ValueError(f"Invalid scale: {scale}; expected e.g. 10kx128")
+    rows, multiplier, dims = match.groups()
+    return int(float(rows) * _MULTIPLIERS[multiplier.lower()]), int(dims)
+
+
+def synthetic_index(rows: int, dims: int, seed: int = 0, objects=False) -> vx.Index:
+    """
+    Generate an index of random float32 embeddings, deterministically from a seed.
+
+    >>> ix = synthetic_index(3, 2)
+    >>> ix.embeddings_frame["id"].tolist(), ix.embeddings_frame["values"].shape
+    (['X:000000000', 'X:000000001', 'X:000000002'], (3, 2))
+
+    :param rows: number of rows
+    :param dims: number of dimensions
+    :param seed: random seed
+    :param objects: also add a named object for each row
+    :return: index with a numpy embeddings frame
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.char.add("X:", np.char.zfill(np.arange(rows).astype(str), 9)).astype(object)
+    ix = vx.Index(embeddings_dimensions=dims)
+    if objects:
+        ix.objects = ObjectTable(pa.table({ID: ids}))
+    ix.embeddings_frame = {"id": ids, "values": rng.standard_normal((rows, dims), dtype=np.float32)}
+    return ix
+
+
+def index_path(directory: Union[str, Path], name: str, format: EmbeddingFormat) -> Path:
+    """
+    Get the path to save an index to, by format.
+
+    >>> str(index_path("out", "bench", EmbeddingFormat.JSON))
+    'out/bench.json'
+
+    :param directory:
+    :param name: stem of the file
+    :param format:
+    :return: the metadata yaml for dual-file formats, otherwise the all-in-one file
+    """
+    suffix = ".vx.yaml" if format in SUFFIX_MAP else f".{EmbeddingFormat(format).value}"
+    return Path(directory) / f"{name}{suffix}"
+
+
+def benchmark_cases(
+    formats: List[EmbeddingFormat], operations: List[str] = None, search_paths: List[str] = None
+) -> List[Dict]:
+    """
+    Get the cases to run for a set of formats and operations.
+
+    >>> [c["name"] for c in benchmark_cases([EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW], ["convert"])]
+    ['convert:parquet->arrow', 'convert:arrow->parquet']
+
+    :param formats: formats to benchmark; searches always read PARQUET indexes
+    :param operations: subset of OPERATIONS, default all
+    :param search_paths: subset of SEARCH_PATHS, default all
+    :return: list of cases, each a dict with the name, operation, and formats or search path
+    """
+    formats = [EmbeddingFormat(f) for f in formats]
+    operations = operations or OPERATIONS
+    cases = []
+    for operation in operations:
+        if operation == "convert":
+            cases.extend(
+                {"name": f"convert:{a.value}->{b.value}", "operation": operation, "format": a, "target_format": b}
+                for a in formats
+                for b in formats
+                if a != b
+            )
+        elif operation == "search":
+            cases.extend(
+                {"name": f"search:{path}", "operation": operation, "format": EmbeddingFormat.PARQUET, "search": path}
+                for path in search_paths or SEARCH_PATHS
+            )
+        elif operation in OPERATIONS:
+            cases.extend({"name": f"{operation}:{f.value}", "operation": operation, "format": f} for f in formats)
+        else:
+            raise ValueError(f"Unknown operation: {operation}")
+    return cases
+
+
+def prepare_inputs(directory: Union[str, Path], rows: int, dims: int, cases: List[Dict], seed: int = 0, objects=False):
+    """
+    Write the input files read by a set of cases.
+
+    :param directory: working directory
+    :param rows: number of rows
+    :param dims: number of dimensions
+    :param cases: see benchmark_cases
+    :param seed: random seed
+    :param objects: add a named object for each row
+    :return:
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    ix = synthetic_index(rows, dims, seed, objects)
+    needed = {c["format"] for c in cases if c["operation"] in ("load", "convert", "validate")}
+    for format in needed:
+        save_index(ix, index_path(directory, "input", format), format=format)
+    search_paths = {c["search"] for c in cases if c["operation"] == "search"}
+    if search_paths & {"exact", "ann"}:
+        save_index(ix, index_path(directory, "input", EmbeddingFormat.PARQUET))
+    if "int8" in search_paths:
+        save_index(ix, index_path(directory, "int8", EmbeddingFormat.PARQUET), dtype=StorageDtype.INT8)
+    if "ann" in search_paths:
+        path = index_path(directory, "ann", EmbeddingFormat.PARQUET)
+        save_index(ix, path)
+        build_ann(load_index(path, mode=LoadMode.NUMPY)).save(ann_sidecar_path(path))
+
+
+def _rss() -> Optional[int]:
+    """Current resident set size in bytes, if it can be read."""
+    try:
+        with open("/proc/self/statm") as stream:
+            return int(stream.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return _peak_rss()
+
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of the process, where supported (linux)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as stream:
+            stream.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss() -> Optional[int]:
+    """Peak resident set size of the process in bytes, since the last reset if supported."""
+    try:
+        with open("/proc/self/status") as stream:
+            for line in stream:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _case_operation(case: Dict, directory: Path, rows: int, dims: int, seed: int, options: Dict) -> Callable[[], None]:
+    """
+    Set up a case, returning the operation to time.
+
+    :return: function running the operation
+    """
+    format = case["format"]
+    load_mode = LoadMode(options.get("load_mode", LoadMode.NUMPY))
+    source = index_path(directory, "input", format)
+    if case["operation"] == "load":
+        return lambda: load_index(source, format=format, mode=load_mode, check=False)
+    if case["operation"] == "save":
+        ix = synthetic_index(rows, dims, seed, options.get("objects", False))
+        return lambda: save_index(ix, index_path(directory, "saved", format), format=format)
+    if case["operation"] == "convert":
+        target = case["target_format"]
+
+        def convert():
+            ix = load_index(source, format=format, mode=LoadMode.NUMPY, check=True)
+            save_index(ix, index_path(directory, f"converted_{format.value}_{target.value}", target), format=target)
+
+        return convert
+    if case["operation"] == "validate":
+        return lambda: validate_file(source, format=format)
+    queries = np.random.default_rng(seed + 1).standard_normal((options.get("num_queries", DEFAULT_NUM_QUERIES), dims))
+    path = case["search"]
+    if path == "int8":
+        ix = load_index(index_path(directory, "int8", format), mode=LoadMode.NUMPY, dequantize=False)
+    else:
+        ix = load_index(index_path(directory, "ann" if path == "ann" else "input", format), mode=LoadMode.NUMPY)
+    return lambda: search(ix, queries, k=10, exact=path != "ann")
+
+
+def run_case(case: Dict, directory: Union[str, Path], rows: int, dims: int, seed: int = 0, **options) -> Dict:
+    """
+    Run one case in the current process, timing the operation and measuring memory.
+
+    :param case: see benchmark_cases
+    :param directory: working directory, with the inputs written by prepare_inputs
+    :param rows: number of rows
+    :param dims: number of dimensions
+    :param seed: random seed
+    :param options: load_mode, objects, num_queries
+    :return: dict with the seconds, the resident memory before the operation and the peak
+    """
+    operation = _case_operation(case, Path(directory), rows, dims, seed, options)
+    rss_before = _rss()
+    _reset_peak_rss()
+    start = time.perf_counter()
+    operation()
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "rss_before_bytes": rss_before, "peak_rss_bytes": _peak_rss()}
+
+
+def _run_isolated(case: Dict, directory: Path, rows: int, dims: int, seed: int, options: Dict) -> Dict:
+    # a fresh process per run, so the peak memory of one case does not carry over to the next
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_case, case, directory, rows, dims, seed, **options).result()
+
+
+def environment() -> Dict:
+    """
+    Describe the environment of a benchmark run, to tell results apart.
+
+    :return:
+    """
+    git = shutil.which("git")
+    try:
+        commit = subprocess.run(  # noqa: S603 - a fixed command
+            [git, "rev-parse", "HEAD"], capture_output=True, text=True, check=True, timeout=10
+        )
+        commit = commit.stdout.strip()
+    except (TypeError, OSError, subprocess.SubprocessError):
+        # not installed, or not run from a git checkout
+        commit = None
+    return {
+        "venomx": vx.__version__,
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pyarrow": pa.__version__,
+        "pandas": importlib_metadata.version("pandas"),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def run_benchmarks(
+    scales: List[str],
+    formats: List[EmbeddingFormat],
+    directory: Union[str, Path],
+    operations: List[str] = None,
+    search_paths: List[str] = None,
+    repeat: int = 1,
+    isolate=True,
+    seed: int = 0,
+    **options,
+) -> Dict:
+    """
+    Run benchmarks over synthetic indexes.
+
+    Each case is set up untimed, then its operation is timed; with ``isolate``, each
+    run is in a fresh process, so the peak memory is that of the case alone. Over
+    repeats, the fastest time and the highest peak memory are kept.
+
+    :param scales: scales of the indexes, e.g. ``["10kx128", "1Mx768"]``
+    :param formats: formats to benchmark
+    :param directory: working directory for the index files
+    :param operations: subset of OPERATIONS, default all
+    :param search_paths: subset of SEARCH_PATHS, default all
+    :param repeat: number of runs of each case
+    :param isolate: run each case in a separate process
+    :param seed: random seed of the embeddings
+    :param options: passed to run_case: load_mode, objects, num_queries
+    :return: dict with the environment, and the results, one per case and scale
+    """
+    cases = benchmark_cases(formats, operations, search_paths)
+    results = []
+    for scale in scales:
+        rows, dims = parse_scale(scale)
+        scale_directory = Path(directory) / f"{rows}x{dims}"
+        logger.info(f"Preparing inputs for {rows}x{dims}")
+        prepare_inputs(scale_directory, rows, dims, cases, seed, options.get("objects", False))
+        for case in cases:
+            runs = []
+            for _ in range(repeat):
+                if isolate:
+                    runs.append(_run_isolated(case, scale_directory, rows, dims, seed, options))
+                else:
+                    runs.append(run_case(case, scale_directory, rows, dims, seed, **options))
+            seconds = min(r["seconds"] for r in runs)
+            peaks = [r["peak_rss_bytes"] for r in runs if r["peak_rss_bytes"] is not None]
+            result = {
+                "name": case["name"],
+                "rows": rows,
+                "dims": dims,
+                "seconds": seconds,
+                "rows_per_second": rows / seconds if seconds else None,
+                "rss_before_bytes": runs[0]["rss_before_bytes"],
+                "peak_rss_bytes": max(peaks) if peaks else None,
+                "repeat": repeat,
+            }
+            logger.info(f"{case['name']} {rows}x{dims}: {seconds:.3f}s")
+            results.append(result)
+    return {"environment": environment(), "results": results}
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> List[Dict]:
+    """
+    Compare benchmark results with those of a baseline, e.g. from another commit.
+
+    >>> old = {"results": [{"name": "load:parquet", "rows": 10, "dims": 2, "seconds": 1.0, "peak_rss_bytes": 100}]}
+    >>> new = {"results": [{"name": "load:parquet", "rows": 10, "dims": 2, "seconds": 1.5, "peak_rss_bytes": 100}]}
+    >>> [(c["name"], c["time_ratio"], c["regression"]) for c in compare_results(old, new)]
+    [('load:parquet', 1.5, True)]
+
+    :param baseline: results of run_benchmarks
+    :param current: results of run_benchmarks
+    :param threshold: relative slowdown (or memory growth) reported as a regression
+    :return: one dict per case found in both, with the ratios of current to baseline
+    """
+    base = {(r["name"], r["rows"], r["dims"]): r for r in baseline["results"]}
+    comparisons = []
+    for result in current["results"]:
+        old = base.get((result["name"], result["rows"], result["dims"]))
+        if old is None:
+            continue
+        time_ratio = result["seconds"] / old["seconds"] if old["seconds"] else None
+        memory_ratio = None
+        if old.get("peak_rss_bytes") and result.get("peak_rss_bytes"):
+            memory_ratio = result["peak_rss_bytes"] / old["peak_rss_bytes"]
+        comparisons.append(
+            {
+                "name": result["name"],
+                "rows": result["rows"],
+                "dims": result["dims"],
+                "time_ratio": time_ratio,
+                "memory_ratio": memory_ratio,
+                "regression": any(r is not None and r > 1 + threshold for r in (time_ratio, memory_ratio)),
+            }
+        )
+    return comparisons
+
+
+def save_results(results: Dict, path: Union[str, Path]):
+    """
+    Save benchmark results as json.
+
+    :param results:
+    :param path:
+    :return:
+    """
+    with open(path, "w", encoding="utf-8") as stream:
+        json.dump(results, stream, indent=2)
+
+
+def load_results(path: Union[str, Path]) -> Dict:
+    """
+    Load benchmark results saved as json.
+
+    :param path:
+    :return:
+    """
+    with open(path, encoding="utf-8") as stream:
+        return json.load(stream)
@@ -1,6 +1,10 @@
 """Command line interface for venomx."""
 
+import json
 import logging
+import tempfile
+from pathlib import Path
+from typing import Optional
 
 import click
 
@@ -8,7 +12,29 @@ __all__ = [
     "main",
 ]
 
-from venomx.tools.file_io import EmbeddingFormat, load_index, save_index
+# commands import the modules they use, so that startup (and --help) does not pay for numpy, pandas and pyarrow
+from venomx.tools import profiling
+from venomx.tools.constants import (
+    DEFAULT_BAND_BITS,
+    DEFAULT_BATCH_WINDOW,
+    DEFAULT_DEDUP_THRESHOLD,
+    DEFAULT_EMBED_BATCH_SIZE,
+    DEFAULT_MAX_BATCH_SIZE,
+    DEFAULT_MAX_IN_FLIGHT,
+    DEFAULT_NUM_QUERIES,
+    DEFAULT_REGRESSION_THRESHOLD,
+    DEFAULT_SCALES,
+    DEFAULT_SERVE_HOST,
+    DEFAULT_SERVE_PORT,
+    DEFAULT_SIMHASH_BITS,
+    OPERATIONS,
+    SEARCH_PATHS,
+    SUFFIX_MAP,
+    EmbeddingFormat,
+    LoadMode,
+    SearchMetric,
+    StorageDtype,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +53,20 @@ output_embeddings_format_option = click.option(
     default="parquet",
     help="Format of the output embeddings.",
 )
+metric_option = click.option(
+    "-m",
+    "--metric",
+    type=click.Choice([x.value for x in SearchMetric]),
+    default=SearchMetric.COSINE.value,
+    show_default=True,
+    help="Similarity metric.",
+)
+sort_ids_option = click.option(
+    "--sort-ids/--no-sort-ids",
+    default=False,
+    show_default=True,
+    help="Write the embeddings sorted by id, so that subsets by prefix only read their row groups.",
+)
 output_option = click.option(
     "-o",
     "--output",
@@ -39,12 +79,25 @@ output_option = click.option(
 @click.group()
 @click.option("-v", "--verbose", count=True)
 @click.option("-q", "--quiet")
-def main(verbose: int, quiet: bool):
+@click.option("--profile", is_flag=True, help="Print the time spent in each phase of loading, saving and validating.")
+@click.option("--profile-output", type=click.Path(), help="Write the profile as json (implies --profile).")
+@click.option(
+    "--profile-format",
+    type=click.Choice(["json", "chrome"]),
+    default="json",
+    show_default=True,
+    help="Format of --profile-output; chrome is the trace event format of chrome://tracing and Perfetto.",
+)
+@click.pass_context
+def main(ctx: click.Context, verbose: int, quiet: bool, profile: bool, profile_output: str, profile_format: str):
     """
     CLI for venomx.
 
     :param verbose: Verbosity while running.
     :param quiet: Boolean to be quiet or verbose.
+    :param profile: Print a per-phase breakdown of the time spent.
+    :param profile_output: Path to write the profile to.
+    :param profile_format: json or chrome.
     """
     if verbose >= 2:
         logger.setLevel(level=logging.DEBUG)
@@ -54,14 +107,39 @@ def main(verbose: int, quiet: bool):
         logger.setLevel(level=logging.WARNING)
     if quiet:
         logger.setLevel(level=logging.ERROR)
+    if profile or profile_output:
+        profiler = profiling.enable()
+
+        def report():
+            profiling.disable()
+            click.echo(str(profiler), err=True)
+            if profile_output:
+                profiler.save(profile_output, chrome=profile_format == "chrome")
+
+        ctx.call_on_close(report)
 
 
 @main.command()
 @input_embeddings_format_option
+@click.option("--strict/--no-strict", default=False, show_default=True, help="Fail on warnings as well as errors.")
+@click.option("--json", "as_json", is_flag=True, help="Print the report as json.")
 @click.argument("input_file")
-def validate(input_file: str, input_embeddings_format: str):
-    """Validate an index."""
-    load_index(input_file, format=input_embeddings_format, check=True)
+def validate(input_file: str, input_embeddings_format: str, strict: bool, as_json: bool):
+    """
+    Validate an index.
+
+    The embeddings are streamed in batches and checked for inconsistent dimensions,
+    null, NaN/infinite and all-zero vectors, duplicate ids, and ids missing from the objects.
+    """
+    from venomx.tools.file_io import validate_file
+
+    report = validate_file(input_file, format=EmbeddingFormat(input_embeddings_format))
+    if as_json:
+        print(json.dumps(report.to_dict(), indent=2))
+    else:
+        print(report)
+    if not report.ok or (strict and report.warnings):
+        raise click.ClickException(f"Validation failed for {input_file}")
 
 
 @main.command()
@@ -69,18 +147,675 @@ def validate(input_file: str, input_embeddings_format: str):
 @input_embeddings_format_option
 @output_embeddings_format_option
 @output_option
-def convert(input_file: str, input_embeddings_format: str, output_embeddings_format: str, output: str):
-    """Merge an index."""
-    ix = load_index(input_file, format=EmbeddingFormat(input_embeddings_format), check=True)
-    save_index(ix, output, format=EmbeddingFormat(output_embeddings_format))
+@click.option(
+    "--dtype",
+    type=click.Choice([x.value for x in StorageDtype]),
+    default=StorageDtype.FLOAT32.value,
+    show_default=True,
+    help="Storage dtype of the output embeddings; int8 is scalar quantized per dimension.",
+)
+@click.option("--shards", type=int, help="Split the output embeddings into this many files, written in parallel.")
+@click.option(
+    "--objects-table/--no-objects-table",
+    default=None,
+    help="Write the named objects as a parquet file next to the metadata; default as in the input.",
+)
+@sort_ids_option
+@click.option(
+    "--pipeline/--no-pipeline",
+    default=False,
+    show_default=True,
+    help="Stream the embeddings batch by batch, reading, converting and writing in parallel threads. "
+    "All-in-one inputs (YAML, JSON) are still parsed whole before streaming.",
+)
+@click.option("--batch-size", type=int, help="Rows per batch when pipelined.")
+@click.option(
+    "--jobs",
+    default=1,
+    show_default=True,
+    help="Number of processes converting indexes, when the input is a directory or a glob.",
+)
+def convert(
+    input_file: str,
+    input_embeddings_format: str,
+    output_embeddings_format: str,
+    output: str,
+    dtype: str,
+    shards: int,
+    objects_table: Optional[bool],
+    sort_ids: bool,
+    pipeline: bool,
+    batch_size: Optional[int],
+    jobs: int,
+):
+    """
+    Merge an index.
+
+    If INPUT_FILE is a directory or a glob, each index it matches is converted into
+    the output directory, under the same name.
+    """
+    from venomx.tools.convert import convert_index, convert_many, expand_inputs
+
+    options = {
+        "input_format": EmbeddingFormat(input_embeddings_format),
+        "dtype": StorageDtype(dtype),
+        "num_shards": shards,
+        "objects_table": objects_table,
+        "sort_ids": sort_ids,
+        "pipeline": pipeline,
+    }
+    if batch_size:
+        options["batch_size"] = batch_size
+    output_format = EmbeddingFormat(output_embeddings_format)
+    if not (Path(input_file).is_dir() or any(c in input_file for c in "*?[")):
+        convert_index(input_file, output, output_format=output_format, **options)
+        return
+    sources = expand_inputs(input_file, options["input_format"])
+    if not sources:
+        raise click.ClickException(f"No indexes found: {input_file}")
+    results = convert_many(sources, output, output_format, jobs=jobs, **options)
+    for result in results:
+        outcome = f"ERROR {result['error']}" if result["error"] else f"{result['rows']} embeddings"
+        print(f"{result['source']} -> {result['target']}: {outcome} ({result['seconds']:.2f}s)")
+    failed = [result for result in results if result["error"]]
+    if failed:
+        raise click.ClickException(f"{len(failed)} of {len(results)} conversions failed")
+
+
+@main.command()
+@input_embeddings_format_option
+@output_embeddings_format_option
+@output_option
+@click.option("--prefix", multiple=True, help="Keep ids with this prefix; CURIE prefixes also match their URIs.")
+@click.option("--id", "ids", multiple=True, help="Keep this id; CURIEs and URIs match either form.")
+@click.option("--ids-file", type=click.File(), help="Keep the ids listed in this file, one per line.")
+@click.option("--metadata", multiple=True, help="Keep the objects with this metadata value.")
+@sort_ids_option
+@click.argument("input_file")
+def subset(
+    input_file: str,
+    input_embeddings_format: str,
+    output_embeddings_format: str,
+    output: str,
+    prefix: tuple,
+    ids: tuple,
+    ids_file,
+    metadata: tuple,
+    sort_ids: bool,
+):
+    """
+    Extract the embeddings of an index with an id prefix, listed ids, or object metadata.
+
+    Rows must meet all the criteria given. Only the matching rows are read: for an
+    index written with --sort-ids, parquet row groups of other ids are skipped.
+    """
+    from venomx.tools.file_io import save_index
+    from venomx.tools.subset import load_subset
+
+    selected = list(ids) + ([line.strip() for line in ids_file if line.strip()] if ids_file else [])
+    ix = load_subset(
+        input_file,
+        format=EmbeddingFormat(input_embeddings_format),
+        prefixes=list(prefix) or None,
+        ids=selected if ids or ids_file else None,
+        metadata=list(metadata) or None,
+        mode=LoadMode.ARROW,
+    )
+    format = EmbeddingFormat(output_embeddings_format)
+    save_index(ix, output, format=format, sort_ids=sort_ids and format in SUFFIX_MAP)
+    print(f"Embeddings: {ix.embeddings_count}")
+
+
+@main.command()
+@input_embeddings_format_option
+@click.argument("input_file")
+def info(input_file: str, input_embeddings_format: str):
+    """
+    Show information.
+
+    Only the metadata and the embeddings file footer are read.
+    """
+    from venomx.tools.file_io import open_index
+
+    lix = open_index(input_file, format=EmbeddingFormat(input_embeddings_format))
+    summary = lix.summary()
+    print(f"Num objects: {summary['num_objects']}")
+    print(f"Num embeddings: {summary['num_rows']}")
+    print(f"Dimensions: {summary['dimensions']}")
+    print(f"Dtype: {summary['dtype']}")
+    if summary["num_shards"]:
+        print(f"Shards: {summary['num_shards']}")
+    if summary["num_segments"]:
+        print(f"Segments: {summary['num_segments']}")
+    if summary["num_row_groups"] is not None:
+        print(f"Row groups: {summary['num_row_groups']}")
+    print(f"Bytes: {summary['num_bytes']}")
+    if summary["schema"]:
+        print(f"Schema:\n{summary['schema']}")
+
+
+@main.command("search")
+@input_embeddings_format_option
+@click.option("-k", "--limit", default=10, show_default=True, help="Number of neighbours per query.")
+@metric_option
+@click.option("--nprobe", type=int, help="Number of lists to scan, if the index has an ANN sidecar.")
+@click.option("--exact/--no-exact", default=False, show_default=True, help="Ignore any ANN sidecar.")
+@click.option("-i", "--query-id", multiple=True, help="Id of an object in the index to use as a query.")
+@click.option("--query-file", type=click.Path(exists=True), help="A .npy file with a (Q, D) matrix of queries.")
+@click.argument("input_file")
+def search_command(
+    input_file: str,
+    input_embeddings_format: str,
+    limit: int,
+    metric: str,
+    nprobe: int,
+    exact: bool,
+    query_id: tuple,
+    query_file: str,
+):
+    """
+    Find nearest neighbours in an index.
+
+    Results are written as tab-separated query, match, score rows.
+    """
+    import numpy as np
+
+    from venomx.tools.file_io import embeddings_ids, embeddings_rows, load_index
+    from venomx.tools.search import search
+
+    ix = load_index(input_file, format=EmbeddingFormat(input_embeddings_format), mode=LoadMode.NUMPY, dequantize=False)
+    query_labels = []
+    queries = []
+    if query_id:
+        row_by_id = {str(x): i for i, x in enumerate(embeddings_ids(ix))}
+        missing = [x for x in query_id if x not in row_by_id]
+        if missing:
+            raise click.BadParameter(f"Not in index: {missing}", param_hint="--query-id")
+        query_labels.extend(query_id)
+        queries.append(embeddings_rows(ix, [row_by_id[x] for x in query_id]))
+    if query_file:
+        query_matrix = np.atleast_2d(np.load(query_file))
+        query_labels.extend(str(i) for i in range(len(query_matrix)))
+        queries.append(query_matrix)
+    if not queries:
+        raise click.UsageError("Specify at least one --query-id or --query-file")
+    search_options = {"nprobe": nprobe} if nprobe else {}
+    result_ids, result_scores = search(
+        ix, np.vstack(queries), k=limit, metric=SearchMetric(metric), exact=exact, **search_options
+    )
+    for label, row_ids, row_scores in zip(query_labels, result_ids, result_scores, strict=True):
+        for match, score in zip(row_ids, row_scores, strict=True):
+            if match is None:
+                continue
+            print(f"{label}\t{match}\t{score:.6f}")
+
+
+@main.command("build-ann")
+@input_embeddings_format_option
+@metric_option
+@click.option("--nlist", type=int, help="Number of coarse lists (default 4 * sqrt(N)).")
+@click.option("--pq-subspaces", default=0, show_default=True, help="Product quantization subspaces; 0 disables PQ.")
+@click.option("--iterations", default=20, show_default=True, help="k-means iterations.")
+@click.option("-k", "--limit", default=10, show_default=True, help="k for the recall@k report.")
+@click.option(
+    "--nprobe", multiple=True, type=int, default=[1, 4, 16], show_default=True, help="nprobe values to report."
+)
+@click.option("--sample-size", default=200, show_default=True, help="Number of sampled queries for the report.")
+@click.argument("input_file")
+def build_ann_command(
+    input_file: str,
+    input_embeddings_format: str,
+    metric: str,
+    nlist: int,
+    pq_subspaces: int,
+    iterations: int,
+    limit: int,
+    nprobe: tuple,
+    sample_size: int,
+):
+    """
+    Build an approximate nearest neighbour sidecar for an index.
+
+    The IVF index is written next to the metadata file, and picked up by load_index.
+    Recall@k against exact search, and latency, is reported for each nprobe.
+    """
+    from venomx.tools.ann import ann_sidecar_path, build_ann, evaluate_ann
+    from venomx.tools.file_io import embeddings_file_tuple, embeddings_matrix, load_index
+
+    format = EmbeddingFormat(input_embeddings_format)
+    ix = load_index(input_file, format=format, mode=LoadMode.NUMPY)
+    ids, matrix = embeddings_matrix(ix)
+    ivf = build_ann(ix, SearchMetric(metric), nlist=nlist, pq_subspaces=pq_subspaces, n_iter=iterations)
+    metadata_path = input_file if format not in SUFFIX_MAP else embeddings_file_tuple(input_file, format)[0]
+    sidecar = ann_sidecar_path(metadata_path)
+    ivf.save(sidecar)
+    logger.info(f"Wrote {sidecar}")
+    print(f"nprobe\trecall@{limit}\tms_per_query")
+    for row in evaluate_ann(ivf.searcher(ids, matrix), matrix, k=limit, nprobes=nprobe, sample_size=sample_size):
+        print(f"{row['nprobe']}\t{row['recall']:.4f}\t{row['ms_per_query']:.3f}")
 
 
 @main.command()
+@input_embeddings_format_option
+@click.option("--host", default=DEFAULT_SERVE_HOST, show_default=True, help="Host to listen on.")
+@click.option("--port", default=DEFAULT_SERVE_PORT, show_default=True, help="TCP port to listen on.")
+@click.option("--socket", "socket_path", type=click.Path(), help="Listen on this unix socket instead of TCP.")
+@metric_option
+@click.option(
+    "--batch-window",
+    default=DEFAULT_BATCH_WINDOW * 1000,
+    show_default=True,
+    help="Milliseconds to wait for concurrent queries to score together.",
+)
+@click.option(
+    "--max-batch-size", default=DEFAULT_MAX_BATCH_SIZE, show_default=True, help="Maximum number of queries per batch."
+)
+@click.option("--workers", default=1, show_default=True, help="Number of threads scoring batches.")
+@click.option("--exact/--no-exact", default=False, show_default=True, help="Ignore any ANN sidecar.")
+@click.argument("input_files", nargs=-1, required=True)
+def serve(
+    input_files: tuple,
+    input_embeddings_format: str,
+    host: str,
+    port: int,
+    socket_path: str,
+    metric: str,
+    batch_window: float,
+    max_batch_size: int,
+    workers: int,
+    exact: bool,
+):
+    """
+    Serve lookups and nearest neighbour searches over HTTP, keeping the indexes in memory.
+
+    Each INPUT_FILE is served under its file name without suffixes, or NAME=PATH. Concurrent
+    searches are scored together in micro-batches; GET /metrics reports latencies and
+    batch sizes.
+    """
+    from venomx.tools.file_io import load_index
+    from venomx.tools.serve import index_name
+    from venomx.tools.serve import serve as serve_indexes
+
+    indexes = {}
+    for input_file in input_files:
+        name, _, path = input_file.partition("=") if "=" in input_file else ("", "", input_file)
+        name = name or index_name(path)
+        if name in indexes:
+            raise click.BadParameter(f"Duplicate index name: {name}", param_hint="INPUT_FILES")
+        format = EmbeddingFormat(input_embeddings_format)
+        indexes[name] = load_index(path, format=format, mode=LoadMode.NUMPY, dequantize=False)
+    serve_indexes(
+        indexes,
+        host=host,
+        port=port,
+        socket_path=socket_path,
+        metric=SearchMetric(metric),
+        window=batch_window / 1000,
+        max_batch_size=max_batch_size,
+        workers=workers,
+        exact=exact,
+    )
+
+
+@main.command("knn-graph")
+@input_embeddings_format_option
+@output_option
+@click.option("-k", "--limit", default=10, show_default=True, help="Number of neighbours per embedding.")
+@metric_option
+@click.option("--threshold", type=float, help="Only keep scores at least this (distances at most this, for euclidean).")
+@click.option(
+    "--memory-budget", default=256, show_default=True, help="Megabytes for the score tiles being computed at a time."
+)
+@click.option("--workers", type=int, help="Number of threads (default: number of CPUs).")
+@click.option("--include-self/--exclude-self", default=False, show_default=True, help="Keep each row as its own match.")
 @click.argument("input_file")
-def info(input_file: str):
-    """Show information."""
-    ix = load_index(input_file, check=True)
-    print(f"Num objects: {len(ix.objects)}")
+@click.argument("target_file", required=False)
+def knn_graph_command(
+    input_file: str,
+    target_file: str,
+    input_embeddings_format: str,
+    output: str,
+    limit: int,
+    metric: str,
+    threshold: float,
+    memory_budget: int,
+    workers: int,
+    include_self: bool,
+):
+    """
+    Compute the top k neighbours of every embedding of an index, as a parquet file.
+
+    With TARGET_FILE, neighbours are found in that index instead (e.g. to match two
+    ontologies). The output has source_id, target_id and score columns, and is written
+    as the score matrix is computed, in tiles that fit the memory budget.
+    """
+    from venomx.tools.file_io import load_index
+    from venomx.tools.knn_graph import save_knn_graph
+
+    format = EmbeddingFormat(input_embeddings_format)
+    source = load_index(input_file, format=format, mode=LoadMode.NUMPY, dequantize=False)
+    target = load_index(target_file, format=format, mode=LoadMode.NUMPY, dequantize=False) if target_file else None
+    num_rows = save_knn_graph(
+        source,
+        output,
+        target=target,
+        k=limit,
+        metric=SearchMetric(metric),
+        memory_budget=memory_budget * 2**20,
+        workers=workers,
+        exclude_self=False if include_self else None,
+        threshold=threshold,
+    )
+    print(f"Pairs: {num_rows}")
+
+
+@main.command()
+@input_embeddings_format_option
+@output_embeddings_format_option
+@click.option("-o", "--output", type=click.Path(), help="Write the deduplicated index to this path.")
+@click.option(
+    "--threshold", default=DEFAULT_DEDUP_THRESHOLD, show_default=True, help="Minimum cosine similarity of duplicates."
+)
+@click.option(
+    "--bits", default=DEFAULT_SIMHASH_BITS, show_default=True, help="SimHash signature bits; more find more duplicates."
+)
+@click.option(
+    "--band-bits",
+    type=click.Choice(["8", "16", "32", "64"]),
+    default=str(DEFAULT_BAND_BITS),
+    show_default=True,
+    help="Bits per LSH band; more compare fewer dissimilar rows.",
+)
+@click.option("--seed", default=0, show_default=True, help="Seed of the random hyperplanes.")
+@click.argument("input_file")
+def dedup(
+    input_file: str,
+    input_embeddings_format: str,
+    output_embeddings_format: str,
+    output: Optional[str],
+    threshold: float,
+    bits: int,
+    band_bits: str,
+    seed: int,
+):
+    """
+    Find near-duplicate embeddings, and optionally remove them.
+
+    Duplicates are written as tab-separated id, duplicate_of, score rows, where
+    duplicate_of is the first row of the group, which is kept. Rows are grouped with
+    random hyperplane LSH signatures, so only rows sharing a band are compared.
+    With --output, the index is written without the duplicates; the kept objects list
+    the ids merged into them as alias:<id> metadata.
+    """
+    from venomx.tools.dedup import deduplicate, find_duplicates
+    from venomx.tools.file_io import load_index, save_index
+
+    ix = load_index(input_file, format=EmbeddingFormat(input_embeddings_format), mode=LoadMode.NUMPY)
+    options = {"threshold": threshold, "num_bits": bits, "band_bits": int(band_bits), "seed": seed}
+    if output:
+        deduped, duplicates = deduplicate(ix, **options)
+        save_index(deduped, output, format=EmbeddingFormat(output_embeddings_format))
+    else:
+        duplicates = find_duplicates(ix, **options)
+    for row in duplicates.to_pylist():
+        print(f"{row['id']}\t{row['duplicate_of']}\t{row['score']:.6f}")
+    groups = len(set(duplicates.column("duplicate_of").to_pylist()))
+    click.echo(f"Duplicates: {duplicates.num_rows} in {groups} groups", err=True)
+
+
+@main.command()
+@input_embeddings_format_option
+@click.option("--workers", type=int, help="Number of threads (default: number of CPUs).")
+@click.argument("input_file")
+def verify(input_file: str, input_embeddings_format: str, workers: int):
+    """
+    Verify the embeddings of an index against the md5s in its metadata.
+
+    Row groups are checked in parallel; each corrupted row group is reported.
+    """
+    from venomx.tools.integrity import verify_index
+
+    failures = verify_index(input_file, format=EmbeddingFormat(input_embeddings_format), workers=workers)
+    for failure in failures:
+        if "segment" in failure:
+            print(
+                f"Corrupted segment {failure['segment']} ({failure['path']}): "
+                f"expected {failure['expected']}, found {failure['actual']}"
+            )
+        elif failure["chunk"] is None:
+            print(f"Mismatch: expected {failure['expected']}, found {failure['actual']}")
+        else:
+            print(
+                f"Corrupted chunk {failure['chunk']} (rows {failure['first_row']}-"
+                f"{failure['first_row'] + failure['num_rows'] - 1}): "
+                f"expected {failure['expected']}, found {failure['actual']}"
+            )
+    if failures:
+        raise click.ClickException(f"{len(failures)} integrity failures in {input_file}")
+    print("OK")
+
+
+@main.command()
+@input_embeddings_format_option
+@click.option(
+    "--mode",
+    type=click.Choice(["append", "upsert"]),
+    default="upsert",
+    show_default=True,
+    help="append fails on ids already in the index; upsert replaces them.",
+)
+@click.option("--delete", "deleted", multiple=True, help="Id to delete from the index.")
+@click.option("--delete-file", type=click.Path(exists=True), help="A file of ids to delete, one per line.")
+@click.argument("input_file")
+@click.argument("delta_file", required=False)
+def merge(input_file: str, delta_file: str, input_embeddings_format: str, mode: str, deleted: tuple, delete_file: str):
+    """
+    Merge a delta index into an index, without rewriting it.
+
+    The embeddings of the delta are written as a new segment next to the index, and
+    deleted ids recorded as tombstones in its metadata. Both are folded back in by compact.
+    """
+    from venomx.tools.delta import append, delete, upsert
+    from venomx.tools.file_io import embeddings_matrix, load_index
+
+    format = EmbeddingFormat(input_embeddings_format)
+    deleted = list(deleted)
+    if delete_file:
+        with open(delete_file) as stream:
+            deleted.extend(line.strip() for line in stream if line.strip())
+    if not delta_file and not deleted:
+        raise click.UsageError("Specify a DELTA_FILE, --delete or --delete-file")
+    if deleted:
+        segment = delete(input_file, deleted, format=format)
+        print(f"Deleted: {len(segment.tombstones or [])}")
+    if delta_file:
+        delta = load_index(delta_file, format=format, check=True, mode=LoadMode.NUMPY)
+        ids, matrix = embeddings_matrix(delta)
+        add = append if mode == "append" else upsert
+        segment = add(input_file, ids, matrix, objects=delta.objects, format=format)
+        print(f"Merged: {segment.count}")
+
+
+@main.command("compact")
+@input_embeddings_format_option
+@click.option("--workers", type=int, help="Number of threads (default: number of CPUs).")
+@click.argument("input_file")
+def compact_command(input_file: str, input_embeddings_format: str, workers: int):
+    """
+    Fold the delta segments of an index back into its embeddings files.
+
+    The segment files are removed; the number of shards and storage dtype are kept.
+    """
+    from venomx.tools.delta import compact
+
+    ix = compact(input_file, format=EmbeddingFormat(input_embeddings_format), workers=workers)
+    print(f"Num embeddings: {ix.embeddings_count}")
+
+
+@main.command()
+@input_embeddings_format_option
+@output_embeddings_format_option
+@output_option
+@click.option(
+    "--encoder", default="hashing", show_default=True, help="Encoder backend; others are added with register_encoder."
+)
+@click.option("--dimensions", type=int, help="Number of dimensions, for encoders that support it.")
+@click.option(
+    "--field", multiple=True, help="Named object field to build the input text from (default: the input method)."
+)
+@click.option("--batch-size", default=DEFAULT_EMBED_BATCH_SIZE, show_default=True, help="Texts per encoder call.")
+@click.option(
+    "--concurrency", default=DEFAULT_MAX_IN_FLIGHT, show_default=True, help="Maximum concurrent encoder calls."
+)
+@click.option("--cache-dir", type=click.Path(), help="Cache of embeddings, keyed by model and input text.")
+@click.argument("input_file")
+def embed(
+    input_file: str,
+    input_embeddings_format: str,
+    output_embeddings_format: str,
+    output: str,
+    encoder: str,
+    dimensions: int,
+    field: tuple,
+    batch_size: int,
+    concurrency: int,
+    cache_dir: str,
+):
+    """
+    Embed the named objects of an index.
+
+    Only the metadata of INPUT_FILE is read. The input text of each object is built
+    from the fields of its embedding_input_method (default the label). With a cache,
+    objects whose input text is unchanged are not re-embedded.
+    """
+    from venomx.model.venomx import ModelInputMethod
+    from venomx.tools.embed import ENCODERS, EmbeddingCache, EmbeddingPipeline, get_encoder
+    from venomx.tools.file_io import load_metadata, save_index
+
+    if encoder not in ENCODERS:
+        raise click.BadParameter(f"Unknown encoder: {encoder}", param_hint="--encoder")
+    ix = load_metadata(input_file, format=EmbeddingFormat(input_embeddings_format))
+    options = {"dimensions": dimensions} if dimensions else {}
+    pipeline = EmbeddingPipeline(
+        get_encoder(encoder, **options),
+        cache=EmbeddingCache(cache_dir) if cache_dir else None,
+        input_method=ModelInputMethod(fields=list(field)) if field else None,
+        batch_size=batch_size,
+        max_in_flight=concurrency,
+    )
+    pipeline.embed_index(ix)
+    save_index(ix, output, format=EmbeddingFormat(output_embeddings_format))
+    print(f"Encoded: {pipeline.num_encoded}")
+    print(f"Cached: {pipeline.num_cached}")
+
+
+def _megabytes(num_bytes):
+    return f"{num_bytes / 2**20:.1f}" if num_bytes is not None else "-"
+
+
+@main.command("benchmark")
+@click.option(
+    "--scale",
+    multiple=True,
+    default=DEFAULT_SCALES,
+    show_default=True,
+    help="Size of a synthetic index, as ROWSxDIMS, e.g. 1Mx768.",
+)
+@click.option(
+    "--format",
+    "formats",
+    multiple=True,
+    type=click.Choice([x.value for x in EmbeddingFormat]),
+    default=[EmbeddingFormat.PARQUET.value, EmbeddingFormat.ARROW.value],
+    show_default=True,
+    help="Format to benchmark.",
+)
+@click.option("--operation", multiple=True, type=click.Choice(OPERATIONS), help="Operation to run (default: all).")
+@click.option("--search-path", multiple=True, type=click.Choice(SEARCH_PATHS), help="Search path (default: all).")
+@click.option(
+    "--load-mode",
+    type=click.Choice([x.value for x in LoadMode]),
+    default=LoadMode.NUMPY.value,
+    show_default=True,
+    help="Mode of load_index.",
+)
+@click.option("--objects/--no-objects", default=False, show_default=True, help="Add a named object per row.")
+@click.option("--queries", default=DEFAULT_NUM_QUERIES, show_default=True, help="Number of search queries.")
+@click.option("--repeat", default=1, show_default=True, help="Runs per case; the fastest is kept.")
+@click.option("--isolate/--no-isolate", default=True, show_default=True, help="Run each case in a fresh process.")
+@click.option("--work-dir", type=click.Path(), help="Directory for the index files (default: a temporary directory).")
+@click.option("-o", "--output", type=click.Path(), help="Write the results as json.")
+@click.option("--baseline", type=click.Path(exists=True), help="Results of a previous run to compare with.")
+@click.option(
+    "--threshold",
+    default=DEFAULT_REGRESSION_THRESHOLD,
+    show_default=True,
+    help="Relative slowdown or memory growth over the baseline reported as a regression.",
+)
+@click.option("--fail-on-regression", is_flag=True, help="Exit with an error if there are regressions.")
+def benchmark_command(
+    scale: tuple,
+    formats: tuple,
+    operation: tuple,
+    search_path: tuple,
+    load_mode: str,
+    objects: bool,
+    queries: int,
+    repeat: int,
+    isolate: bool,
+    work_dir: str,
+    output: str,
+    baseline: str,
+    threshold: float,
+    fail_on_regression: bool,
+):
+    """
+    Benchmark load, save, convert, validate and search on synthetic indexes.
+
+    Reports the time and peak resident memory of each case, as tab-separated rows;
+    the json output can be compared with that of another version with --baseline.
+    """
+    from venomx.tools.benchmark import compare_results, load_results, run_benchmarks, save_results
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results = run_benchmarks(
+            list(scale),
+            [EmbeddingFormat(f) for f in formats],
+            work_dir or temp_dir,
+            operations=list(operation) or None,
+            search_paths=list(search_path) or None,
+            repeat=repeat,
+            isolate=isolate,
+            load_mode=load_mode,
+            objects=objects,
+            num_queries=queries,
+        )
+    if output:
+        save_results(results, output)
+    comparisons = {}
+    if baseline:
+        comparisons = {
+            (c["name"], c["rows"], c["dims"]): c
+            for c in compare_results(load_results(baseline), results, threshold=threshold)
+        }
+    print(
+        "case\trows\tdims\tseconds\trows_per_second\tpeak_rss_mb" + ("\ttime_ratio\tmemory_ratio" if baseline else "")
+    )
+    for result in results["results"]:
+        line = (
+            f"{result['name']}\t{result['rows']}\t{result['dims']}\t{result['seconds']:.4f}\t"
+            f"{result['rows_per_second'] or 0:.0f}\t{_megabytes(result['peak_rss_bytes'])}"
+        )
+        comparison = comparisons.get((result["name"], result["rows"], result["dims"]))
+        if comparison:
+            ratios = [comparison["time_ratio"], comparison["memory_ratio"]]
+            line += "".join(f"\t{r:.2f}" if r is not None else "\t-" for r in ratios)
+            if comparison["regression"]:
+                line += "\tREGRESSION"
+        print(line)
+    regressions = [c for c in comparisons.values() if c["regression"]]
+    if regressions and fail_on_regression:
+        raise click.ClickException(f"{len(regressions)} regressions over {baseline}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+"""
+Enumerations and defaults of the tools.
+
+This module only uses the standard library, so that the command line can declare its
+options without importing numpy, pandas or pyarrow.
+"""
+
+from enum import Enum
+
+
+class EmbeddingFormat(str, Enum):
+    PARQUET = "parquet"
+    ARROW = "arrow"
+    YAML = "yaml"
+    JSON = "json"
+
+
+class LoadMode(str, Enum):
+    """How the embeddings are materialized in ``Index.embeddings_frame``."""
+
+    PANDAS = "pandas"
+    """A pandas DataFrame with an ``id`` column and a ``values`` column of python lists."""
+
+    NUMPY = "numpy"
+    """A dict with an ``id`` array and a contiguous float32 (N, D) ``values`` matrix."""
+
+    ARROW = "arrow"
+    """A pyarrow Table with an ``id`` column and a ``values`` column of fixed size float32 lists."""
+
+
+class StorageDtype(str, Enum):
+    FLOAT32 = "float32"
+    FLOAT16 = "float16"
+    INT8 = "int8"
+
+
+class SearchMetric(str, Enum):
+    COSINE = "cosine"
+    DOT = "dot"
+    EUCLIDEAN = "euclidean"
+
+
+SUFFIX_MAP = {EmbeddingFormat.PARQUET: ".parquet", EmbeddingFormat.ARROW: ".arrow"}
+
+# embedding runs (see venomx.tools.embed)
+DEFAULT_EMBED_BATCH_SIZE = 256
+DEFAULT_MAX_IN_FLIGHT = 4
+
+# benchmarks (see venomx.tools.benchmark)
+OPERATIONS = ["load", "save", "convert", "validate", "search"]
+SEARCH_PATHS = ["exact", "int8", "ann"]
+DEFAULT_SCALES = ["10kx128"]
+DEFAULT_NUM_QUERIES = 100
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+
+# query server (see venomx.tools.serve)
+DEFAULT_SERVE_HOST = "127.0.0.1"
+DEFAULT_SERVE_PORT = 8765
+DEFAULT_BATCH_WINDOW = 0.002
+DEFAULT_MAX_BATCH_SIZE = 256
+
+# near-duplicate detection (see venomx.tools.dedup)
+DEFAULT_DEDUP_THRESHOLD = 0.99
+DEFAULT_SIMHASH_BITS = 512
+DEFAULT_BAND_BITS = 32
@@ -0,0 +1,238 @@
+"""Conversion of indexes between formats: pipelined for one index, and over a process pool for many."""
+
+import glob
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+
+import venomx as vx
+from venomx.model.embeddings_pa import ID, VALUES
+from venomx.tools.constants import SUFFIX_MAP, EmbeddingFormat, LoadMode, StorageDtype
+from venomx.tools.file_io import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_ROW_GROUP_SIZE,
+    IndexWriter,
+    _arrow_frame,
+    _batch_sources,
+    _index_from_metadata,
+    _is_all_in_one,
+    _load_bundled,
+    _load_metadata,
+    _validator,
+    embeddings_file_tuple,
+    iter_pipelined,
+    list_array_to_matrix,
+    load_index,
+    save_index,
+)
+from venomx.tools.profiling import phase, profiled
+from venomx.tools.quantization import dequantize
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PIPELINE_DEPTH = 2
+
+
+def _read_batches(source: Union[str, Path], format: EmbeddingFormat, batch_size: int) -> Tuple[vx.Index, Iterator]:
+    """
+    Get the metadata of an index, and a function iterating over its embeddings as record batches.
+
+    Dual-file indexes are read one batch at a time, shard by shard; all-in-one files
+    have to be parsed as a whole, and are then sliced.
+
+    :return: tuple of the index, without embeddings, and the function returning the batches
+    """
+    if _is_all_in_one(format):
+        metadata_obj, ids, matrix = _load_bundled(source, format)
+        ix = _index_from_metadata(metadata_obj, source)
+        table = _arrow_frame(ids, matrix) if ids is not None else None
+        return ix, lambda: iter(table.to_batches(max_chunksize=batch_size) if table is not None else [])
+    metadata, _, ef = embeddings_file_tuple(source, format, allow_bundled=True)
+    ix = _index_from_metadata(_load_metadata(metadata, format), metadata)
+    sources = _batch_sources(source, ef, batch_size, [ID, VALUES])
+
+    def _batches():
+        for batch_source in sources:
+            yield from batch_source()
+
+    return ix, _batches
+
+
+def can_pipeline(
+    output_format: EmbeddingFormat, dtype: StorageDtype = StorageDtype.FLOAT32, num_shards=None, sort_ids=False
+) -> bool:
+    """
+    Check if a conversion can be streamed batch by batch.
+
+    Int8 quantizers, sorting and sharding need all the rows, and all-in-one outputs are
+    written as a whole, so these are converted by loading the index.
+
+    :return:
+    """
+    return (
+        EmbeddingFormat(output_format) in SUFFIX_MAP
+        and StorageDtype(dtype) != StorageDtype.INT8
+        and not (num_shards and num_shards > 1)
+        and not sort_ids
+    )
+
+
+@profiled("convert_index")
+def convert_index(
+    source: Union[str, Path],
+    target: Union[str, Path],
+    input_format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+    output_format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+    pipeline=False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    depth: int = DEFAULT_PIPELINE_DEPTH,
+    dtype: StorageDtype = StorageDtype.FLOAT32,
+    **kwargs,
+) -> int:
+    """
+    Convert an index to another format (or storage dtype), checking it on the way.
+
+    With ``pipeline``, reading and decoding, checking and converting, and encoding and
+    writing run in three threads, connected by queues of ``depth`` batches, so that
+    CPU and I/O overlap and only a few batches are in memory. The written embeddings
+    have the same md5 as with ``pipeline=False``, which loads the whole index and then
+    saves it. Conversions that need all the rows (see :func:`can_pipeline`) are never
+    pipelined, and all-in-one inputs (YAML, JSON) are still parsed whole before streaming.
+
+    >>> convert_index("tests/input/example.combined.yaml", "tests/output/converted.vx.yaml",
+    ...               input_format=EmbeddingFormat.YAML, pipeline=True)
+    10
+
+    :param source: path to the input index
+    :param target: path to the output index
+    :param input_format:
+    :param output_format:
+    :param pipeline: stream the embeddings batch by batch
+    :param batch_size: rows per batch when pipelined; each batch is written as row groups of at most ``row_group_size``
+    :param depth: number of batches queued between the stages
+    :param dtype: storage dtype of the output
+    :param kwargs: passed to save_index (num_shards, objects_table, sort_ids, fixed_size, row_group_size)
+    :return: number of embeddings written
+    """
+    input_format = EmbeddingFormat(input_format)
+    output_format = EmbeddingFormat(output_format)
+    if not pipeline or not can_pipeline(output_format, dtype, kwargs.get("num_shards"), kwargs.get("sort_ids")):
+        # the arrow table read is written back out as is, without a pandas or python list copy
+        ix = load_index(source, format=input_format, check=True, mode=LoadMode.ARROW)
+        save_index(ix, target, format=output_format, dtype=dtype, **kwargs)
+        return ix.embeddings_frame.num_rows
+    ix, batches = _read_batches(source, input_format, batch_size)
+    validator = _validator(ix)
+
+    def _decode(batch: pa.RecordBatch) -> Tuple[pa.Array, np.ndarray]:
+        with phase("check_batch", rows=batch.num_rows):
+            validator.update(batch.column(ID), batch.column(VALUES))
+        with phase("decode_batch", rows=batch.num_rows):
+            return batch.column(ID), dequantize(ix, list_array_to_matrix(batch.column(VALUES), dtype=None))
+
+    row_group_size = (
+        None if output_format == EmbeddingFormat.ARROW else kwargs.get("row_group_size", DEFAULT_ROW_GROUP_SIZE)
+    )
+    options = {
+        "fixed_size": kwargs.get("fixed_size", False),
+        "row_group_size": row_group_size,
+        "dtype": dtype,
+        "objects_table": kwargs.get("objects_table"),
+    }
+    with IndexWriter(ix, target, output_format, **options) as writer:
+        for ids, matrix in iter_pipelined(batches, [_decode], depth=depth):
+            writer.write_batch(ids, matrix)
+        # the metadata is only written if the whole index was valid
+        report = validator.finish()
+        report.raise_for_errors()
+    return writer.count
+
+
+def expand_inputs(pattern: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.PARQUET) -> List[Path]:
+    """
+    Get the indexes matched by a glob, or in a directory.
+
+    In a directory, the indexes are the ``.json`` files for JSON, otherwise the
+    ``.yaml`` files (all-in-one, or the metadata of dual-file indexes).
+
+    :param pattern: glob, directory or path
+    :param format: format of the indexes
+    :return: sorted paths
+    """
+    path = Path(pattern)
+    if path.is_dir():
+        suffix = ".json" if EmbeddingFormat(format) == EmbeddingFormat.JSON else ".yaml"
+        return sorted(p for p in path.iterdir() if p.suffix == suffix and p.is_file())
+    return sorted(Path(p) for p in glob.glob(str(pattern)))
+
+
+def target_path(source: Path, output_dir: Union[str, Path], output_format: EmbeddingFormat) -> Path:
+    """
+    Get the path an index is converted to, in an output directory.
+
+    >>> str(target_path(Path("in/hp.json"), "out", EmbeddingFormat.PARQUET))
+    'out/hp.yaml'
+
+    :param source: input index
+    :param output_dir:
+    :param output_format:
+    :return:
+    """
+    suffix = ".json" if EmbeddingFormat(output_format) == EmbeddingFormat.JSON else ".yaml"
+    return Path(output_dir) / f"{Path(source).stem}{suffix}"
+
+
+def _convert_one(source: Path, target: Path, options: dict) -> dict:
+    start = time.perf_counter()
+    result = {"source": str(source), "target": str(target), "rows": None, "error": None}
+    try:
+        if target.resolve() == source.resolve():
+            raise ValueError("Output would overwrite the input")
+        result["rows"] = convert_index(source, target, **options)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def convert_many(
+    sources: List[Path],
+    output_dir: Union[str, Path],
+    output_format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+    jobs: Optional[int] = None,
+    **options,
+) -> List[dict]:
+    """
+    Convert many indexes into a directory, in parallel processes.
+
+    A failed conversion is reported in its result rather than raised, so that the
+    other indexes are still converted.
+
+    :param sources: input indexes
+    :param output_dir: directory of the outputs, named after the inputs
+    :param output_format:
+    :param jobs: number of processes, default number of CPUs; 1 converts in this process
+    :param options: passed to convert_index
+    :return: one result per index, in input order, with the source, target, rows, seconds and error
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    options["output_format"] = EmbeddingFormat(output_format)
+    tasks = [(Path(source), target_path(source, output_dir, output_format)) for source in sources]
+    if len({target for _, target in tasks}) != len(tasks):
+        raise ValueError("Several inputs have the same name")
+    if jobs == 1 or len(tasks) <= 1:
+        return [_convert_one(source, target, options) for source, target in tasks]
+    results = [None] * len(tasks)
+    # spawn rather than fork, as the parent may be running threads
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(_convert_one, source, target, options): i for i, (source, target) in enumerate(tasks)}
+        for future in as_completed(futures):
+            result = results[futures[future]] = future.result()
+            logger.info(f"Converted {result['source']}: {result['error'] or result['rows']}")
+    return results
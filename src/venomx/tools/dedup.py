@@ -0,0 +1,377 @@
+"""Near-duplicate embeddings, found with random hyperplane LSH (SimHash) signatures."""
+
+import logging
+import math
+from typing import Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import venomx as vx
+from venomx.model.objects_pa import ID, METADATA, ObjectTable
+from venomx.tools.constants import DEFAULT_BAND_BITS, DEFAULT_DEDUP_THRESHOLD, DEFAULT_SIMHASH_BITS, LoadMode
+from venomx.tools.file_io import _frame, embeddings_matrix
+from venomx.tools.profiling import count, phase, profiled
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_OF = "duplicate_of"
+SCORE = "score"
+DUPLICATES_SCHEMA = pa.schema([(ID, pa.string()), (DUPLICATE_OF, pa.string()), (SCORE, pa.float32())])
+
+# metadata entry of a kept object for each id merged into it, e.g. "alias:HP:0000002"
+ALIAS_PREFIX = "alias:"
+
+BAND_DTYPES = {8: np.uint8, 16: np.uint16, 32: np.uint32, 64: np.uint64}
+SIGNATURE_BATCH_SIZE = 65536
+VERIFY_BATCH_SIZE = 65536
+# buckets with more rows than this are compared block by block, rather than pair by pair
+MAX_PAIRWISE_BUCKET = 64
+# similarities computed at a time in a large bucket
+MAX_BLOCK_CELLS = 2**22
+
+
+def hyperplanes(dimensions: int, num_bits: int = DEFAULT_SIMHASH_BITS, seed: int = 0) -> np.ndarray:
+    """
+    Draw the random hyperplanes of SimHash signatures.
+
+    :param dimensions: dimensions of the embeddings
+    :param num_bits: number of hyperplanes, one per signature bit
+    :param seed:
+    :return: (D, num_bits) float32 matrix of hyperplane normals
+    """
+    return np.random.default_rng(seed).standard_normal((dimensions, num_bits), dtype=np.float32)
+
+
+def simhash(matrix: np.ndarray, planes: np.ndarray, batch_size: int = SIGNATURE_BATCH_SIZE) -> np.ndarray:
+    """
+    Compute the SimHash signatures of vectors: one bit per hyperplane, set if the vector is on its positive side.
+
+    Two vectors at an angle theta differ in each bit with probability theta / pi; the
+    signature of a vector does not depend on its norm.
+
+    >>> planes = hyperplanes(2, 64)
+    >>> signatures = simhash(np.array([[1.0, 0.0], [3.0, 0.0], [0.0, 1.0]]), planes)
+    >>> signatures.shape, bool((signatures[0] == signatures[1]).all()), bool((signatures[0] == signatures[2]).all())
+    ((3, 8), True, False)
+
+    :param matrix: (N, D) matrix
+    :param planes: (D, B) hyperplanes (see :func:`hyperplanes`)
+    :param batch_size: rows per matrix product
+    :return: (N, B / 8) uint8 matrix of packed bits
+    """
+    signatures = np.empty((len(matrix), planes.shape[1] // 8), dtype=np.uint8)
+    for start in range(0, len(matrix), batch_size):
+        batch = np.asarray(matrix[start : start + batch_size], dtype=np.float32)
+        signatures[start : start + len(batch)] = np.packbits(batch @ planes > 0, axis=1)
+    return signatures
+
+
+def candidate_probability(cosine: float, num_bits: int = DEFAULT_SIMHASH_BITS, band_bits: int = DEFAULT_BAND_BITS):
+    """
+    Get the probability that two vectors with a cosine similarity are compared, i.e. share at least one band.
+
+    >>> round(candidate_probability(0.99), 3), round(candidate_probability(0.5), 6)
+    (0.984, 3.7e-05)
+
+    :param cosine: cosine similarity of the vectors
+    :param num_bits: signature bits
+    :param band_bits: bits per band
+    :return:
+    """
+    agree = 1 - math.acos(max(-1.0, min(1.0, cosine))) / math.pi
+    return 1 - (1 - agree**band_bits) ** (num_bits // band_bits)
+
+
+def _band_keys(signatures: np.ndarray, band: int, band_bits: int) -> np.ndarray:
+    width = band_bits // 8
+    return np.ascontiguousarray(signatures[:, band * width : (band + 1) * width]).view(BAND_DTYPES[band_bits]).ravel()
+
+
+def _buckets(keys: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Group rows by key.
+
+    :param keys: (N,) keys
+    :param rows: (N,) rows
+    :return: tuple of rows sorted by key, and the start and size of each bucket of more than one row
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(keys)])
+    shared = sizes > 1
+    return rows[order], starts[shared], sizes[shared]
+
+
+def _bucket_pairs(members: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # all the pairs of the buckets of each size at once
+    left, right = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for size in np.unique(sizes):
+        rows = members[starts[sizes == size][:, None] + np.arange(size)]
+        i, j = np.triu_indices(size, 1)
+        left.append(rows[:, i].ravel())
+        right.append(rows[:, j].ravel())
+    return np.concatenate(left), np.concatenate(right)
+
+
+def _find(labels: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+    # the roots of nodes in a union-find forest whose parents are lower nodes
+    roots = labels[nodes]
+    while True:
+        parents = labels[roots]
+        if np.array_equal(parents, roots):
+            labels[nodes] = roots
+            return roots
+        roots = parents
+
+
+def _union(labels: np.ndarray, left: np.ndarray, right: np.ndarray):
+    """
+    Merge the trees of the ends of edges, in place; each root is the lowest node of its tree.
+
+    :param labels: (N,) parent of each node
+    :param left: (E,) first node of each edge
+    :param right: (E,) second node of each edge
+    :return:
+    """
+    while True:
+        left_roots, right_roots = _find(labels, left), _find(labels, right)
+        if np.array_equal(left_roots, right_roots):
+            return
+        # hook the root of each end of an edge to the lower root
+        lowest = np.minimum(left_roots, right_roots)
+        np.minimum.at(labels, left_roots, lowest)
+        np.minimum.at(labels, right_roots, lowest)
+
+
+def _link_similar(matrix: np.ndarray, norms: np.ndarray, rows: np.ndarray, threshold: float, labels: np.ndarray):
+    """
+    Merge the rows of a large bucket (e.g. many copies of one vector) whose cosine is at least a threshold.
+
+    The bucket is compared a block of rows at a time against all its rows. Rather than
+    listing the similar pairs (quadratic in the bucket size), each row is linked to the
+    lowest group among the rows it is similar to, and each column to the lowest group
+    among the block rows it is similar to, until the groups agree with all the pairs.
+    Once all the rows are in one group, the remaining blocks are skipped.
+
+    :param matrix: (N, D) matrix
+    :param norms: (N,) norms of its rows
+    :param rows: rows of the bucket
+    :param threshold: minimum cosine similarity
+    :param labels: (N,) union-find parents, updated in place
+    :return:
+    """
+    vectors = matrix[rows] / norms[rows, None]
+    block_size = max(1, min(MAX_PAIRWISE_BUCKET, MAX_BLOCK_CELLS // len(rows)))
+    for start in range(0, len(rows), block_size):
+        groups = _find(labels, rows)
+        if (groups == groups[0]).all():
+            return
+        similar = vectors[start : start + block_size] @ vectors.T >= threshold
+        while True:
+            block_groups = groups[start : start + block_size]
+            if not (similar & (block_groups[:, None] != groups[None, :])).any():
+                break
+            row_lowest = np.where(similar, groups[None, :], len(matrix)).min(axis=1)
+            column_lowest = np.where(similar, block_groups[:, None], len(matrix)).min(axis=0)
+            block_rows, columns = rows[start : start + block_size], np.flatnonzero(column_lowest < len(matrix))
+            _union(
+                labels,
+                np.concatenate([block_rows[row_lowest < len(matrix)], rows[columns]]),
+                np.concatenate([row_lowest[row_lowest < len(matrix)], column_lowest[columns]]),
+            )
+            groups = _find(labels, rows)
+
+
+def _cosines(matrix: np.ndarray, norms: np.ndarray, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    scores = np.empty(len(left), dtype=np.float32)
+    for start in range(0, len(left), VERIFY_BATCH_SIZE):
+        i, j = left[start : start + VERIFY_BATCH_SIZE], right[start : start + VERIFY_BATCH_SIZE]
+        scores[start : start + len(i)] = np.einsum("ij,ij->i", matrix[i], matrix[j]) / (norms[i] * norms[j])
+    return scores
+
+
+def connected_components(n: int, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    Label the connected components of a graph, by union-find with vectorized hooking and path compression.
+
+    >>> connected_components(5, np.array([3, 1]), np.array([4, 3])).tolist()
+    [0, 1, 2, 1, 1]
+
+    :param n: number of nodes
+    :param left: (E,) first node of each edge
+    :param right: (E,) second node of each edge
+    :return: (n,) lowest node of the component of each node
+    """
+    labels = np.arange(n)
+    _union(labels, left, right)
+    return _find(labels, np.arange(n))
+
+
+@profiled("dedup")
+def duplicate_labels(
+    matrix: np.ndarray,
+    threshold: float = DEFAULT_DEDUP_THRESHOLD,
+    num_bits: int = DEFAULT_SIMHASH_BITS,
+    band_bits: int = DEFAULT_BAND_BITS,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Group the rows of a matrix whose cosine similarity is at least a threshold.
+
+    Signatures of ``num_bits`` random hyperplanes are split into bands of ``band_bits``;
+    only rows that share a band are compared, and their exact cosine checked, so the
+    cost is about linear in the number of rows rather than quadratic. A pair of rows is
+    compared with probability :func:`candidate_probability`, so a few pairs above the
+    threshold can be missed. Groups are connected components of the similar pairs, so
+    their rows can be linked through each other.
+
+    >>> matrix = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.999, 0.01, 0.0], [2.0, 0.0, 0.0]])
+    >>> duplicate_labels(matrix).tolist()
+    [0, 1, 0, 0]
+
+    :param matrix: (N, D) matrix
+    :param threshold: minimum cosine similarity of duplicates
+    :param num_bits: signature bits; more bits find more of the duplicates
+    :param band_bits: bits per band (8, 16, 32 or 64); more bits compare fewer dissimilar rows
+    :param seed: seed of the hyperplanes
+    :return: (N,) first row of the group of each row; rows without duplicates are their own group
+    """
+    if band_bits not in BAND_DTYPES or num_bits % band_bits:
+        raise ValueError(f"Band bits must be one of {sorted(BAND_DTYPES)}, and divide {num_bits}")
+    norms = np.linalg.norm(matrix, axis=1)
+    # zero vectors have no direction, and no duplicates
+    rows = np.flatnonzero(norms > 0)
+    with phase("simhash", rows=len(rows)):
+        signatures = simhash(matrix[rows], hyperplanes(matrix.shape[1], num_bits, seed))
+    # union-find forest of the groups found so far
+    labels = np.arange(len(matrix))
+    candidates, large = [], 0
+    with phase("candidates"):
+        for band in range(num_bits // band_bits):
+            members, starts, sizes = _buckets(_band_keys(signatures, band, band_bits), rows)
+            pairwise = sizes <= MAX_PAIRWISE_BUCKET
+            candidates.append(_bucket_pairs(members, starts[pairwise], sizes[pairwise]))
+            for start, size in zip(starts[~pairwise], sizes[~pairwise], strict=True):
+                # a bucket collapsed into one group in an earlier band returns straight away
+                _link_similar(matrix, norms, members[start : start + size], threshold, labels)
+                large += 1
+        left = np.concatenate([pair[0] for pair in candidates])
+        right = np.concatenate([pair[1] for pair in candidates])
+        # a pair of rows can share several bands
+        codes = np.unique(np.minimum(left, right) * len(matrix) + np.maximum(left, right))
+        left, right = codes // len(matrix), codes % len(matrix)
+    logger.info(f"{len(codes)} candidate pairs, {large} large buckets")
+    with phase("verify", rows=len(codes)):
+        keep = _cosines(matrix, norms, left, right) >= threshold
+    count(rows=int(keep.sum()))
+    _union(labels, left[keep], right[keep])
+    return _find(labels, np.arange(len(matrix)))
+
+
+def _duplicates_table(ids: np.ndarray, matrix: np.ndarray, labels: np.ndarray) -> pa.Table:
+    duplicates = np.flatnonzero(labels != np.arange(len(labels)))
+    # grouped by the kept row
+    duplicates = duplicates[np.argsort(labels[duplicates], kind="stable")]
+    kept = labels[duplicates]
+    norms = np.linalg.norm(matrix, axis=1)
+    scores = _cosines(matrix, norms, duplicates, kept)
+    return pa.Table.from_arrays(
+        [pa.array(ids[duplicates], type=pa.string()), pa.array(ids[kept], type=pa.string()), pa.array(scores)],
+        schema=DUPLICATES_SCHEMA,
+    )
+
+
+def find_duplicates(ix: vx.Index, **kwargs) -> pa.Table:
+    """
+    Find the near-duplicate embeddings of an index.
+
+    Each group of duplicates is represented by its first row; the other rows are
+    listed with the id of that row, and their cosine similarity to it.
+
+    >>> ix = vx.Index()
+    >>> ix.embeddings_frame = {"id": np.array(["A", "B", "C"]), "values": np.array([[1.0, 0], [0, 1.0], [1.0, 0]])}
+    >>> find_duplicates(ix).to_pylist()
+    [{'id': 'C', 'duplicate_of': 'A', 'score': 1.0}]
+
+    :param ix:
+    :param kwargs: passed to duplicate_labels (threshold, num_bits, band_bits, seed)
+    :return: table of id, duplicate_of, score, one row per duplicate
+    """
+    ids, matrix = embeddings_matrix(ix)
+    return _duplicates_table(ids, matrix, duplicate_labels(matrix, **kwargs))
+
+
+def _alias_objects(ix: vx.Index, kept_ids: np.ndarray, duplicates: pa.Table) -> ObjectTable:
+    """
+    Drop the objects of duplicates, and record their ids in the metadata of the objects they duplicate.
+
+    An index without objects gets one object per kept embedding.
+
+    :param ix:
+    :param kept_ids: ids of the kept embeddings
+    :param duplicates: table of id, duplicate_of (see :func:`find_duplicates`)
+    :return:
+    """
+    objects = ix.objects if isinstance(ix.objects, ObjectTable) else ObjectTable.from_objects(ix.objects or [])
+    kept = pa.array(kept_ids, type=pa.string())
+    table = objects.table if len(objects) else ObjectTable(pa.table({ID: kept})).table
+    removed = duplicates.column(ID).combine_chunks()
+    kept_of = duplicates.column(DUPLICATE_OF).combine_chunks()
+    # an id can be both removed and kept, if the index repeats it
+    dropped = pc.and_(pc.is_in(table.column(ID), removed), pc.invert(pc.is_in(table.column(ID), kept)))
+    table = table.filter(pc.invert(dropped))
+    missing = pc.unique(kept_of.filter(pc.invert(pc.is_in(kept_of, table.column(ID)))))
+    if len(missing):
+        table = pa.concat_tables([table, ObjectTable(pa.table({ID: missing})).table])
+    column = table.column(METADATA).combine_chunks()
+    parents = np.concatenate(
+        [
+            pc.list_parent_indices(column).to_numpy(),
+            pc.index_in(kept_of, value_set=table.column(ID)).to_numpy(),
+        ]
+    )
+    aliases = pa.array([ALIAS_PREFIX + x for x in removed.to_pylist()], type=pa.string())
+    values = pa.concat_arrays([pc.list_flatten(column), aliases])
+    offsets = np.zeros(len(table) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(parents, minlength=len(table)), out=offsets[1:])
+    metadata = pa.ListArray.from_arrays(pa.array(offsets), values.take(pa.array(np.argsort(parents, kind="stable"))))
+    return ObjectTable(table.set_column(table.schema.get_field_index(METADATA), METADATA, metadata))
+
+
+def deduplicate(ix: vx.Index, **kwargs) -> Tuple[vx.Index, pa.Table]:
+    """
+    Remove the near-duplicate embeddings of an index, keeping the first row of each group.
+
+    The objects of removed embeddings are dropped too; the object of each kept embedding
+    lists the ids merged into it as ``alias:<id>`` metadata.
+
+    >>> ix = vx.Index(objects=[{"id": "A", "label": "a"}, {"id": "B"}, {"id": "C", "label": "a"}])
+    >>> ix.embeddings_frame = {"id": np.array(["A", "B", "C"]), "values": np.array([[1.0, 0], [0, 1.0], [1.0, 0]])}
+    >>> deduped, duplicates = deduplicate(ix)
+    >>> deduped.embeddings_frame["id"].tolist(), deduped.objects[0]
+    (['A', 'B'], NamedObject(id='A', label='a', metadata=['alias:C']))
+
+    :param ix:
+    :param kwargs: passed to duplicate_labels (threshold, num_bits, band_bits, seed)
+    :return: tuple of the deduplicated index, and the duplicates removed (see :func:`find_duplicates`)
+    """
+    ids, matrix = embeddings_matrix(ix)
+    labels = duplicate_labels(matrix, **kwargs)
+    duplicates = _duplicates_table(ids, matrix, labels)
+    kept = labels == np.arange(len(labels))
+    # the checksums, shards and segments describe the files of the whole index
+    deduped = ix.model_copy(
+        update={
+            "objects": _alias_objects(ix, ids[kept], duplicates),
+            "embeddings_frame": _frame(LoadMode.NUMPY, ids[kept], matrix[kept]),
+            "embeddings_count": int(kept.sum()),
+            "md5": None,
+            "chunk_md5s": [],
+            "shards": [],
+            "segments": [],
+        }
+    )
+    return deduped, duplicates
@@ -0,0 +1,387 @@
+"""Incremental updates of an index: delta segments and tombstones, and compaction."""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import venomx as vx
+from venomx.model.embeddings_pa import ID
+from venomx.model.objects_pa import ObjectTable
+from venomx.model.venomx import Segment
+from venomx.tools.file_io import (
+    SUFFIX_MAP,
+    EmbeddingFormat,
+    LoadMode,
+    _embeddings_paths,
+    _index_from_metadata,
+    _load_metadata,
+    _write_metadata,
+    _write_shard,
+    embeddings_file_tuple,
+    load_index,
+    read_embeddings_table,
+    save_index,
+)
+from venomx.tools.quantization import ScalarQuantizer, StorageDtype
+
+logger = logging.getLogger(__name__)
+
+
+def segment_path(metadata_path: Union[str, Path], generation: int, format: EmbeddingFormat) -> Path:
+    """
+    Get the path of a delta segment of an index.
+
+    >>> str(segment_path("tests/output/test.vx.yaml", 3, EmbeddingFormat.PARQUET))
+    'tests/output/test.vx.delta-00003.parquet'
+
+    :param metadata_path: path to the metadata yaml
+    :param generation: segment number, starting at 1
+    :param format: PARQUET or ARROW
+    :return:
+    """
+    path = Path(metadata_path)
+    return path.with_name(f"{path.stem}.delta-{generation:05d}{SUFFIX_MAP[format]}")
+
+
+def segment_files(ix: vx.Index, metadata_path: Union[str, Path]) -> List[Tuple[Path, int]]:
+    """
+    Get the embeddings files of the segments of an index, with their generations.
+
+    :param ix: index whose metadata lists the segments
+    :param metadata_path: path to the metadata yaml
+    :return: list of (path, generation), generations starting at 1
+    """
+    parent = Path(metadata_path).parent
+    return [(parent / s.path, g) for g, s in enumerate(ix.segments or [], start=1) if s.path]
+
+
+def live_row_masks(
+    id_arrays: List[pa.Array], generations: List[int], tombstones: Dict[int, List[str]]
+) -> List[np.ndarray]:
+    """
+    Resolve which rows of a base and its segments are live.
+
+    A row of generation g (0 for the base, i for the i-th segment) is live unless
+    a later generation has a row with the same id, or a tombstone for it.
+    Ids are dictionary encoded by arrow, so this is vectorized over all rows.
+
+    >>> masks = live_row_masks([pa.array(["A", "B", "C"]), pa.array(["B"])], [0, 1], {2: ["C"]})
+    >>> [m.tolist() for m in masks]
+    [[True, False, False], [True]]
+
+    :param id_arrays: ids of each file
+    :param generations: generation of each file
+    :param tombstones: deleted ids, by generation of the segment that deleted them
+    :return: boolean mask of live rows, for each file
+    """
+    lengths = [len(a) for a in id_arrays]
+    chunks = [a.cast(pa.string()) for a in id_arrays]
+    encoded = pa.chunked_array(chunks, type=pa.string()).combine_chunks().dictionary_encode()
+    codes = encoded.indices.to_numpy(zero_copy_only=False)
+    row_generations = np.repeat(np.asarray(generations, dtype=np.int64), lengths)
+    latest = np.full(len(encoded.dictionary), -1, dtype=np.int64)
+    np.maximum.at(latest, codes, row_generations)
+    deleted = np.full(len(encoded.dictionary), -1, dtype=np.int64)
+    for generation, ids in tombstones.items():
+        found = pc.index_in(pa.array(ids, type=pa.string()), value_set=encoded.dictionary)
+        found = found.fill_null(-1).to_numpy(zero_copy_only=False)
+        np.maximum.at(deleted, found[found >= 0], generation)
+    live = (row_generations == latest[codes]) & (row_generations >= deleted[codes])
+    return np.split(live, np.cumsum(lengths)[:-1])
+
+
+def segments_md5(md5: Optional[str], segments: Iterable[dict]) -> Optional[str]:
+    """
+    Fold the delta segments of an index into the md5 of its embeddings files.
+
+    The md5 of an index with segments is that of its embeddings files (as written by
+    :func:`save_index`), chained with the md5 and tombstones of each segment in order,
+    so that it changes with every segment.
+
+    >>> segments_md5("d41d8cd98f00b204e9800998ecf8427e", [])
+    'd41d8cd98f00b204e9800998ecf8427e'
+    >>> segments_md5("d41d8cd98f00b204e9800998ecf8427e", [{"count": 0, "tombstones": ["A"]}])
+    '41384e589b8a6a8de1dce5b6b98924fd'
+
+    :param md5: md5 of the embeddings files, or None if not recorded
+    :param segments: segments of the metadata, in generation order
+    :return: None if md5 is None
+    """
+    for segment in segments:
+        if md5 is None:
+            return None
+        chained = json.dumps([md5, segment.get("md5"), segment.get("tombstones") or []])
+        md5 = hashlib.md5(chained.encode("utf-8"), usedforsecurity=False).hexdigest()
+    return md5
+
+
+def _tombstones(ix: vx.Index) -> Dict[int, List[str]]:
+    return {g: s.tombstones for g, s in enumerate(ix.segments or [], start=1) if s.tombstones}
+
+
+def _read_ids(path: Path, format: EmbeddingFormat) -> pa.Array:
+    return read_embeddings_table(path, format, columns=[ID]).column(ID).combine_chunks()
+
+
+def live_file_masks(
+    ix: vx.Index, metadata_path: Union[str, Path], format: EmbeddingFormat, workers: Optional[int] = None
+) -> List[Tuple[Path, np.ndarray]]:
+    """
+    Get the embeddings files of an index with segments, and the mask of live rows of each.
+
+    Only the id columns are read, with a thread pool.
+
+    :param ix: index built from the metadata
+    :param metadata_path: path to the metadata yaml
+    :param format: PARQUET or ARROW
+    :param workers: number of threads, default number of CPUs
+    :return: list of (path, mask), base files first
+    """
+    return [(path, mask) for path, _, mask in _live_files(ix, metadata_path, format, workers)]
+
+
+def _live_files(
+    ix: vx.Index, metadata_path: Union[str, Path], format: EmbeddingFormat, workers: Optional[int] = None
+) -> List[Tuple[Path, pa.Array, np.ndarray]]:
+    files = [(path, 0) for path in _embeddings_paths(ix, Path(metadata_path), _base_file(metadata_path, format))]
+    files += segment_files(ix, metadata_path)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        id_arrays = list(pool.map(lambda f: _read_ids(f[0], format), files))
+    masks = live_row_masks(id_arrays, [g for _, g in files], _tombstones(ix))
+    return [(path, ids, mask) for (path, _), ids, mask in zip(files, id_arrays, masks, strict=True)]
+
+
+def apply_segments(
+    ix: vx.Index,
+    metadata_path: Union[str, Path],
+    format: EmbeddingFormat,
+    ids: np.ndarray,
+    matrix: np.ndarray,
+    load_file,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Apply the segments of an index to its loaded base rows.
+
+    :param ix: index built from the metadata
+    :param metadata_path: path to the metadata yaml
+    :param format: PARQUET or ARROW
+    :param ids: ids of the base
+    :param matrix: matrix of the base, in the stored dtype
+    :param load_file: function loading the (ids, matrix) of an embeddings file
+    :return: tuple of live ids, matrix
+    """
+    files = segment_files(ix, metadata_path)
+    parts = [(ids, matrix)] + [load_file(path) for path, _ in files]
+    masks = live_row_masks(
+        [pa.array(p[0], type=pa.string()) for p in parts], [0] + [g for _, g in files], _tombstones(ix)
+    )
+    parts = [(p[0][m], p[1][m]) for p, m in zip(parts, masks, strict=True)]
+    return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+
+def _base_file(metadata_path: Union[str, Path], format: EmbeddingFormat) -> Optional[Path]:
+    _, embeddings, _ = embeddings_file_tuple(metadata_path, format, exists_check=False)
+    return embeddings if embeddings.exists() else None
+
+
+def _open_metadata(target: Union[str, Path], format: EmbeddingFormat) -> Tuple[Path, dict, vx.Index]:
+    format = EmbeddingFormat(format)
+    if format not in SUFFIX_MAP:
+        raise ValueError(f"Incremental updates are not supported for {format}")
+    metadata_path, _, _ = embeddings_file_tuple(target, format, allow_bundled=True)
+    metadata_obj = _load_metadata(metadata_path, format)
+    metadata_obj.pop("embeddings", None)
+    return metadata_path, metadata_obj, _index_from_metadata(metadata_obj, metadata_path)
+
+
+def _live_ids(ix: vx.Index, metadata_path: Path, format: EmbeddingFormat) -> pa.Array:
+    parts = [ids.filter(pa.array(mask)) for _, ids, mask in _live_files(ix, metadata_path, format)]
+    return pa.chunked_array(parts, type=pa.string()).combine_chunks()
+
+
+def _merge_objects(
+    metadata_obj: dict, metadata_path: Path, objects: Optional[List[vx.NamedObject]], removed: Iterable[str]
+):
+    removed = set(removed) | {obj.id for obj in objects or []}
+    if not removed:
+        return
+    if metadata_obj.get("objects_path"):
+        # the objects table is rewritten; it is small next to the embeddings
+        path = metadata_path.parent / metadata_obj["objects_path"]
+        table = ObjectTable.read(path)
+        kept = table.filter(pc.invert(pc.is_in(table.ids, value_set=pa.array(list(removed), type=pa.string()))))
+        added = ObjectTable.from_objects(objects or [])
+        ObjectTable(pa.concat_tables([kept.table, added.table])).write(path)
+        return
+    kept = [obj for obj in metadata_obj.get("objects") or [] if obj.get("id") not in removed]
+    metadata_obj["objects"] = kept + [obj.model_dump(exclude_unset=True) for obj in objects or []]
+
+
+def _add_segment(
+    target: Union[str, Path],
+    format: EmbeddingFormat,
+    ids: Optional[Iterable[str]] = None,
+    values: Optional[np.ndarray] = None,
+    deleted: Optional[Iterable[str]] = None,
+    objects: Optional[List[vx.NamedObject]] = None,
+    replace=True,
+) -> Segment:
+    """
+    Record a delta segment in the metadata of an index, writing its rows to a new embeddings file.
+
+    :return: the new segment
+    """
+    format = EmbeddingFormat(format)
+    metadata_path, metadata_obj, ix = _open_metadata(target, format)
+    live = _live_ids(ix, metadata_path, format)
+    ids = pa.array([] if ids is None else list(ids), type=pa.string())
+    if pc.count_distinct(ids).as_py() != len(ids):
+        raise ValueError("Delta has duplicate ids")
+    existing = ids.filter(pc.is_in(ids, value_set=live))
+    if len(existing) and not replace:
+        raise ValueError(f"Already in index: {existing.to_pylist()[:10]}")
+    deleted = pa.array([] if deleted is None else list(deleted), type=pa.string())
+    deleted = deleted.filter(pc.is_in(deleted, value_set=live))
+    generation = len(ix.segments or []) + 1
+    segment = {"count": len(ids)}
+    if len(deleted):
+        segment["tombstones"] = deleted.to_pylist()
+    if len(ids):
+        matrix = np.asarray(values, dtype=np.float32)
+        if ix.embeddings_dimensions is not None and matrix.shape[1] != ix.embeddings_dimensions:
+            raise ValueError(f"Delta dimensions {matrix.shape[1]} != index dimensions {ix.embeddings_dimensions}")
+        shard, _ = _write_shard(
+            segment_path(metadata_path, generation, format),
+            format,
+            ids.to_numpy(zero_copy_only=False),
+            matrix,
+            dtype=StorageDtype(ix.embeddings_dtype or StorageDtype.FLOAT32),
+            quantizer=ScalarQuantizer.from_index(ix),
+        )
+        segment.update({"path": shard["path"], "md5": shard["md5"]})
+    metadata_obj["segments"] = [s.model_dump(exclude_unset=True) for s in ix.segments or []] + [segment]
+    metadata_obj["md5"] = segments_md5(metadata_obj.get("md5"), [segment])
+    metadata_obj["embeddings_count"] = len(live) - len(existing) - len(deleted) + len(ids)
+    _merge_objects(metadata_obj, metadata_path, objects, deleted.to_pylist())
+    _write_metadata(metadata_obj, metadata_path)
+    logger.info(f"Added segment {generation} to {metadata_path}: {len(ids)} rows, {len(deleted)} deleted")
+    return Segment(**segment)
+
+
+def append(
+    target: Union[str, Path],
+    ids: Iterable[str],
+    values: np.ndarray,
+    objects: Optional[List[vx.NamedObject]] = None,
+    format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+) -> Segment:
+    """
+    Append embeddings for new ids to an index, as a delta segment.
+
+    Only the new rows are written, and the id columns of the index read.
+
+    >>> ix = vx.Index()
+    >>> ix.embeddings_frame = {"id": np.array(["A", "B"]), "values": np.eye(2)}
+    >>> save_index(ix, "tests/output/appended.vx.yaml")
+    >>> _ = append("tests/output/appended.vx.yaml", ["C"], np.ones((1, 2)))
+    >>> load_index("tests/output/appended.vx.yaml", mode=LoadMode.NUMPY).embeddings_frame["id"].tolist()
+    ['A', 'B', 'C']
+
+    :param target: path to the metadata yaml
+    :param ids: (N,) new ids; it is an error if any is already in the index
+    :param values: (N, D) matrix
+    :param objects: named objects to add to the metadata
+    :param format: PARQUET or ARROW
+    :return: the new segment
+    """
+    return _add_segment(target, format, ids, values, objects=objects, replace=False)
+
+
+def upsert(
+    target: Union[str, Path],
+    ids: Iterable[str],
+    values: np.ndarray,
+    objects: Optional[List[vx.NamedObject]] = None,
+    format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+) -> Segment:
+    """
+    Add or replace embeddings in an index, as a delta segment.
+
+    :param target: path to the metadata yaml
+    :param ids: (N,) ids; rows already in the index are replaced
+    :param values: (N, D) matrix
+    :param objects: named objects to add to (or replace in) the metadata
+    :param format: PARQUET or ARROW
+    :return: the new segment
+    """
+    return _add_segment(target, format, ids, values, objects=objects, replace=True)
+
+
+def delete(target: Union[str, Path], ids: Iterable[str], format: EmbeddingFormat = EmbeddingFormat.PARQUET) -> Segment:
+    """
+    Delete embeddings (and their named objects) from an index, as tombstones.
+
+    Ids that are not in the index are ignored.
+
+    :param target: path to the metadata yaml
+    :param ids: ids to delete
+    :param format: PARQUET or ARROW
+    :return: the new segment
+    """
+    return _add_segment(target, format, deleted=ids)
+
+
+def compact(
+    target: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.PARQUET, workers: Optional[int] = None
+) -> vx.Index:
+    """
+    Fold the segments of an index back into its embeddings, and remove the segment files.
+
+    The index keeps its number of shards and storage dtype, and gets the md5s of the
+    rewritten files. Int8 indexes keep their quantizer, so the codes of the rows are
+    written back unchanged rather than quantized again. These are written to a temporary directory and moved over the old
+    files, the metadata last, so that a failed write leaves the index as it was, and the
+    metadata never refers to partly written files.
+
+    :param target: path to the metadata yaml
+    :param format: PARQUET or ARROW
+    :param workers: number of threads reading and writing shards
+    :return: the compacted index
+    """
+    format = EmbeddingFormat(format)
+    metadata_path, _, _ = _open_metadata(target, format)
+    ix = load_index(metadata_path, format=format, mode=LoadMode.NUMPY, check=False, workers=workers)
+    old_files = {path for path, _ in live_file_masks(ix, metadata_path, format, workers)}
+    num_shards = len(ix.shards or []) or None
+    dtype = StorageDtype(ix.embeddings_dtype or StorageDtype.FLOAT32)
+    ix.segments = []
+    ix.shards = []
+    with tempfile.TemporaryDirectory(prefix=".compact-", dir=metadata_path.parent) as staging:
+        staged = Path(staging) / metadata_path.name
+        save_index(
+            ix,
+            staged,
+            format=format,
+            dtype=dtype,
+            num_shards=num_shards,
+            workers=workers,
+            quantizer=ScalarQuantizer.from_index(ix),
+        )
+        new_files = []
+        for path in Path(staging).iterdir():
+            if path != staged:
+                new_files.append(metadata_path.parent / path.name)
+                os.replace(path, new_files[-1])
+        os.replace(staged, metadata_path)
+    for path in old_files - set(new_files):
+        path.unlink(missing_ok=True)
+    return ix
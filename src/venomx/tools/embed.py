@@ -0,0 +1,373 @@
+"""Generation of embeddings for the named objects of an index, with batching, caching and concurrency."""
+
+import hashlib
+import logging
+import re
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import venomx as vx
+from venomx.model.embeddings_pa import VALUES
+from venomx.model.venomx import Model, ModelInputMethod
+from venomx.tools.constants import DEFAULT_EMBED_BATCH_SIZE, DEFAULT_MAX_IN_FLIGHT
+from venomx.tools.file_io import list_array_to_matrix
+from venomx.tools.id_map import hash_ids
+from venomx.tools.search import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FIELDS = ["label"]
+FIELD_SEPARATOR = "; "
+DEFAULT_BATCH_SIZE = DEFAULT_EMBED_BATCH_SIZE
+HASH = "hash"
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def input_text(obj: vx.NamedObject, method: Optional[ModelInputMethod] = None) -> str:
+    """
+    Build the input text for the embedding model from the fields of a named object.
+
+    Fields are taken in the order given by the input method (default the label), skipping
+    empty ones; list fields contribute each of their values. An object with none of the
+    fields is embedded by its id.
+
+    >>> obj = vx.NamedObject(id="HP:1", label="Abnormal heart", metadata=["cardiac"])
+    >>> input_text(obj, ModelInputMethod(fields=["label", "metadata"]))
+    'Abnormal heart; cardiac'
+    >>> input_text(vx.NamedObject(id="HP:2"))
+    'HP:2'
+
+    :param obj:
+    :param method: input method, whose fields are names of NamedObject fields
+    :return:
+    """
+    fields = method.fields if method is not None and method.fields else DEFAULT_FIELDS
+    parts = []
+    for field in fields:
+        if field not in type(obj).model_fields:
+            raise ValueError(f"Unknown named object field: {field}")
+        value = getattr(obj, field)
+        if isinstance(value, list):
+            parts.extend(str(v) for v in value if v)
+        elif value:
+            parts.append(str(value))
+    return FIELD_SEPARATOR.join(parts) if parts else obj.id
+
+
+def text_hash(text: str) -> str:
+    """
+    Get the cache key of an input text.
+
+    >>> text_hash("heart")
+    '3189934774aa880fa7fbf8da8f9e446d'
+
+    :param text:
+    :return: md5 hex digest of the utf-8 text
+    """
+    return hashlib.md5(text.encode("utf-8"), usedforsecurity=False).hexdigest()
+
+
+class Encoder(ABC):
+    """
+    A backend that embeds batches of texts.
+
+    Subclasses set ``model``, which is recorded in the index and keys the cache, and
+    ``dimensions``. ``encode`` may be called from several threads at once.
+    """
+
+    model: Model
+    dimensions: int
+
+    @abstractmethod
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed a batch of texts.
+
+        :param texts:
+        :return: (N, D) matrix
+        """
+
+
+class HashingEncoder(Encoder):
+    """
+    A local, deterministic stand-in for an embedding model.
+
+    Each lowercased word is hashed to a dimension and a sign (feature hashing), and the
+    rows are L2-normalized, so texts sharing words get similar embeddings.
+
+    >>> m = HashingEncoder(dimensions=16).encode(["abnormal heart", "Heart, abnormal"])
+    >>> m.shape, bool(np.allclose(m[0], m[1]))
+    ((2, 16), True)
+    """
+
+    def __init__(self, dimensions: int = 256):
+        """
+        Create an encoder.
+
+        :param dimensions: number of dimensions of the embeddings
+        """
+        self.dimensions = dimensions
+        self.model = Model(name=f"hashing-{dimensions}", source="venomx")
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed a batch of texts.
+
+        :param texts:
+        :return: (N, D) float32 matrix
+        """
+        tokens = [TOKEN_PATTERN.findall(text.lower()) for text in texts]
+        counts = [len(t) for t in tokens]
+        hashes = hash_ids([token for t in tokens for token in t])
+        columns = (hashes % np.uint64(self.dimensions)).astype(np.int64)
+        signs = np.where(hashes >> np.uint64(63), -1.0, 1.0).astype(np.float32)
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        np.add.at(matrix, (np.repeat(np.arange(len(texts)), counts), columns), signs)
+        return normalize_rows(matrix)
+
+
+ENCODERS: Dict[str, Callable[..., Encoder]] = {"hashing": HashingEncoder}
+
+
+def register_encoder(name: str, factory: Callable[..., Encoder]):
+    """
+    Register an encoder backend, e.g. a client for a hosted embedding model.
+
+    :param name: name of the backend, as used by ``venomx embed --encoder``
+    :param factory: function creating the encoder, taking keyword options such as ``dimensions``
+    :return:
+    """
+    ENCODERS[name] = factory
+
+
+def get_encoder(name: str, **kwargs) -> Encoder:
+    """
+    Create an encoder from its registered name.
+
+    :param name:
+    :param kwargs: options for the encoder
+    :return:
+    """
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown encoder: {name}; available: {sorted(ENCODERS)}")
+    return ENCODERS[name](**kwargs)
+
+
+def model_key(model: Model) -> str:
+    """
+    Get the part of the cache key identifying a model.
+
+    >>> model_key(Model(name="text-embedding-3-small", version="1"))
+    'text-embedding-3-small@1'
+
+    :param model:
+    :return:
+    """
+    key = model.name or model.url or (model.identifiers or ["unknown"])[0]
+    if model.version:
+        key += f"@{model.version}"
+    return key
+
+
+class EmbeddingCache:
+    """
+    A persistent cache of embeddings, keyed by model and input text hash.
+
+    Each model has a directory of parquet files of (hash, values) rows. New entries are
+    written as a new file, so existing files are never rewritten.
+
+    >>> cache = EmbeddingCache("tests/output/embedding_cache_doctest")
+    >>> model = Model(name="doctest")
+    >>> cache.add(model, [text_hash("heart")], np.ones((1, 2)))
+    >>> found, matrix = cache.lookup(model, [text_hash("kidney"), text_hash("heart")])
+    >>> found.tolist(), matrix.tolist()
+    ([False, True], [[1.0, 1.0]])
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        """
+        Open a cache.
+
+        :param directory: directory of the cache, created as needed
+        """
+        self.directory = Path(directory)
+        self._tables: Dict[str, Optional[pa.Table]] = {}
+
+    def _model_directory(self, model: Model) -> Path:
+        return self.directory / re.sub(r"[^\w.@-]+", "_", model_key(model))
+
+    def _table(self, model: Model) -> Optional[pa.Table]:
+        key = model_key(model)
+        if key not in self._tables:
+            parts = sorted(self._model_directory(model).glob("part-*.parquet"))
+            self._tables[key] = pa.concat_tables([pq.read_table(p) for p in parts]) if parts else None
+        return self._tables[key]
+
+    def lookup(self, model: Model, hashes: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up the embeddings of a batch of input text hashes.
+
+        :param model:
+        :param hashes: (N,) text hashes
+        :return: tuple of (N,) boolean mask of the hashes found, and the (F, D) float32 matrix of those found
+        """
+        hashes = pa.array(list(hashes), type=pa.string())
+        table = self._table(model)
+        if table is None:
+            return np.zeros(len(hashes), dtype=bool), np.zeros((0, 0), dtype=np.float32)
+        positions = pc.index_in(hashes, value_set=table.column(HASH)).fill_null(-1).to_numpy(zero_copy_only=False)
+        found = positions >= 0
+        matrix = list_array_to_matrix(table.column(VALUES).take(pa.array(positions[found])))
+        return found, matrix
+
+    def add(self, model: Model, hashes: Iterable[str], matrix: np.ndarray):
+        """
+        Add embeddings to the cache.
+
+        :param model:
+        :param hashes: (N,) text hashes
+        :param matrix: (N, D) matrix
+        :return:
+        """
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        values = pa.FixedSizeListArray.from_arrays(pa.array(matrix.ravel()), matrix.shape[1])
+        table = pa.table({HASH: pa.array(list(hashes), type=pa.string()), VALUES: values})
+        directory = self._model_directory(model)
+        directory.mkdir(parents=True, exist_ok=True)
+        pq.write_table(table, str(directory / f"part-{uuid.uuid4().hex}.parquet"))
+        existing = self._table(model)
+        self._tables[model_key(model)] = table if existing is None else pa.concat_tables([existing, table])
+
+
+class EmbeddingPipeline:
+    """
+    Embeds named objects with an encoder.
+
+    The input text of each object is built from its fields; texts already in the cache
+    (for the same model) are not re-embedded, and the rest are sent to the encoder in
+    batches, with at most ``max_in_flight`` batches running concurrently.
+
+    >>> pipeline = EmbeddingPipeline(HashingEncoder(dimensions=8))
+    >>> ids, matrix = pipeline.embed_objects([vx.NamedObject(id="X:1", label="heart")])
+    >>> ids.tolist(), matrix.shape
+    (['X:1'], (1, 8))
+    """
+
+    def __init__(
+        self,
+        encoder: Encoder,
+        cache: Optional[EmbeddingCache] = None,
+        input_method: Optional[ModelInputMethod] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    ):
+        """
+        Create a pipeline.
+
+        :param encoder: backend embedding the texts
+        :param cache: cache of embeddings, if any
+        :param input_method: fields to build the input texts from; default that of the index, or the label
+        :param batch_size: number of texts per encoder call
+        :param max_in_flight: maximum number of concurrent encoder calls
+        """
+        self.encoder = encoder
+        self.cache = cache
+        self.input_method = input_method
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.num_encoded = 0
+        self.num_cached = 0
+
+    def _collect(self, pending: Deque[Tuple[int, Future]], matrix: np.ndarray):
+        start, future = pending.popleft()
+        batch = np.asarray(future.result(), dtype=np.float32)
+        end = min(start + self.batch_size, len(matrix))
+        if batch.shape != (end - start, self.encoder.dimensions):
+            raise ValueError(f"Encoder returned shape {batch.shape}, expected {(end - start, self.encoder.dimensions)}")
+        matrix[start:end] = batch
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts with the encoder, bypassing the cache.
+
+        :param texts:
+        :return: (N, D) float32 matrix
+        """
+        matrix = np.empty((len(texts), self.encoder.dimensions), dtype=np.float32)
+        pending: Deque[Tuple[int, Future]] = deque()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            for start in range(0, len(texts), self.batch_size):
+                if len(pending) >= self.max_in_flight:
+                    self._collect(pending, matrix)
+                pending.append((start, pool.submit(self.encoder.encode, texts[start : start + self.batch_size])))
+                logger.debug(f"Submitted batch at {start} of {len(texts)}")
+            while pending:
+                self._collect(pending, matrix)
+        return matrix
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts, each distinct text once, using the cache if any.
+
+        :param texts:
+        :return: (N, D) float32 matrix
+        """
+        model = self.encoder.model
+        hashes = np.array([text_hash(t) for t in texts], dtype=object)
+        unique, first, inverse = np.unique(hashes.astype(str), return_index=True, return_inverse=True)
+        matrix = np.empty((len(unique), self.encoder.dimensions), dtype=np.float32)
+        found = np.zeros(len(unique), dtype=bool)
+        if self.cache is not None and len(unique):
+            found, cached = self.cache.lookup(model, unique)
+            if found.any():
+                matrix[found] = cached
+        todo = np.flatnonzero(~found)
+        if len(todo):
+            encoded = self.encode([texts[first[i]] for i in todo])
+            matrix[todo] = encoded
+            if self.cache is not None:
+                self.cache.add(model, unique[todo], encoded)
+        self.num_cached += int(found.sum())
+        self.num_encoded += len(todo)
+        logger.info(f"Embedded {len(texts)} texts with {model_key(model)}: {len(todo)} encoded, {found.sum()} cached")
+        return matrix[inverse]
+
+    def embed_objects(
+        self, objects: List[vx.NamedObject], input_method: Optional[ModelInputMethod] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Embed named objects.
+
+        :param objects:
+        :param input_method: default the input method of the pipeline
+        :return: tuple of (N,) ids and (N, D) float32 matrix
+        """
+        method = input_method or self.input_method
+        ids = np.array([obj.id for obj in objects], dtype=object)
+        return ids, self.embed_texts([input_text(obj, method) for obj in objects])
+
+    def embed_index(self, ix: vx.Index) -> vx.Index:
+        """
+        Embed the objects of an index, replacing its embeddings.
+
+        The model and input method are recorded in the index.
+
+        :param ix:
+        :return: the index
+        """
+        method = self.input_method or ix.embedding_input_method or ModelInputMethod(fields=DEFAULT_FIELDS)
+        ids, matrix = self.embed_objects(ix.objects or [], method)
+        ix.embedding_model = self.encoder.model
+        ix.embedding_input_method = method
+        ix.embeddings_frame = {"id": ids, "values": matrix}
+        ix.embeddings_dimensions = self.encoder.dimensions
+        return ix
@@ -1,29 +1,58 @@
 """Conversion utils."""
 
+from __future__ import annotations
+
+import hashlib
+import json
 import logging
-from enum import Enum
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
-import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import yaml
 
 import venomx as vx
-from venomx.model.embeddings_pa import pyarrow_schema
+from venomx.model.embeddings_pa import ID, VALUES, pyarrow_schema
+from venomx.model.objects_pa import ObjectTable
+from venomx.tools.constants import SUFFIX_MAP, EmbeddingFormat, LoadMode
+from venomx.tools.id_map import IdMap, hash_ids, id_map_path
+from venomx.tools.profiling import count, file_size, phase, profiled
+from venomx.tools.quantization import ScalarQuantizer, StorageDtype, dequantize, to_storage
+from venomx.tools.validation import ValidationReport, Validator
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+# use the LibYAML bindings if available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+class FlowList(list):
+    """A list that is written in YAML flow style, e.g. ``[0.1, 0.2]``."""
+
+
+def _represent_flow_list(dumper: yaml.SafeDumper, data: FlowList) -> yaml.Node:
+    return dumper.represent_sequence("tag:yaml.org,2002:seq", data, flow_style=True)
+
 
-class EmbeddingFormat(str, Enum):
-    PARQUET = "parquet"
-    YAML = "yaml"
-    JSON = "json"
+yaml.add_representer(FlowList, _represent_flow_list, Dumper=YamlDumper)
 
 
-SUFFIX_MAP = {EmbeddingFormat.PARQUET: ".parquet"}
+DEFAULT_BATCH_SIZE = 65536
+
+OBJECTS_SUFFIX = ".objects.parquet"
 
 
 def embeddings_file_tuple(
@@ -59,19 +88,571 @@ def embeddings_file_tuple(
     return metadata, embeddings, embedding_format
 
 
+def read_embeddings_table(
+    source: Union[str, Path],
+    format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+    memory_map=False,
+    columns: Optional[List[str]] = None,
+    **kwargs,
+) -> pa.Table:
+    """
+    Read the embeddings file as an arrow table.
+
+    With ``memory_map=True``, arrow IPC files are opened via a memory map, so the buffers
+    of the returned table are backed by the page cache rather than copied onto the heap,
+    and can be shared across processes. Parquet files still need decoding, but are read
+    through a memory map rather than buffered reads.
+
+    :param source: path to the embeddings file
+    :param format: PARQUET or ARROW
+    :param memory_map: memory map the file
+    :param columns: restrict to these columns
+    :return:
+    """
+    if format == EmbeddingFormat.PARQUET:
+        return pq.read_table(str(source), columns=columns, memory_map=memory_map)
+    elif format == EmbeddingFormat.ARROW:
+        source = pa.memory_map(str(source)) if memory_map else pa.OSFile(str(source))
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table
+    else:
+        raise ValueError(f"Unsupported format: {format}")
+
+
 def load_embeddings_as_pandas(
     self, source: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.PARQUET, **kwargs
-) -> pd.DataFrame:
-    if format == EmbeddingFormat.PARQUET:
-        read_table = pq.read_table(str(source))
+) -> "pd.DataFrame":
+    with phase("read_embeddings", nbytes=file_size(source)):
+        read_table = read_embeddings_table(source, format, **kwargs)
+        count(rows=read_table.num_rows)
+    with phase("to_pandas", rows=read_table.num_rows):
         df = read_table.to_pandas()
         df["values"] = df["values"].apply(lambda x: x.tolist() if isinstance(x, np.ndarray) else x)
-        # df['values'] = df['values'].apply(lambda x: list(x) if isinstance(x, tuple) else x)
-        return df
+    # df['values'] = df['values'].apply(lambda x: list(x) if isinstance(x, tuple) else x)
+    return df
+
+
+def _list_chunk_dimension(chunk: pa.Array) -> int:
+    """
+    Get the common list length of a non-empty list array, checking it is uniform.
+
+    :param chunk:
+    :return:
+    """
+    if chunk.null_count:
+        raise ValueError("Embeddings column contains null vectors")
+    if pa.types.is_fixed_size_list(chunk.type):
+        return chunk.type.list_size
+    lengths = np.diff(chunk.offsets.to_numpy())
+    dim = int(lengths[0])
+    if (lengths != dim).any():
+        raise ValueError(f"Index has inconsistent embeddings lengths: {set(np.unique(lengths).tolist())}")
+    return dim
+
+
+def _pandas_frame(ids: np.ndarray, matrix: np.ndarray) -> "pd.DataFrame":
+    # pandas is only imported when a pandas frame is requested
+    import pandas as pd
+
+    with phase("to_pandas", rows=len(ids)):
+        return pd.DataFrame({ID: ids, VALUES: matrix.tolist()})
+
+
+def list_array_to_matrix(column: Union[pa.Array, pa.ChunkedArray], dtype=np.float32) -> np.ndarray:
+    """
+    Convert an arrow list column to a float32 (N, D) matrix.
+
+    The flat child buffer of the list array is reinterpreted directly; no per-row
+    python objects are created. A single chunk of the requested dtype is returned as
+    a zero-copy view, otherwise chunks are copied once into a preallocated matrix.
+
+    >>> arr = pa.array([[1.0, 2.0], [3.0, 4.0]], type=pa.list_(pa.float32()))
+    >>> list_array_to_matrix(arr).tolist()
+    [[1.0, 2.0], [3.0, 4.0]]
+
+    :param column: list, large list or fixed size list array (or chunked array)
+    :param dtype: dtype of the matrix; None keeps the stored dtype (e.g. float16 or int8)
+    :return: matrix with one row per list
+    """
+    chunks = column.chunks if isinstance(column, pa.ChunkedArray) else [column]
+    chunks = [c for c in chunks if len(c)]
+    if not chunks:
+        return np.empty((0, 0), dtype=dtype or np.float32)
+    dims = None
+    flats = []
+    for chunk in chunks:
+        dim = _list_chunk_dimension(chunk)
+        if dims is None:
+            dims = dim
+        elif dims != dim:
+            raise ValueError(f"Index has inconsistent embeddings lengths: {set([dims, dim])}")
+        flat = chunk.flatten()
+        if flat.null_count:
+            raise ValueError("Embeddings column contains null values")
+        flats.append(flat)
+    if dtype is None:
+        dtype = flats[0].type.to_pandas_dtype()
+    if len(flats) == 1:
+        flat = flats[0].to_numpy(zero_copy_only=False)
+        return flat.astype(dtype, copy=False).reshape(-1, dims)
+    matrix = np.empty((sum(len(f) for f in flats) // max(dims, 1), dims), dtype=dtype)
+    row = 0
+    for flat in flats:
+        n = len(flat) // max(dims, 1)
+        matrix[row : row + n] = flat.to_numpy(zero_copy_only=False).reshape(n, dims)
+        row += n
+    return matrix
+
+
+def load_embeddings_as_numpy(
+    source: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.PARQUET, dtype=np.float32, **kwargs
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load embeddings as an id array and a contiguous float32 (N, D) matrix.
+
+    If the file is a single-batch arrow file opened with ``memory_map=True``, the
+    matrix is a read-only view onto the memory map.
+
+    :param source: path to the embeddings file
+    :param format: embeddings format
+    :param dtype: dtype of the matrix; None keeps the stored dtype
+    :return: tuple of ids, matrix
+    """
+    table = read_embeddings_table(source, format, columns=[ID, VALUES], **kwargs)
+    ids = table.column(ID).to_numpy()
+    matrix = list_array_to_matrix(table.column(VALUES), dtype=dtype)
+    return ids, matrix
+
+
+def embeddings_matrix(ix: vx.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the ids and float32 (N, D) matrix for the embeddings of an index.
+
+    Works for any of the supported embeddings frame types (numpy dict, pandas, arrow table).
+    Float32 numpy frames are returned as is, without copying; reduced precision numpy
+    frames (see ``load_index(dequantize=False)``) are converted to float32.
+
+    :param ix:
+    :return: tuple of ids, matrix
+    """
+    frame = ix.embeddings_frame
+    if frame is None:
+        raise ValueError("Index has no embeddings frame")
+    if isinstance(frame, dict):
+        return np.asarray(frame[ID]), dequantize(ix, np.asarray(frame[VALUES]))
+    if isinstance(frame, (pa.Table, pa.RecordBatch)):
+        return frame.column(ID).to_numpy(zero_copy_only=False), list_array_to_matrix(frame.column(VALUES))
+    if hasattr(frame[VALUES].dtype, "pyarrow_dtype"):
+        # pd.ArrowDtype column, e.g. from embeddings_as_pandas
+        return frame[ID].to_numpy(), list_array_to_matrix(pa.chunked_array(frame[VALUES]))
+    with phase("to_numpy", rows=len(frame)):
+        ids = frame[ID].to_numpy()
+        values = frame[VALUES].tolist()
+        if not values:
+            return ids, np.empty((0, ix.embeddings_dimensions or 0), dtype=np.float32)
+        return ids, np.array(values, dtype=np.float32)
+
+
+def embeddings_codes(ix: vx.Index) -> Optional[Tuple[np.ndarray, np.ndarray, ScalarQuantizer]]:
+    """
+    Get the int8 codes of an index whose embeddings were loaded without dequantizing.
+
+    :param ix:
+    :return: tuple of ids, (N, D) int8 codes and quantizer; None if the frame is not quantized
+    """
+    frame = ix.embeddings_frame
+    quantizer = ScalarQuantizer.from_index(ix)
+    if quantizer is None or not isinstance(frame, dict):
+        return None
+    codes = np.asarray(frame[VALUES])
+    if codes.dtype != np.int8:
+        return None
+    return np.asarray(frame[ID]), codes, quantizer
+
+
+def embeddings_ids(ix: vx.Index) -> np.ndarray:
+    """
+    Get the ids of the embeddings of an index, without converting the values.
+
+    :param ix:
+    :return: (N,) ids
+    """
+    frame = ix.embeddings_frame
+    if frame is None:
+        raise ValueError("Index has no embeddings frame")
+    if isinstance(frame, dict):
+        return np.asarray(frame[ID])
+    if isinstance(frame, (pa.Table, pa.RecordBatch)):
+        return frame.column(ID).to_numpy(zero_copy_only=False)
+    return frame[ID].to_numpy()
+
+
+def embeddings_rows(ix: vx.Index, rows: np.ndarray) -> np.ndarray:
+    """
+    Gather rows of the embeddings of an index into a float32 matrix, converting only those rows.
+
+    :param ix:
+    :param rows: row numbers
+    :return: (len(rows), D) matrix
+    """
+    frame = ix.embeddings_frame
+    rows = np.asarray(rows, dtype=np.int64)
+    if isinstance(frame, dict):
+        return dequantize(ix, np.asarray(frame[VALUES])[rows])
+    if isinstance(frame, (pa.Table, pa.RecordBatch)):
+        return list_array_to_matrix(frame.column(VALUES).take(pa.array(rows)))
+    values = frame[VALUES].iloc[rows].tolist()
+    return np.array(values, dtype=np.float32).reshape(len(rows), -1)
+
+
+def _string_array(ids: Union[List[str], np.ndarray, pa.Array, pa.ChunkedArray]) -> pa.Array:
+    """
+    Convert ids to an arrow string array; arrow ids are used as they are, not via python strings.
+
+    :param ids:
+    :return:
+    """
+    if isinstance(ids, pa.ChunkedArray):
+        ids = ids.combine_chunks()
+    if isinstance(ids, pa.Array):
+        return ids.cast(pa.string())
+    return pa.array(np.asarray(ids), type=pa.string())
+
+
+def _arrow_frame(ids: Union[np.ndarray, pa.Array, pa.ChunkedArray], matrix: np.ndarray) -> pa.Table:
+    """
+    Wrap ids and a matrix as an embeddings table; a contiguous float32 matrix is not copied.
+
+    :param ids: (N,) ids
+    :param matrix: (N, D) matrix
+    :return: table with a fixed size list values column
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    ids = _string_array(ids)
+    if not matrix.size:
+        return pyarrow_schema().empty_table()
+    dimensions = matrix.shape[1]
+    values = pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), dimensions)
+    return pa.Table.from_arrays([ids, values], schema=pyarrow_schema(dimensions))
+
+
+def embeddings_table(ix: vx.Index) -> pa.Table:
+    """
+    Get the embeddings of an index as an arrow table, the canonical in-memory representation.
+
+    The table has an ``id`` string column and a ``values`` column of fixed size lists of
+    float32. Arrow frames (see ``load_index(mode=LoadMode.ARROW)``) are returned as is,
+    and float32 numpy frames are wrapped without copying the matrix.
+
+    >>> ix = vx.Index()
+    >>> ix.embeddings_frame = {"id": np.array(["A", "B"]), "values": np.eye(2, dtype=np.float32)}
+    >>> table = embeddings_table(ix)
+    >>> table.schema.field("values").type
+    FixedSizeListType(fixed_size_list<item: float>[2])
+    >>> np.shares_memory(embeddings_matrix(vx.Index(embeddings_frame=table))[1], ix.embeddings_frame["values"])
+    True
+
+    :param ix:
+    :return: table of id, values
+    """
+    frame = ix.embeddings_frame
+    if frame is None:
+        raise ValueError("Index has no embeddings frame")
+    if isinstance(frame, pa.RecordBatch):
+        frame = pa.Table.from_batches([frame])
+    if isinstance(frame, pa.Table):
+        return to_fixed_size_table(frame.select([ID, VALUES]))
+    ids, matrix = embeddings_matrix(ix)
+    return _arrow_frame(ids, matrix)
+
+
+def embeddings_as_pandas(ix: vx.Index) -> "pd.DataFrame":
+    """
+    Get the embeddings of an index as a pandas DataFrame backed by arrow.
+
+    Both columns use ``pd.ArrowDtype``, so the frame is a view onto the arrow buffers
+    of :func:`embeddings_table`, rather than a column of python lists.
+
+    >>> ix = vx.Index(embeddings_frame={"id": np.array(["A"]), "values": np.ones((1, 2))})
+    >>> embeddings_as_pandas(ix).dtypes.astype(str).tolist()
+    ['string[pyarrow]', 'fixed_size_list<item: float>[2][pyarrow]']
+
+    :param ix:
+    :return: frame with id and values columns
+    """
+    import pandas as pd
+
+    return embeddings_table(ix).to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def embeddings_as_polars(ix: vx.Index):
+    """
+    Get the embeddings of an index as a polars DataFrame, with an ``Array`` values column.
+
+    Requires polars (``pip install venomx[polars]``).
+
+    :param ix:
+    :return: polars DataFrame with id and values columns
+    """
+    try:
+        import polars as pl
+    except ImportError as e:
+        raise ImportError("embeddings_as_polars requires polars: pip install venomx[polars]") from e
+    return pl.from_arrow(embeddings_table(ix))
+
+
+def _iter_record_batches(
+    source: Path, format: EmbeddingFormat, batch_size: int, columns: List[str], memory_map=False
+) -> Iterator[pa.RecordBatch]:
+    if format == EmbeddingFormat.PARQUET:
+        pf = pq.ParquetFile(str(source), memory_map=memory_map)
+        yield from pf.iter_batches(batch_size=batch_size, columns=columns)
+    elif format == EmbeddingFormat.ARROW:
+        stream = pa.memory_map(str(source)) if memory_map else pa.OSFile(str(source))
+        reader = pa.ipc.open_file(stream)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i).select(columns)
+            for offset in range(0, batch.num_rows, batch_size):
+                yield batch.slice(offset, batch_size)
     else:
         raise ValueError(f"Unsupported format: {format}")
 
 
+def _put_until_stopped(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _produce(source: Callable[[], Iterator], q: queue.Queue, stop: threading.Event):
+    """
+    Run an iterator into a bounded queue, ending with a (False, exception or None) marker.
+
+    :return:
+    """
+    try:
+        for item in source():
+            if not _put_until_stopped(q, (True, item), stop):
+                return
+        _put_until_stopped(q, (False, None), stop)
+    except Exception as e:
+        _put_until_stopped(q, (False, e), stop)
+
+
+def _drain(q: queue.Queue) -> Iterator:
+    while True:
+        more, item = q.get()
+        if not more:
+            if item is not None:
+                raise item
+            return
+        yield item
+
+
+def _iter_prefetched(sources: List[Callable[[], Iterator]], workers: int, depth: int = 2) -> Iterator:
+    """
+    Chain iterators, running up to ``workers`` of them ahead in threads.
+
+    Items are yielded in order. Each running iterator buffers at most ``depth`` items,
+    so memory stays bounded; abandoning the chain stops the threads.
+
+    >>> list(_iter_prefetched([lambda i=i: iter(range(i * 3, i * 3 + 3)) for i in range(3)], workers=2))
+    [0, 1, 2, 3, 4, 5, 6, 7, 8]
+
+    :param sources: functions returning the iterators
+    :param workers: number of threads
+    :param depth: number of items buffered per iterator
+    :return:
+    """
+    if workers <= 1 or len(sources) <= 1:
+        for source in sources:
+            yield from source()
+        return
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=depth) for _ in sources]
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for source, q in zip(sources, queues, strict=True):
+            pool.submit(_produce, source, q, stop)
+        for q in queues:
+            yield from _drain(q)
+    finally:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _drain_until_stopped(q: queue.Queue, stop: threading.Event) -> Iterator:
+    while True:
+        try:
+            more, item = q.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return
+            continue
+        if not more:
+            if item is not None:
+                raise item
+            return
+        yield item
+
+
+def iter_pipelined(source: Callable[[], Iterator], stages: List[Callable], depth: int = 2) -> Iterator:
+    """
+    Pass the items of an iterator through a chain of functions, each stage running in its own thread.
+
+    Stages are connected by queues of at most ``depth`` items, so that e.g. reading,
+    decoding and writing overlap while memory stays bounded. Items are yielded in
+    order; an exception in any stage is raised to the consumer, and abandoning the
+    iterator stops the threads.
+
+    >>> list(iter_pipelined(lambda: iter(range(5)), [lambda x: x * 2, lambda x: x + 1]))
+    [1, 3, 5, 7, 9]
+
+    :param source: function returning the iterator
+    :param stages: functions applied to each item, in order
+    :param depth: number of items buffered between stages
+    :return:
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    producers = [source] + [
+        partial(lambda stage, q: map(stage, _drain_until_stopped(q, stop)), stage, q)
+        for stage, q in zip(stages, queues[:-1], strict=True)
+    ]
+    threads = [
+        threading.Thread(target=_produce, args=(producer, q, stop), daemon=True)
+        for producer, q in zip(producers, queues, strict=True)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        yield from _drain_until_stopped(queues[-1], stop)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _iter_masked(read: Callable[[Path], Iterator[pa.RecordBatch]], path: Path, mask: np.ndarray):
+    offset = 0
+    for batch in read(path):
+        keep = mask[offset : offset + batch.num_rows]
+        offset += batch.num_rows
+        if keep.all():
+            yield batch
+        elif keep.any():
+            yield batch.filter(pa.array(keep))
+
+
+def _batch_sources(
+    source: Union[str, Path],
+    format: EmbeddingFormat,
+    batch_size: int,
+    columns: List[str],
+    memory_map=False,
+    apply_segments=True,
+) -> List[Callable[[], Iterator[pa.RecordBatch]]]:
+    """
+    Get the record batch iterators over the embeddings files of an index, in row order.
+
+    The files are the one next to the metadata, or the shards it lists; rows replaced
+    or deleted by delta segments are filtered out, and the segment rows appended.
+
+    :param source: path to the metadata yaml or the embeddings file
+    :param format: PARQUET or ARROW
+    :param batch_size: maximum rows per batch
+    :param columns: columns to read
+    :param memory_map: memory map the files
+    :param apply_segments: apply the delta segments, if any
+    :return: one function per file, returning its batches
+    """
+    metadata, embeddings, _ = embeddings_file_tuple(source, format, exists_check=False)
+    metadata_obj = _load_metadata(metadata, format) if metadata.exists() else {}
+    read = partial(_iter_record_batches, format=format, batch_size=batch_size, columns=columns, memory_map=memory_map)
+    if apply_segments and metadata_obj.get("segments"):
+        from venomx.tools.delta import live_file_masks
+
+        files = live_file_masks(_index_from_metadata(metadata_obj, metadata), metadata, format)
+        return [partial(_iter_masked, read, path, mask) for path, mask in files]
+    if metadata_obj.get("shards"):
+        paths = [metadata.parent / shard["path"] for shard in metadata_obj["shards"]]
+    elif embeddings.exists():
+        paths = [embeddings]
+    else:
+        raise ValueError(f"Embeddings file does not exist: {embeddings}")
+    return [partial(read, path) for path in paths]
+
+
+def iter_embeddings(
+    source: Union[str, Path],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    columns: Optional[List[str]] = None,
+    ids: Optional[Iterable[str]] = None,
+    format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+    dimensions: Optional[int] = None,
+    memory_map=False,
+    workers: Optional[int] = None,
+    apply_segments=True,
+) -> Iterator[Tuple[Optional[np.ndarray], Optional[np.ndarray]]]:
+    """
+    Iterate over the embeddings of an index in batches, in bounded memory.
+
+    Each batch is checked as it is read: all vectors must have the same number of
+    dimensions as each other, as previous batches, and as ``dimensions`` if given.
+
+    The shards of a sharded index are read ahead in parallel, by up to ``workers``
+    threads, and yielded in row order. Rows replaced or deleted by delta segments
+    are skipped, and the rows of the segments yielded after those of the index.
+
+    >>> with IndexWriter(vx.Index(), "tests/output/iterated.vx.yaml") as writer:
+    ...     writer.write_batch([f"X:{i}" for i in range(100)], np.random.rand(100, 50))
+    >>> for ids, matrix in iter_embeddings("tests/output/iterated.vx.yaml", batch_size=40):
+    ...     print(len(ids), matrix.shape)
+    40 (40, 50)
+    40 (40, 50)
+    20 (20, 50)
+
+    :param source: path to the metadata yaml or the embeddings file
+    :param batch_size: maximum rows per batch
+    :param columns: columns to read, default id and values; if one is omitted it is yielded as None
+    :param ids: if set, only yield rows with these ids
+    :param format: PARQUET or ARROW
+    :param dimensions: expected number of dimensions
+    :param memory_map: memory map the file
+    :param workers: number of threads reading shards ahead, default number of CPUs
+    :param apply_segments: apply the delta segments; if False, yield the rows of the embeddings files as written
+    :return: iterator over (ids, float32 matrix) tuples
+    """
+    format = EmbeddingFormat(format)
+    if columns is None:
+        columns = [ID, VALUES]
+    read_columns = list(columns)
+    if ids is not None and ID not in read_columns:
+        read_columns.append(ID)
+    id_filter = pa.array(list(ids), type=pa.string()) if ids is not None else None
+    sources = _batch_sources(source, format, batch_size, read_columns, memory_map, apply_segments)
+    for batch in _iter_prefetched(sources, workers or os.cpu_count()):
+        if id_filter is not None:
+            batch = batch.filter(pc.is_in(batch.column(ID), value_set=id_filter))
+        if not batch.num_rows:
+            continue
+        matrix = None
+        if VALUES in columns:
+            matrix = list_array_to_matrix(batch.column(VALUES))
+            if dimensions is None:
+                dimensions = matrix.shape[1]
+            elif matrix.shape[1] != dimensions:
+                raise ValueError(f"Index has inconsistent embeddings dimensions: {matrix.shape[1]} != {dimensions}")
+        batch_ids = batch.column(ID).to_numpy(zero_copy_only=False) if ID in columns else None
+        yield batch_ids, matrix
+
+
 def _is_all_in_one(format: EmbeddingFormat) -> bool:
     """
     Check if a file is an all-in-one file.
@@ -83,65 +664,995 @@ def _is_all_in_one(format: EmbeddingFormat) -> bool:
     return format in [EmbeddingFormat.YAML, EmbeddingFormat.JSON]
 
 
-def load_index(source: Union[str, Path], format: EmbeddingFormat = None, check=True, **kwargs) -> vx.Index:
+def _embeddings_paths(ix: vx.Index, metadata: Path, embeddings: Optional[Path]) -> List[Path]:
+    """
+    Get the embeddings files of a dual-file index: its shards, or the file next to the metadata.
+
+    :param ix: index built from the metadata
+    :param metadata: path to the metadata file
+    :param embeddings: path to the embeddings file, None if it does not exist
+    :return:
+    """
+    if ix.shards:
+        return shard_paths(ix, metadata)
+    if embeddings is None:
+        raise ValueError(f"Embeddings file does not exist for: {metadata}")
+    return [embeddings]
+
+
+def _load_shards(
+    paths: List[Path], format: EmbeddingFormat, workers: Optional[int] = None, **kwargs
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load the shards of an index with a thread pool, and concatenate them in row order.
+
+    :param paths: embeddings files
+    :param format: PARQUET or ARROW
+    :param workers: number of threads, default number of CPUs
+    :param kwargs: passed to load_embeddings_as_numpy
+    :return: tuple of ids, matrix in the stored dtype
+    """
+    if len(paths) == 1:
+        return load_embeddings_as_numpy(paths[0], format, dtype=None, **kwargs)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        parts = list(pool.map(lambda path: load_embeddings_as_numpy(path, format, dtype=None, **kwargs), paths))
+    parts = [(ids, matrix) for ids, matrix in parts if len(ids)] or parts[:1]
+    return np.concatenate([ids for ids, _ in parts]), np.concatenate([matrix for _, matrix in parts])
+
+
+def _load_dual_file(
+    ix: vx.Index,
+    metadata: Path,
+    paths: List[Path],
+    format: EmbeddingFormat,
+    mode: LoadMode,
+    dequantize_values: bool,
+    workers: Optional[int] = None,
+    **kwargs,
+):
+    """
+    Load the embeddings files of a dual-file index into its embeddings frame.
+
+    Delta segments, if any, are applied to the rows of the embeddings files.
+
+    :param ix: index built from the metadata
+    :param metadata: path to the metadata file
+    :param paths: embeddings file, or shards
+    :param format: PARQUET or ARROW
+    :param mode: how to materialize the embeddings frame
+    :param dequantize_values: convert reduced precision values to float32
+    :param workers: number of threads reading shards
+    :return:
+    """
+    reduced = StorageDtype(ix.embeddings_dtype or StorageDtype.FLOAT32) != StorageDtype.FLOAT32
+    if mode == LoadMode.PANDAS and not reduced and len(paths) == 1 and not ix.segments:
+        ix.embeddings_frame = load_embeddings_as_pandas(ix, paths[0], format, **kwargs)
+        return
+    if mode == LoadMode.ARROW and not reduced and len(paths) == 1 and not ix.segments:
+        with phase("read_embeddings", nbytes=file_size(paths[0])):
+            table = read_embeddings_table(paths[0], format, columns=[ID, VALUES], **kwargs)
+            count(rows=table.num_rows)
+        ix.embeddings_frame = to_fixed_size_table(table)
+        return
+    with phase("read_embeddings", nbytes=sum(file_size(path) for path in paths)):
+        ids, matrix = _load_shards(paths, format, workers, **kwargs)
+        count(rows=len(ids))
+    if ix.segments:
+        from venomx.tools.delta import apply_segments
+
+        with phase("apply_segments"):
+            ids, matrix = apply_segments(
+                ix, metadata, format, ids, matrix, lambda path: load_embeddings_as_numpy(path, format, dtype=None)
+            )
+    if dequantize_values or mode != LoadMode.NUMPY:
+        with phase("dequantize", rows=len(ids)):
+            matrix = dequantize(ix, matrix)
+    ix.embeddings_frame = _frame(mode, ids, matrix)
+
+
+def _frame(mode: LoadMode, ids: np.ndarray, matrix: np.ndarray):
+    if mode == LoadMode.NUMPY:
+        return {ID: ids, VALUES: matrix}
+    if mode == LoadMode.ARROW:
+        return _arrow_frame(ids, matrix)
+    return _pandas_frame(ids, matrix)
+
+
+@profiled("load_index")
+def load_index(
+    source: Union[str, Path],
+    format: EmbeddingFormat = None,
+    check=True,
+    mode: LoadMode = LoadMode.PANDAS,
+    dequantize=True,
+    workers: Optional[int] = None,
+    **kwargs,
+) -> vx.Index:
     """
     Load an index from a file.
 
+    With ``mode=LoadMode.NUMPY`` the embeddings frame is a dict with an ``id``
+    array and a float32 ``values`` matrix, read straight from the arrow buffers.
+    Combined with ``format=EmbeddingFormat.ARROW`` and ``memory_map=True`` the matrix
+    is backed by the memory-mapped file.
+
+    With ``mode=LoadMode.ARROW`` the embeddings frame is the arrow table as read (see
+    :func:`embeddings_table`), from which :func:`embeddings_matrix`,
+    :func:`embeddings_as_pandas` and :func:`embeddings_as_polars` give views on demand.
+
+    Embeddings stored as float16 or int8 (see ``save_index(dtype=...)``) are converted
+    to float32 on load. With ``mode=LoadMode.NUMPY`` and ``dequantize=False`` they are
+    kept as stored; :func:`embeddings_matrix` then converts on demand, and searches
+    score int8 codes directly.
+
+    The shards of a sharded index (see :func:`save_sharded_index`) are read in parallel
+    with a thread pool.
+
     :param source:
-    :param kwargs:
+    :param mode: how to materialize the embeddings frame
+    :param dequantize: convert reduced precision embeddings to float32
+    :param workers: number of threads reading shards, default number of CPUs
+    :param kwargs: passed to the embeddings reader (e.g. ``memory_map``)
     :return:
     """
     if format is None:
         format = EmbeddingFormat.PARQUET
-    all_in_one = _is_all_in_one(format)
-    if all_in_one:
+    mode = LoadMode(mode)
+    if _is_all_in_one(format):
         metadata = source
-        embeddings = None
-        ef = format
+        metadata_obj, ids, matrix = _load_bundled(metadata, format)
+        ix = _index_from_metadata(metadata_obj, metadata)
+        if ids is None:
+            raise ValueError(f"Index has no embeddings: {source}")
+        ix.embeddings_frame = _frame(mode, ids, matrix)
+    elif format in SUFFIX_MAP:
+        metadata, embeddings, ef = embeddings_file_tuple(source, format, allow_bundled=True)
+        ix = _index_from_metadata(_load_metadata(metadata, format), metadata)
+        paths = _embeddings_paths(ix, metadata, embeddings)
+        _load_dual_file(ix, metadata, paths, ef, mode, dequantize, workers=workers, **kwargs)
     else:
-        metadata, embeddings, ef = embeddings_file_tuple(source, format, allow_bundled=all_in_one)
-    metadata_obj = yaml.safe_load(open(metadata))
-    ix = vx.Index(**metadata_obj)
-    if embeddings:
-        if format == EmbeddingFormat.PARQUET:
-            ix.embeddings_frame = load_embeddings_as_pandas(ix, embeddings, ef, **kwargs)
-        else:
-            raise NotImplementedError(f"Unsupported format: {format}")
-    if not ix.embeddings and ix.embeddings_frame is None:
-        raise ValueError(f"Index has no embeddings: {source}")
-    if ix.embeddings and not ix.embeddings_frame:
-        ix.embeddings_frame = pd.DataFrame([row.model_dump() for row in ix.embeddings])
+        raise NotImplementedError(f"Unsupported format: {format}")
     if check:
         validate(ix)
+    with phase("attach_sidecars"):
+        _attach_sidecars(ix, metadata)
     return ix
 
 
-def validate(ix: vx.Index, **kwargs):
+def _attach_sidecars(ix: vx.Index, metadata: Union[str, Path]):
+    """
+    Attach the id map and approximate nearest neighbour sidecars of an index, if they exist.
+
+    :param ix:
+    :param metadata: path to the metadata file
+    :return:
+    """
+    from venomx.tools.ann import IVFIndex, ann_sidecar_path
+    from venomx.tools.lookup import attach_id_map
+    from venomx.tools.search import attach_ann
+
+    if ix.segments:
+        # sidecars index the rows as they were before the segments were applied
+        return
+    num_rows = len(ix.embeddings_frame[ID])
+    sidecar = id_map_path(metadata)
+    if sidecar.exists():
+        # memory mapped; lookups confirm the ids of matched rows, so a stale map cannot return wrong rows
+        attach_id_map(ix, IdMap.load(sidecar))
+    sidecar = ann_sidecar_path(metadata)
+    if not sidecar.exists():
+        return
+    ann = IVFIndex.load(sidecar)
+    if ann.source_md5 and ix.md5 and ann.source_md5 != ix.md5:
+        logger.warning(f"Ignoring stale ANN sidecar {sidecar}: built for md5 {ann.source_md5}, index is {ix.md5}")
+        return
+    if ann.num_rows != num_rows:
+        logger.warning(f"Ignoring ANN sidecar {sidecar}: {ann.num_rows} rows != {num_rows}")
+        return
+    attach_ann(ix, ann)
+
+
+class LazyIndex:
+    """
+    An index opened for metadata only.
+
+    Opening parses the metadata file and the footer of the embeddings file; the
+    embeddings payload is only read when :attr:`embeddings_frame` (or :meth:`load`)
+    is accessed, and pydantic objects are only built when :attr:`index` is accessed.
+
+    >>> with IndexWriter(vx.Index(objects=[{"id": "X:1"}]), "tests/output/lazy.vx.yaml") as writer:
+    ...     writer.write_batch(["X:1"], np.zeros((1, 4)))
+    >>> lix = open_index("tests/output/lazy.vx.yaml")
+    >>> lix.num_rows, lix.dimensions, lix.num_objects
+    (1, 4, 1)
+    """
+
+    def __init__(self, source: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.PARQUET):
+        """
+        Open an index.
+
+        :param source: path to the metadata yaml or the embeddings file
+        :param format: embeddings format
+        """
+        self.source = source
+        self.format = EmbeddingFormat(format)
+        self._index = None
+        self._loaded = None
+        self.schema = None
+        self.num_row_groups = None
+        self.num_bytes = None
+        if _is_all_in_one(self.format):
+            self._loaded = load_index(source, format=self.format, mode=LoadMode.NUMPY, check=False)
+            self.metadata_path = Path(source)
+            self.embeddings_path = None
+            self.embeddings_paths = []
+            self.chunk_counts = []
+            self.metadata = _metadata_dict(self._loaded)
+            self.num_rows = len(self._loaded.embeddings_frame[ID])
+            self.dimensions = self._loaded.embeddings_frame[VALUES].shape[1] if self.num_rows else None
+            self.num_bytes = self.metadata_path.stat().st_size
+            return
+        self.metadata_path, self.embeddings_path, _ = embeddings_file_tuple(source, self.format, allow_bundled=True)
+        self.metadata = _load_metadata(self.metadata_path, self.format)
+        shards = self.metadata.get("shards") or []
+        if shards:
+            self.embeddings_path = None
+            self.embeddings_paths = [self.metadata_path.parent / shard["path"] for shard in shards]
+        elif self.embeddings_path is None:
+            raise ValueError(f"Embeddings file does not exist for: {self.metadata_path}")
+        else:
+            self.embeddings_paths = [self.embeddings_path]
+        self.chunk_counts = []
+        self.num_rows = 0
+        self.num_bytes = 0
+        for path in self.embeddings_paths:
+            schema, num_chunks, num_rows = self._read_footer(path)
+            self.schema = self.schema or schema
+            self.chunk_counts.append(num_chunks)
+            self.num_rows += num_rows
+            self.num_bytes += path.stat().st_size
+        self.num_row_groups = sum(self.chunk_counts)
+        if self.metadata.get("segments"):
+            # rows of the embeddings files may be replaced or deleted by the segments
+            self.num_rows = self.metadata.get("embeddings_count")
+        self.dimensions = self._footer_dimensions()
+
+    def _read_footer(self, path: Path) -> Tuple[pa.Schema, int, int]:
+        if self.format == EmbeddingFormat.ARROW:
+            reader = pa.ipc.open_file(pa.memory_map(str(path)))
+            num_rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+            return reader.schema, reader.num_record_batches, num_rows
+        pf = pq.ParquetFile(str(path))
+        return pf.schema_arrow, pf.num_row_groups, pf.metadata.num_rows
+
+    def _footer_dimensions(self) -> Optional[int]:
+        values_type = self.schema.field(VALUES).type
+        if pa.types.is_fixed_size_list(values_type):
+            return values_type.list_size
+        if self.metadata.get("embeddings_dimensions") is not None:
+            return self.metadata["embeddings_dimensions"]
+        if not self.num_rows:
+            return None
+        # variable size lists: read a single vector
+        _, matrix = next(iter_embeddings(self.embeddings_paths[0], batch_size=1, format=self.format))
+        return matrix.shape[1]
+
+    def chunk_locations(self) -> List[Tuple[Path, int]]:
+        """
+        Get the row groups (or record batches) of the index, in row order.
+
+        :return: list of (embeddings file, chunk number in the file)
+        """
+        return [(path, i) for path, n in zip(self.embeddings_paths, self.chunk_counts, strict=True) for i in range(n)]
+
+    @property
+    def num_objects(self) -> int:
+        """Number of named objects in the metadata, or in its objects table."""
+        if self.metadata.get("objects_path"):
+            return pq.ParquetFile(str(self.metadata_path.parent / self.metadata["objects_path"])).metadata.num_rows
+        return len(self.metadata.get("objects") or [])
+
+    @property
+    def index(self) -> vx.Index:
+        """The index, without embeddings unless they have been loaded."""
+        if self._loaded is not None:
+            return self._loaded
+        if self._index is None:
+            self._index = _index_from_metadata(self.metadata, self.metadata_path)
+        return self._index
+
+    def load(self, **kwargs) -> vx.Index:
+        """
+        Load the full index, including the embeddings payload.
+
+        :param kwargs: passed to load_index
+        :return:
+        """
+        if self._loaded is None or kwargs:
+            self._loaded = load_index(self.source, format=self.format, **kwargs)
+        return self._loaded
+
+    @property
+    def embeddings_frame(self):
+        """The embeddings frame, loaded on first access."""
+        return self.load().embeddings_frame
+
+    def summary(self) -> dict:
+        """
+        Summarize the index, without reading the embeddings payload.
+
+        :return: dict with counts, sizes and schema
+        """
+        return {
+            "id": self.metadata.get("id"),
+            "metadata_path": str(self.metadata_path),
+            "embeddings_path": str(self.embeddings_path) if self.embeddings_path else None,
+            "num_shards": len(self.metadata.get("shards") or []),
+            "num_segments": len(self.metadata.get("segments") or []),
+            "format": self.format.value,
+            "num_objects": self.num_objects,
+            "num_rows": self.num_rows,
+            "dimensions": self.dimensions,
+            "dtype": self.metadata.get("embeddings_dtype") or StorageDtype.FLOAT32.value,
+            "num_row_groups": self.num_row_groups,
+            "num_bytes": self.num_bytes,
+            "schema": str(self.schema) if self.schema is not None else None,
+            "md5": self.metadata.get("md5"),
+        }
+
+
+def open_index(source: Union[str, Path], format: EmbeddingFormat = None) -> LazyIndex:
+    """
+    Open an index lazily, reading only the metadata and the embeddings file footer.
+
+    :param source: path to the metadata yaml or the embeddings file
+    :param format: embeddings format, default PARQUET
+    :return:
+    """
+    return LazyIndex(source, format or EmbeddingFormat.PARQUET)
+
+
+def _frame_arrays(ix: vx.Index) -> Tuple[pa.Array, pa.Array]:
+    """
+    Get the ids and values of the embeddings frame of an index as arrow arrays.
+
+    :param ix: index with a numpy dict, pandas or arrow embeddings frame
+    :return: tuple of ids, list array
+    """
+    frame = ix.embeddings_frame
+    if isinstance(frame, (pa.Table, pa.RecordBatch)):
+        return frame.column(ID), frame.column(VALUES)
+    if isinstance(frame, dict):
+        if isinstance(frame[VALUES], np.ndarray) and frame[VALUES].ndim == 2:
+            ids, matrix = embeddings_matrix(ix)
+            return pa.array(ids, type=pa.string()), _matrix_to_list_array(matrix)
+        return pa.array(np.asarray(frame[ID]), type=pa.string()), pa.array(list(frame[VALUES]))
+    return pa.array(frame[ID], type=pa.string(), from_pandas=True), pa.array(frame[VALUES], from_pandas=True)
+
+
+def _validator(ix: vx.Index) -> Validator:
+    if isinstance(ix.objects, ObjectTable):
+        object_ids = ix.objects.ids
+    else:
+        object_ids = [obj.id for obj in ix.objects or []]
+    return Validator(ix.embeddings_dimensions, object_ids=object_ids, expected_count=ix.embeddings_count)
+
+
+def validate(ix: vx.Index, raise_errors=True, **kwargs) -> ValidationReport:
     """
     Validate an index.
 
+    The embeddings are checked column-wise for vectors of the wrong dimensions, null,
+    non-finite and all-zero vectors, duplicate ids, and ids that are not objects of the index.
+
+    >>> ix = vx.Index(objects=[{"id": "A"}])
+    >>> ix.embeddings_frame = {"id": np.array(["A", "B"]), "values": np.array([[1.0, 2.0], [0.0, 0.0]])}
+    >>> report = validate(ix)
+    >>> report.ok, report.to_dict()["issues"]["zero_vector"]["rows"], ix.embeddings_dimensions
+    (True, [1], 2)
+
     :param ix:
+    :param raise_errors: raise a ValueError if the report has errors, e.g. inconsistent dimensions
     :param kwargs:
+    :return: report of the issues found
+    """
+    if ix.embeddings_frame is None:
+        return ValidationReport(dimensions=ix.embeddings_dimensions)
+    with phase("validate"):
+        validator = _validator(ix)
+        validator.update(*_frame_arrays(ix))
+        report = validator.finish()
+        count(rows=report.num_rows)
+    if ix.embeddings_dimensions is None:
+        ix.embeddings_dimensions = report.dimensions
+    if raise_errors:
+        report.raise_for_errors()
+    return report
+
+
+def validate_file(
+    source: Union[str, Path],
+    format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    memory_map=False,
+) -> ValidationReport:
+    """
+    Validate an index file, streaming the embeddings in batches.
+
+    Only the ids of all rows are held in memory (for the duplicate id check).
+
+    :param source: path to the metadata file or the embeddings file
+    :param format: embeddings format
+    :param batch_size: maximum rows per batch
+    :param memory_map: memory map the file
+    :return: report of the issues found
+    """
+    format = EmbeddingFormat(format)
+    if _is_all_in_one(format):
+        return validate(load_index(source, format=format, check=False, mode=LoadMode.NUMPY), raise_errors=False)
+    metadata, _, _ = embeddings_file_tuple(source, format, allow_bundled=True)
+    validator = _validator(_index_from_metadata(_load_metadata(metadata, format), metadata))
+    sources = _batch_sources(source, format, batch_size, [ID, VALUES], memory_map=memory_map)
+    with phase("validate"):
+        for batch in _iter_prefetched(sources, os.cpu_count()):
+            validator.update(batch.column(ID), batch.column(VALUES))
+            count(nbytes=batch.nbytes, rows=batch.num_rows)
+        return validator.finish()
+
+
+DEFAULT_ROW_GROUP_SIZE = 65536
+
+
+class ContentHasher:
+    """
+    Incremental md5 over the ids and float32 values of an index.
+
+    The id lengths, the utf-8 id bytes and the little-endian float32 bytes of the values
+    are hashed as three separate streams, straight from their buffers, and combined at
+    the end, so the digest does not depend on how the rows were batched or laid out.
+
+    >>> h = ContentHasher()
+    >>> h.update(np.array(["X:1", "X:2"]), np.zeros((2, 2)))
+    >>> h2 = ContentHasher()
+    >>> h2.update(np.array(["X:1"]), np.zeros((1, 2)))
+    >>> h2.update(pa.array(["X:2"]), np.zeros((1, 2)))
+    >>> h.hexdigest() == h2.hexdigest()
+    True
+    """
+
+    def __init__(self):
+        """Create a hasher."""
+        self.lengths_md5 = hashlib.md5(usedforsecurity=False)
+        self.ids_md5 = hashlib.md5(usedforsecurity=False)
+        self.values_md5 = hashlib.md5(usedforsecurity=False)
+
+    def update(self, ids: Union[np.ndarray, pa.Array], matrix: np.ndarray):
+        """
+        Add a batch of rows.
+
+        :param ids: (N,) ids, as numpy or arrow strings
+        :param matrix: (N, D) values
+        :return:
+        """
+        if isinstance(ids, pa.ChunkedArray):
+            ids = ids.combine_chunks()
+        if not isinstance(ids, pa.Array):
+            ids = pa.array(ids, type=pa.string())
+        elif ids.type != pa.string():
+            ids = ids.cast(pa.string())
+        if len(ids):
+            _, offsets_buffer, data = ids.buffers()
+            offsets = np.frombuffer(offsets_buffer, dtype=np.int32)[ids.offset : ids.offset + len(ids) + 1]
+            self.lengths_md5.update(np.diff(offsets).astype("<i4").data)
+            if data is not None:
+                self.ids_md5.update(data[offsets[0] : offsets[-1]])
+        self.values_md5.update(np.ascontiguousarray(matrix, dtype="<f4").data)
+
+    def hexdigest(self) -> str:
+        """
+        Get the combined digest.
+
+        :return:
+        """
+        digests = self.lengths_md5.digest() + self.ids_md5.digest() + self.values_md5.digest()
+        return hashlib.md5(digests, usedforsecurity=False).hexdigest()
+
+
+def content_md5(ids: Union[np.ndarray, pa.Array], matrix: np.ndarray) -> str:
+    """
+    Get the content md5 of a set of rows.
+
+    :param ids:
+    :param matrix:
     :return:
     """
-    if ix.embeddings_frame is not None:
-        vseries = ix.embeddings_frame["values"]
-        lens = set(vseries.apply(len).tolist())
-        if len(lens) != 1:
-            raise ValueError(f"Index has inconsistent embeddings lengths: {lens}")
-        vseries_len = list(lens)[0]
-        if ix.embeddings_dimensions is None:
-            ix.embeddings_dimensions = vseries_len
-        if vseries_len != ix.embeddings_dimensions:
-            raise ValueError(
-                "Index has inconsistent embeddings dimensions: " f"{vseries_len} != {ix.embeddings_dimensions}"
+    hasher = ContentHasher()
+    hasher.update(ids, matrix)
+    return hasher.hexdigest()
+
+
+def _metadata_dict(ix: vx.Index) -> dict:
+    metadata_obj = ix.model_dump(exclude_unset=True)
+    metadata_obj["embeddings"] = None
+    metadata_obj["embeddings_frame"] = None
+    # the objects are listed in the metadata, unless written as a table by _write_objects
+    metadata_obj.pop("objects_path", None)
+    if isinstance(ix.objects, ObjectTable):
+        with phase("objects_to_list", rows=len(ix.objects)):
+            metadata_obj["objects"] = ix.objects.to_records()
+    return metadata_obj
+
+
+def objects_table_path(metadata_path: Union[str, Path]) -> Path:
+    """
+    Get the path of the objects table of an index metadata file.
+
+    >>> str(objects_table_path("tests/output/test.vx.yaml"))
+    'tests/output/test.vx.objects.parquet'
+
+    :param metadata_path: path to the metadata yaml
+    :return:
+    """
+    path = Path(metadata_path)
+    return path.with_name(path.stem + OBJECTS_SUFFIX)
+
+
+def _write_objects(metadata_obj: dict, ix: vx.Index, metadata_path: Union[str, Path], objects_table: Optional[bool]):
+    """
+    Write the objects of an index as a parquet table next to the metadata, instead of in the metadata.
+
+    :param metadata_obj: metadata, updated in place
+    :param ix:
+    :param metadata_path: path to the metadata yaml
+    :param objects_table: write the table; default if the index was loaded from one
+    :return:
+    """
+    if objects_table is None:
+        objects_table = bool(ix.objects_path)
+    if not objects_table:
+        return
+    path = objects_table_path(metadata_path)
+    objects = ObjectTable.from_objects(ix.objects or [])
+    with phase("write_objects", rows=len(objects)):
+        objects.write(path)
+    metadata_obj.pop("objects", None)
+    metadata_obj["objects_path"] = path.name
+
+
+def _index_from_metadata(metadata_obj: dict, metadata_path: Union[str, Path]) -> vx.Index:
+    """
+    Create an index from its parsed metadata, with the objects as an :class:`ObjectTable`.
+
+    The objects are read from the objects table, if the metadata has one; no pydantic
+    objects are created for them.
+
+    :param metadata_obj: metadata; not modified
+    :param metadata_path: path to the metadata file
+    :return: index without embeddings
+    """
+    metadata_obj = dict(metadata_obj)
+    metadata_obj.pop("embeddings", None)
+    if metadata_obj.get("objects_path"):
+        path = Path(metadata_path).parent / metadata_obj["objects_path"]
+        with phase("read_objects", nbytes=file_size(path)):
+            metadata_obj["objects"] = ObjectTable.read(path)
+    elif metadata_obj.get("objects"):
+        with phase("objects_from_list", rows=len(metadata_obj["objects"])):
+            metadata_obj["objects"] = ObjectTable.from_records(metadata_obj["objects"])
+    with phase("validate_metadata"):
+        return vx.Index(**metadata_obj)
+
+
+def _load_metadata(metadata_path: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.YAML) -> dict:
+    with phase("parse_metadata", nbytes=file_size(metadata_path)), open(metadata_path, encoding="utf-8") as stream:
+        if format == EmbeddingFormat.JSON:
+            return json.load(stream)
+        return yaml.load(stream, Loader=YamlLoader)  # noqa: S506 - a safe loader
+
+
+def load_metadata(source: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.YAML) -> vx.Index:
+    """
+    Load the metadata of an index (its objects, model, input method...), without the embeddings.
+
+    The file may be a metadata file that has no embeddings yet, e.g. the input to an embedding run.
+
+    :param source: path to the metadata file, or for PARQUET and ARROW, the embeddings file
+    :param format: format of the index
+    :return: index whose embeddings_frame is None
+    """
+    format = EmbeddingFormat(format)
+    if format in SUFFIX_MAP:
+        source, _, _ = embeddings_file_tuple(source, format, exists_check=False)
+    return _index_from_metadata(_load_metadata(source, format), source)
+
+
+_BUNDLED_YAML_KEY = "\nembeddings:\n"
+_BUNDLED_YAML_ROW = re.compile(r'^- id: ("(?:[^"\\\n]|\\.)*")\n  values: \[([^\]\n]*)\]\n', re.MULTILINE)
+
+
+def _decode_bundled_rows(rows: List[Tuple[str, str]]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Decode the flow-style embeddings rows of an all-in-one YAML file, without the YAML parser.
+
+    >>> ids, matrix = _decode_bundled_rows([('"A"', "1.0, 2"), ('"B"', "3, -4.5e-1")])
+    >>> ids.tolist(), matrix.tolist()
+    (['A', 'B'], [[1.0, 2.0], [3.0, -0.44999998807907104]])
+    >>> _decode_bundled_rows([('"A"', "1.0, .nan")]) is None
+    True
+
+    :param rows: json-quoted id and comma separated values of each row
+    :return: tuple of ids, matrix; None if a value is not a plain number, for the YAML parser to decode
+    """
+    lengths = {m[1].count(",") + 1 for m in rows}
+    if len(lengths) != 1:
+        raise ValueError(f"Index has inconsistent embeddings lengths: {lengths}")
+    try:
+        flat = np.array(",".join(m[1] for m in rows).split(","), dtype=np.float32)
+    except ValueError:
+        return None
+    ids = np.array([json.loads(m[0]) for m in rows], dtype=object)
+    return ids, flat.reshape(len(rows), lengths.pop())
+
+
+def _load_bundled(
+    path: Union[str, Path], format: EmbeddingFormat
+) -> Tuple[dict, Optional[np.ndarray], Optional[np.ndarray]]:
+    """
+    Load an all-in-one file, decoding the embeddings straight into numpy.
+
+    Embeddings written by venomx in YAML (one flow-style row per embedding, at the end
+    of the file) are decoded without building a python object per value; any other
+    layout falls back to the YAML parser.
+
+    :param path:
+    :param format: YAML or JSON
+    :return: metadata without the embeddings, ids, matrix (both None if there are no embeddings)
+    """
+    metadata_obj = None
+    if format == EmbeddingFormat.YAML:
+        with phase("parse_metadata", nbytes=file_size(path)):
+            with open(path, encoding="utf-8") as stream:
+                text = stream.read()
+            pos = text.find(_BUNDLED_YAML_KEY)
+            if pos >= 0:
+                tail = text[pos + len(_BUNDLED_YAML_KEY) :]
+                rows = _BUNDLED_YAML_ROW.findall(tail)
+                if rows and sum(len(m[0]) + len(m[1]) + 20 for m in rows) == len(tail):
+                    with phase("decode_embeddings", rows=len(rows)):
+                        decoded = _decode_bundled_rows(rows)
+                    if decoded is not None:
+                        metadata_obj = yaml.load(text[: pos + 1], Loader=YamlLoader)  # noqa: S506 - a safe loader
+                        metadata_obj.pop("embeddings", None)
+                        return (metadata_obj, *decoded)
+            metadata_obj = yaml.load(text, Loader=YamlLoader)  # noqa: S506 - a safe loader
+    else:
+        metadata_obj = _load_metadata(path, format)
+    embeddings = metadata_obj.pop("embeddings", None)
+    if not embeddings:
+        return metadata_obj, None, None
+    with phase("decode_embeddings", rows=len(embeddings)):
+        ids = np.array([row[ID] for row in embeddings], dtype=object)
+        lengths = {len(row[VALUES]) for row in embeddings}
+        if len(lengths) != 1:
+            raise ValueError(f"Index has inconsistent embeddings lengths: {lengths}")
+        return metadata_obj, ids, np.array([row[VALUES] for row in embeddings], dtype=np.float32)
+
+
+def _write_bundled_yaml(metadata_obj: dict, ix: vx.Index, path: Union[str, Path]):
+    """
+    Write an all-in-one YAML file, with one flow-style line per embedding at the end.
+
+    :param metadata_obj: metadata, without embeddings
+    :param ix: index with the embeddings frame
+    :param path:
+    :return:
+    """
+    ids, matrix = embeddings_matrix(ix) if ix.embeddings_frame is not None else ([], None)
+    if matrix is not None and not np.isfinite(matrix).all():
+        # python reprs of non-finite floats are not YAML, use the YAML dumper
+        metadata_obj["embeddings"] = populate_embeddings_list(ix)
+        _write_metadata(metadata_obj, path)
+        return
+    with phase("write_bundled", rows=len(ids)), open(path, "w", encoding="utf-8") as stream:
+        yaml.dump(metadata_obj, stream, Dumper=YamlDumper, sort_keys=False, allow_unicode=True)
+        if matrix is None or not len(matrix):
+            stream.write("embeddings: []\n")
+            return
+        stream.write(_BUNDLED_YAML_KEY.lstrip("\n"))
+        for id, values in zip(ids.tolist(), matrix.tolist(), strict=True):
+            stream.write(f"- id: {json.dumps(str(id))}\n  values: {values}\n")
+        count(nbytes=stream.tell())
+
+
+def _write_metadata(
+    metadata_obj: dict, metadata_path: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.YAML
+):
+    with phase("write_metadata"), open(metadata_path, "w", encoding="utf-8") as stream:
+        if format == EmbeddingFormat.JSON:
+            # dumps uses the C encoder, dump does not
+            stream.write(json.dumps(metadata_obj))
+        else:
+            yaml.dump(metadata_obj, stream, Dumper=YamlDumper, sort_keys=False, allow_unicode=True)
+        count(nbytes=stream.tell())
+
+
+def _embeddings_metadata_dict(
+    ix: vx.Index,
+    dimensions: Optional[int],
+    count: int,
+    md5: str,
+    chunk_md5s: List[str],
+    dtype: StorageDtype,
+    quantizer: Optional[ScalarQuantizer],
+    shards: Optional[List[dict]] = None,
+) -> dict:
+    """
+    Get the metadata of an index, with the fields describing the embeddings that were written.
+
+    :return:
+    """
+    metadata_obj = _metadata_dict(ix)
+    metadata_obj["embeddings_dimensions"] = dimensions
+    metadata_obj["embeddings_count"] = count
+    metadata_obj["md5"] = md5
+    metadata_obj["chunk_md5s"] = chunk_md5s
+    metadata_obj["embeddings_dtype"] = StorageDtype(dtype).value
+    for key in ["quantization_scale", "quantization_offset", "shards", "segments"]:
+        metadata_obj.pop(key, None)
+    if quantizer is not None:
+        metadata_obj["quantization_scale"] = quantizer.scale.tolist()
+        metadata_obj["quantization_offset"] = quantizer.offset.tolist()
+    if shards:
+        metadata_obj["shards"] = shards
+    return metadata_obj
+
+
+class IndexWriter:
+    """
+    Incrementally write the embeddings of an index, in constant memory.
+
+    Batches of ids and vectors are written as row groups (PARQUET) or record batches
+    (ARROW) as they arrive. When the writer is closed, the metadata yaml is written,
+    with the dimensions, count and md5 of the embeddings that were written. If the
+    ``with`` block raises, no metadata is written. An id to row map is written
+    alongside, for constant time lookups by id.
+
+    Each row group also has its own md5 (``chunk_md5s``), so that :func:`verify_index`
+    can check row groups independently. The md5s are of the values as stored.
+
+    Values can be stored as float16, or int8 quantized per dimension (``dtype``). For
+    int8, the quantizer is fitted to the first batch unless one is given; values of
+    later batches outside its range are clipped.
+
+    >>> ix = vx.Index(id="streamed")
+    >>> with IndexWriter(ix, "tests/output/streamed.vx.yaml") as writer:
+    ...     for start in range(0, 100, 25):
+    ...         ids = [f"X:{i}" for i in range(start, start + 25)]
+    ...         writer.write_batch(ids, np.random.rand(25, 8))
+    >>> load_index("tests/output/streamed.vx.yaml").embeddings_count
+    100
+    """
+
+    def __init__(
+        self,
+        ix: vx.Index,
+        target: Union[str, Path],
+        format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+        fixed_size=False,
+        row_group_size: Optional[int] = DEFAULT_ROW_GROUP_SIZE,
+        id_map=True,
+        dtype: StorageDtype = StorageDtype.FLOAT32,
+        quantizer: Optional[ScalarQuantizer] = None,
+        objects_table: Optional[bool] = None,
+    ):
+        """
+        Create a writer.
+
+        :param ix: index whose metadata (objects etc.) is written on close
+        :param target: path to the metadata yaml or the embeddings file
+        :param format: PARQUET or ARROW
+        :param fixed_size: use a fixed size list layout (always used for ARROW)
+        :param row_group_size: maximum rows per row group or record batch; None for one per batch
+        :param id_map: also write an id to row map sidecar (see :class:`IdMap`)
+        :param dtype: storage dtype of the values
+        :param quantizer: int8 quantizer
+        :param objects_table: write the objects as a parquet table (see :class:`ObjectTable`) rather than in the
+            metadata; default if the index was loaded from one
+        """
+        format = EmbeddingFormat(format)
+        if format not in SUFFIX_MAP:
+            raise ValueError(f"Unsupported format for streaming: {format}")
+        self.ix = ix
+        self.format = format
+        self.fixed_size = fixed_size or format == EmbeddingFormat.ARROW
+        self.row_group_size = row_group_size
+        self.dtype = StorageDtype(dtype)
+        self.quantizer = quantizer
+        self.objects_table = objects_table
+        self.metadata_path, self.embeddings_path, _ = embeddings_file_tuple(target, format, exists_check=False)
+        self.dimensions = None
+        self.count = 0
+        self.hasher = ContentHasher()
+        self.chunk_md5s = []
+        self.id_hashes = [] if id_map else None
+        self._sink = None
+        self._writer = None
+        self._schema = None
+
+    def _open(self, schema: pa.Schema):
+        self._schema = schema
+        if self.format == EmbeddingFormat.ARROW:
+            self._sink = pa.OSFile(str(self.embeddings_path), "wb")
+            self._writer = pa.ipc.new_file(self._sink, schema)
+        else:
+            compression = "none" if self.fixed_size else "snappy"
+            # min/max id statistics per row group let filtered reads skip row groups (see venomx.tools.subset)
+            self._writer = pq.ParquetWriter(
+                str(self.embeddings_path), schema, compression=compression, write_statistics=[ID]
             )
 
+    def write_batch(self, ids: Union[List[str], np.ndarray, pa.Array], values: np.ndarray):
+        """
+        Write a batch of embeddings.
+
+        :param ids: (N,) ids, as a list, numpy or arrow array
+        :param values: (N, D) matrix
+        :return:
+        """
+        matrix = np.ascontiguousarray(values, dtype=np.float32)
+        if matrix.ndim != 2 or len(matrix) != len(ids):
+            raise ValueError(f"Expected a ({len(ids)}, D) matrix, got {matrix.shape}")
+        if self.dimensions is None:
+            self.dimensions = matrix.shape[1]
+            if self.dtype == StorageDtype.INT8 and self.quantizer is None:
+                self.quantizer = ScalarQuantizer.fit(matrix)
+            self._open(pyarrow_schema(self.dimensions if self.fixed_size else None, self.dtype.value))
+        elif matrix.shape[1] != self.dimensions:
+            raise ValueError(f"Index has inconsistent embeddings dimensions: {matrix.shape[1]} != {self.dimensions}")
+        with phase("encode", rows=len(matrix)):
+            matrix = to_storage(matrix, self.dtype, self.quantizer)
+            ids = _string_array(ids)
+        step = self.row_group_size or max(1, len(matrix))
+        # each chunk is written as exactly one row group (or record batch), with its own md5
+        for start in range(0, len(matrix), step):
+            chunk_ids = ids[start : start + step]
+            chunk = matrix[start : start + step]
+            with phase("hash", nbytes=chunk.nbytes, rows=len(chunk)):
+                self.hasher.update(chunk_ids, chunk)
+                self.chunk_md5s.append(content_md5(chunk_ids, chunk))
+                if self.id_hashes is not None:
+                    self.id_hashes.append(hash_ids(chunk_ids.to_numpy(zero_copy_only=False)))
+            with phase("write_embeddings", nbytes=chunk.nbytes, rows=len(chunk)):
+                if self.fixed_size:
+                    values_array = pa.FixedSizeListArray.from_arrays(pa.array(chunk.reshape(-1)), self.dimensions)
+                else:
+                    values_array = _matrix_to_list_array(chunk, dtype=chunk.dtype)
+                table = pa.Table.from_arrays([chunk_ids, values_array], schema=self._schema)
+                if self.format == EmbeddingFormat.ARROW:
+                    self._writer.write_table(table, max_chunksize=len(chunk))
+                else:
+                    self._writer.write_table(table, row_group_size=len(chunk))
+        self.count += len(matrix)
+
+    def close(self, write_metadata=True):
+        """
+        Finish the embeddings file, and write the metadata.
+
+        :param write_metadata: if False, only close the embeddings file
+        :return:
+        """
+        if self._writer is None:
+            self._open(pyarrow_schema(dtype=self.dtype.value))
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+        if not write_metadata:
+            return
+        metadata_obj = _embeddings_metadata_dict(
+            self.ix, self.dimensions, self.count, self.hasher.hexdigest(), self.chunk_md5s, self.dtype, self.quantizer
+        )
+        _write_objects(metadata_obj, self.ix, self.metadata_path, self.objects_table)
+        _write_metadata(metadata_obj, self.metadata_path)
+        if self.id_hashes is not None:
+            with phase("write_id_map"):
+                hashes = np.concatenate(self.id_hashes) if self.id_hashes else np.empty(0, dtype=np.uint64)
+                IdMap.from_hashes(hashes).save(id_map_path(self.metadata_path))
+
+    def __enter__(self) -> "IndexWriter":
+        """Enter the context."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the writer; metadata is only written if there was no exception."""
+        self.close(write_metadata=exc_type is None)
+
 
-def save_index(ix: vx.Index, target: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.PARQUET, **kwargs):
+def sort_by_id(
+    ids: Union[np.ndarray, pa.Array, pa.ChunkedArray], matrix: np.ndarray
+) -> Tuple[Union[np.ndarray, pa.Array], np.ndarray]:
+    """
+    Sort the rows of an index by id.
+
+    Written sorted, each row group (and shard) covers its own range of ids, so that
+    reads of a prefix or a list of ids can skip the others by their statistics.
+
+    >>> ids, matrix = sort_by_id(np.array(["B", "A"]), np.array([[2.0], [1.0]]))
+    >>> ids.tolist(), matrix.tolist()
+    (['A', 'B'], [[1.0], [2.0]])
+
+    :param ids: (N,) ids
+    :param matrix: (N, D) matrix
+    :return: tuple of sorted ids, matrix
+    """
+    with phase("sort_ids", rows=len(ids)):
+        order = pc.sort_indices(_string_array(ids)).to_numpy()
+        if isinstance(ids, (pa.Array, pa.ChunkedArray)):
+            return ids.take(order), matrix[order]
+        return np.asarray(ids)[order], matrix[order]
+
+
+def _rows_to_write(ix: vx.Index, sort_ids=False) -> tuple:
+    if ix.embeddings_frame is None:
+        return None, None
+    ids, matrix = embeddings_matrix(ix)
+    if isinstance(ix.embeddings_frame, (pa.Table, pa.RecordBatch)):
+        # write the arrow ids as they are, rather than via python strings
+        ids = ix.embeddings_frame.column(ID)
+    if sort_ids:
+        ids, matrix = sort_by_id(ids, matrix)
+    return ids, matrix
+
+
+def _storage_quantizer(
+    dtype: StorageDtype, matrix: Optional[np.ndarray], quantizer: Optional[ScalarQuantizer]
+) -> Optional[ScalarQuantizer]:
+    # int8 storage uses the given quantizer, or one fitted to the rows
+    if dtype != StorageDtype.INT8 or matrix is None:
+        return None
+    return quantizer if quantizer is not None else ScalarQuantizer.fit(matrix)
+
+
+@profiled("save_index")
+def save_index(
+    ix: vx.Index,
+    target: Union[str, Path],
+    format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+    fixed_size=False,
+    row_group_size: Optional[int] = DEFAULT_ROW_GROUP_SIZE,
+    dtype: StorageDtype = StorageDtype.FLOAT32,
+    num_shards: Optional[int] = None,
+    workers: Optional[int] = None,
+    objects_table: Optional[bool] = None,
+    sort_ids=False,
+    quantizer: Optional[ScalarQuantizer] = None,
+    **kwargs,
+):
     """
     Save an index to a file.
 
+    Dual-file formats are written with an :class:`IndexWriter`; the embeddings frame of
+    the index is not modified.
+    The ARROW format always uses the fixed size list layout, written as a single
+    uncompressed record batch so that it can be memory mapped on load. For PARQUET,
+    ``fixed_size=True`` writes a ``fixed_size_list<float32, D>`` column without compression.
+
+    Dual-file formats can store the values as float16, or as int8 with a per-dimension
+    scale and offset fitted to the embeddings (``dtype``); the dtype is recorded in the
+    metadata as ``embeddings_dtype``.
+
+    With ``num_shards``, the embeddings of a dual-file format are split into that many
+    files, written in parallel, and listed in the metadata (see :func:`save_sharded_index`).
+
+    With ``objects_table``, the named objects of a dual-file format are written as a
+    parquet file next to the metadata (``objects_path``), and loaded as an
+    :class:`ObjectTable`, which is much faster than listing millions of objects in
+    the metadata yaml. By default, an index loaded from an objects table keeps one.
+
+    With ``sort_ids``, the rows of a dual-file format are written sorted by id (see
+    :func:`sort_by_id`), so that subsets by id prefix (see :mod:`venomx.tools.subset`)
+    only read the row groups holding them.
+
+    >>> import pandas as pd
     >>> num_entities = 100
     >>> embedding_dim = 50
     >>> entities = [f"X:{i}" for i in range(num_entities)]
@@ -159,44 +1670,255 @@ def save_index(ix: vx.Index, target: Union[str, Path], format: EmbeddingFormat =
 
     :param ix:
     :param target:
+    :param fixed_size: use a fixed size list layout for the values
+    :param row_group_size: maximum rows per parquet row group
+    :param dtype: storage dtype of the values
+    :param num_shards: number of embeddings files
+    :param workers: number of threads writing shards, default number of CPUs
+    :param objects_table: write the objects as a parquet table, for PARQUET and ARROW
+    :param sort_ids: write the rows sorted by id, for PARQUET and ARROW
+    :param quantizer: int8 quantizer, default fitted to the embeddings
     :param kwargs:
     :return:
     """
-    metadata_path, embeddings_path, ef = embeddings_file_tuple(target, exists_check=False)
-    all_in_one = format in [EmbeddingFormat.YAML, EmbeddingFormat.JSON]
-    metadata_obj = ix.model_dump(exclude_unset=True)
-    if all_in_one:
-        metadata_obj["embeddings"] = populate_embeddings_list(ix)
+    dtype = StorageDtype(dtype)
+    if objects_table and format not in SUFFIX_MAP:
+        raise ValueError(f"Objects tables are not supported for {format}")
+    if sort_ids and format not in SUFFIX_MAP:
+        raise ValueError(f"Sorting by id is not supported for {format}")
+    if num_shards and num_shards > 1 and format in SUFFIX_MAP:
+        save_sharded_index(
+            ix,
+            target,
+            format,
+            num_shards,
+            workers,
+            fixed_size,
+            row_group_size,
+            dtype,
+            objects_table,
+            sort_ids,
+            quantizer,
+        )
+    elif format in SUFFIX_MAP:
+        if format == EmbeddingFormat.ARROW:
+            row_group_size = None
+        ids, matrix = _rows_to_write(ix, sort_ids)
+        quantizer = _storage_quantizer(dtype, matrix, quantizer)
+        options = {"fixed_size": fixed_size, "row_group_size": row_group_size, "dtype": dtype, "quantizer": quantizer}
+        with IndexWriter(ix, target, format, objects_table=objects_table, **options) as writer:
+            if matrix is not None:
+                writer.write_batch(ids, matrix)
+    elif dtype != StorageDtype.FLOAT32:
+        raise ValueError(f"Reduced precision storage is not supported for {format}")
+    elif format == EmbeddingFormat.YAML:
+        metadata_obj = _metadata_dict(ix)
+        metadata_obj.pop("embeddings")
+        _write_bundled_yaml(metadata_obj, ix, target)
+    elif format == EmbeddingFormat.JSON:
+        metadata_obj = _metadata_dict(ix)
+        with phase("to_list"):
+            metadata_obj["embeddings"] = populate_embeddings_list(ix)
+        _write_metadata(metadata_obj, target, format)
     else:
-        metadata_obj["embeddings"] = None
-    metadata_obj["embeddings_frame"] = None
-    yaml.safe_dump(metadata_obj, open(metadata_path, "w", encoding="utf-8"), sort_keys=False)
-    if ix.embeddings_frame is not None:
-        if format == EmbeddingFormat.PARQUET:
-            df = ix.embeddings_frame
-            df["values"] = df["values"].apply(lambda x: pa.array(x, type=pa.float32()))
-            schema = pyarrow_schema()
-            table = pa.Table.from_pandas(df, schema=schema)
-            pq.write_table(table, str(embeddings_path))
-        elif all_in_one:
-            pass
-        else:
-            raise ValueError(f"Unsupported format: {format}")
+        raise ValueError(f"Unsupported format: {format}")
+
+
+def shard_path(metadata_path: Union[str, Path], i: int, num_shards: int, format: EmbeddingFormat) -> Path:
+    """
+    Get the path of a shard of an index.
+
+    >>> str(shard_path("tests/output/test.vx.yaml", 2, 4, EmbeddingFormat.PARQUET))
+    'tests/output/test.vx-00002-of-00004.parquet'
+
+    :param metadata_path: path to the metadata yaml
+    :param i: shard number
+    :param num_shards: number of shards
+    :param format: PARQUET or ARROW
+    :return:
+    """
+    path = Path(metadata_path)
+    return path.with_name(f"{path.stem}-{i:05d}-of-{num_shards:05d}{SUFFIX_MAP[format]}")
+
+
+def shard_paths(ix: vx.Index, metadata_path: Union[str, Path]) -> List[Path]:
+    """
+    Get the paths of the shards of a sharded index, in row order.
+
+    :param ix: index whose metadata lists the shards
+    :param metadata_path: path to the metadata yaml
+    :return:
+    """
+    parent = Path(metadata_path).parent
+    return [parent / shard.path for shard in ix.shards or []]
+
+
+def _write_shard(path: Path, format: EmbeddingFormat, ids: np.ndarray, matrix: np.ndarray, **kwargs) -> tuple:
+    """
+    Write one shard of an index, without metadata or id map.
+
+    :param path: path of the embeddings file
+    :param kwargs: passed to IndexWriter
+    :return: tuple of the shard record, and the chunk md5s
+    """
+    writer = IndexWriter(vx.Index(), path, format, id_map=False, **kwargs)
+    try:
+        with phase("write_shard", rows=len(ids)):
+            writer.write_batch(ids, matrix)
+    finally:
+        writer.close(write_metadata=False)
+    id_range = pc.min_max(pa.array(ids, type=pa.string()))
+    shard = {
+        "path": path.name,
+        "count": writer.count,
+        "min_id": id_range["min"].as_py(),
+        "max_id": id_range["max"].as_py(),
+        "md5": writer.hasher.hexdigest(),
+    }
+    return shard, writer.chunk_md5s
+
+
+def save_sharded_index(
+    ix: vx.Index,
+    target: Union[str, Path],
+    format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+    num_shards: int = 2,
+    workers: Optional[int] = None,
+    fixed_size=False,
+    row_group_size: Optional[int] = DEFAULT_ROW_GROUP_SIZE,
+    dtype: StorageDtype = StorageDtype.FLOAT32,
+    objects_table: Optional[bool] = None,
+    sort_ids=False,
+    quantizer: Optional[ScalarQuantizer] = None,
+):
+    """
+    Save an index as a metadata yaml plus a number of embeddings files, written in parallel.
+
+    Rows are split into contiguous ranges of (nearly) equal size. The metadata lists
+    the shards in row order, with their paths, row counts, id ranges and md5s. The
+    index ``md5`` is the same as for an unsharded index; the ``chunk_md5s`` are those of
+    the row groups of each shard in turn, which start again at every shard.
+
+    >>> ix = vx.Index()
+    >>> ix.embeddings_frame = {"id": np.array([f"X:{i}" for i in range(10)]), "values": np.eye(10)}
+    >>> save_sharded_index(ix, "tests/output/sharded.vx.yaml", num_shards=3)
+    >>> for shard in load_index("tests/output/sharded.vx.yaml").shards:
+    ...     print(shard.path, shard.count, shard.min_id, shard.max_id)
+    sharded.vx-00000-of-00003.parquet 3 X:0 X:2
+    sharded.vx-00001-of-00003.parquet 3 X:3 X:5
+    sharded.vx-00002-of-00003.parquet 4 X:6 X:9
+
+    :param ix:
+    :param target: path to the metadata yaml
+    :param format: PARQUET or ARROW
+    :param num_shards: number of embeddings files
+    :param workers: number of threads, default number of CPUs
+    :param fixed_size: use a fixed size list layout
+    :param row_group_size: maximum rows per row group
+    :param dtype: storage dtype of the values
+    :param objects_table: write the objects as a parquet table
+    :param sort_ids: sort the rows by id, so that each shard covers its own range of ids
+    :param quantizer: int8 quantizer, default fitted to the embeddings
+    :return:
+    """
+    format = EmbeddingFormat(format)
+    dtype = StorageDtype(dtype)
+    if format == EmbeddingFormat.ARROW:
+        row_group_size = None
+    metadata_path, _, _ = embeddings_file_tuple(target, format, exists_check=False)
+    ids, matrix = embeddings_matrix(ix)
+    if sort_ids:
+        ids, matrix = sort_by_id(ids, matrix)
+    num_shards = max(1, min(num_shards, len(ids)))
+    quantizer = _storage_quantizer(dtype, matrix, quantizer)
+    bounds = np.linspace(0, len(ids), num_shards + 1).astype(int)
+    options = {"fixed_size": fixed_size, "row_group_size": row_group_size, "dtype": dtype, "quantizer": quantizer}
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [
+            pool.submit(
+                _write_shard, shard_path(metadata_path, i, num_shards, format), format, ids[a:b], matrix[a:b], **options
+            )
+            for i, (a, b) in enumerate(zip(bounds[:-1], bounds[1:], strict=True))
+        ]
+        # the whole-index md5 and id map are computed while the shards are written
+        hasher = ContentHasher()
+        hasher.update(ids, to_storage(matrix, dtype, quantizer))
+        id_map = IdMap.build(ids)
+        results = [future.result() for future in futures]
+    shards = [shard for shard, _ in results]
+    chunk_md5s = [md5 for _, md5s in results for md5 in md5s]
+    metadata_obj = _embeddings_metadata_dict(
+        ix, matrix.shape[1], len(ids), hasher.hexdigest(), chunk_md5s, dtype, quantizer, shards=shards
+    )
+    _write_objects(metadata_obj, ix, metadata_path, objects_table)
+    _write_metadata(metadata_obj, metadata_path)
+    id_map.save(id_map_path(metadata_path))
+
+
+def _matrix_to_list_array(matrix: np.ndarray, dtype=np.float32) -> pa.ListArray:
+    """
+    Convert a (N, D) matrix to an arrow list<float32> array without per-row work.
+
+    >>> _matrix_to_list_array(np.zeros((2, 3))).to_pylist()
+    [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]
+
+    :param matrix:
+    :param dtype: dtype of the list values
+    :return:
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=dtype)
+    n, d = matrix.shape
+    offsets = pa.array(np.arange(n + 1, dtype=np.int32) * d)
+    return pa.ListArray.from_arrays(offsets, pa.array(matrix.reshape(-1)))
+
+
+def to_fixed_size_table(table: pa.Table) -> pa.Table:
+    """
+    Convert the values column of an embeddings table to a fixed size list of float32.
+
+    Each chunk of float32 values is converted without copying, by reinterpreting its
+    flat child array; other value types are cast.
+
+    >>> table = pa.table({"id": ["X:1"], "values": pa.array([[1.0, 2.0]], type=pa.list_(pa.float32()))})
+    >>> to_fixed_size_table(table).schema.field("values").type
+    FixedSizeListType(fixed_size_list<item: float>[2])
+
+    :param table: table using the default list schema
+    :return:
+    """
+    values = table.column(VALUES)
+    dimensions = None
+    chunks = []
+    for chunk in values.chunks:
+        if not len(chunk):
+            continue
+        dim = _list_chunk_dimension(chunk)
+        if dimensions is not None and dim != dimensions:
+            raise ValueError(f"Index has inconsistent embeddings lengths: {set([dimensions, dim])}")
+        dimensions = dim
+        flat = chunk.flatten()
+        if flat.null_count:
+            raise ValueError("Embeddings column contains null values")
+        chunks.append(pa.FixedSizeListArray.from_arrays(flat.cast(pa.float32()), dim))
+    schema = pyarrow_schema(dimensions)
+    if not chunks:
+        return schema.empty_table()
+    ids = table.column(ID).cast(pa.string())
+    return pa.Table.from_arrays([ids, pa.chunked_array(chunks, type=schema.field(VALUES).type)], schema=schema)
 
 
 def populate_embeddings_list(ix: vx.Index) -> List[Dict[str, list[float]]]:
     """
     Populate the embeddings list.
 
+    Values lists are marked to be written in YAML flow style, one line per embedding.
+
     :param ix:
     :return:
     """
+    embeddings = []
     if ix.embeddings_frame is not None:
-        embeddings = []
-        for _, row in ix.embeddings_frame.iterrows():
-            e = vx.Embedding(
-                id=row["id"],
-                values=row["values"],
-            )
-            embeddings.append({"id": row["id"], "values": row["values"]})
+        ids, matrix = embeddings_matrix(ix)
+        for id, values in zip(ids.tolist(), matrix.tolist(), strict=True):
+            embeddings.append({"id": str(id), "values": FlowList(values)})
     return embeddings
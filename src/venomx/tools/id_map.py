@@ -0,0 +1,230 @@
+"""A persisted, memory-mappable hash map from embedding ids to row offsets."""
+
+import logging
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ID_MAP_SUFFIX = ".ids.npy"
+SLOT_DTYPE = np.dtype([("hash", "<u8"), ("row", "<i8")])
+EMPTY = np.uint64(0)
+FNV_OFFSET = np.uint64(0xCBF29CE484222325)
+FNV_PRIME = np.uint64(0x100000001B3)
+HASH_BATCH_SIZE = 1_000_000
+
+
+def hash_ids(ids: Iterable[str]) -> np.ndarray:
+    """
+    Compute 64-bit FNV-1a hashes of the utf-8 bytes of a batch of ids, vectorized over the batch.
+
+    Hashes are never zero, as zero marks an empty slot.
+
+    >>> h = hash_ids(["HP:0000001", "HP:0000002", "HP:0000001"])
+    >>> h.dtype, bool(h[0] == h[2]), bool(h[0] == h[1])
+    (dtype('uint64'), True, False)
+
+    :param ids: ids
+    :return: (N,) uint64 hashes
+    """
+    ids = np.asarray(ids, dtype=str)
+    hashes = np.empty(len(ids), dtype=np.uint64)
+    for start in range(0, len(ids), HASH_BATCH_SIZE):
+        encoded = np.char.encode(ids[start : start + HASH_BATCH_SIZE], "utf-8")
+        lengths = np.char.str_len(encoded)
+        width = encoded.dtype.itemsize
+        data = encoded.view(np.uint8).reshape(len(encoded), width) if width else np.zeros((len(encoded), 0))
+        h = np.full(len(encoded), FNV_OFFSET, dtype=np.uint64)
+        for j in range(width):
+            active = lengths > j
+            h[active] = (h[active] ^ data[active, j].astype(np.uint64)) * FNV_PRIME
+        h[h == EMPTY] = 1
+        hashes[start : start + len(encoded)] = h
+    return hashes
+
+
+def id_map_path(metadata_path: Union[str, Path]) -> Path:
+    """
+    Get the path of the id map sidecar for an index metadata file.
+
+    >>> str(id_map_path("tests/output/test.vx.yaml"))
+    'tests/output/test.vx.ids.npy'
+
+    :param metadata_path: path to the metadata yaml
+    :return:
+    """
+    path = Path(metadata_path)
+    return path.with_name(path.stem + ID_MAP_SUFFIX)
+
+
+class IdMap:
+    """
+    An open addressing (linear probing) hash table from id hashes to row numbers.
+
+    The table is a single structured numpy array, at most half full, so it can be
+    saved as ``.npy`` and memory mapped. Lookups are vectorized over a batch of ids;
+    as only hashes are stored, callers should confirm the id at the returned row.
+
+    >>> m = IdMap.build(["A", "B", "C"])
+    >>> m.lookup(["C", "A", "Z"]).tolist()
+    [2, 0, -1]
+    """
+
+    def __init__(self, slots: np.ndarray):
+        """
+        Create a map over a table of slots.
+
+        :param slots: array of SLOT_DTYPE, whose length is a power of 2
+        """
+        self.slots = slots
+        self.mask = np.uint64(len(slots) - 1)
+
+    @property
+    def num_rows(self) -> int:
+        """Number of ids in the map."""
+        return int(np.count_nonzero(self.slots["hash"]))
+
+    @classmethod
+    def from_hashes(cls, hashes: np.ndarray, rows: Optional[np.ndarray] = None) -> "IdMap":
+        """
+        Build a map from precomputed id hashes.
+
+        :param hashes: (N,) uint64 hashes, see hash_ids
+        :param rows: (N,) row numbers, default 0..N-1
+        :return:
+        """
+        if rows is None:
+            rows = np.arange(len(hashes), dtype=np.int64)
+        capacity = 1 << max(1, int(2 * len(hashes) - 1).bit_length())
+        slots = np.zeros(capacity, dtype=SLOT_DTYPE)
+        mask = np.uint64(capacity - 1)
+        pending = np.arange(len(hashes))
+        positions = hashes & mask
+        while len(pending):
+            empty = slots["hash"][positions] == EMPTY
+            # of the pending items probing the same empty slot, the first claims it
+            candidates = np.flatnonzero(empty)
+            _, first = np.unique(positions[candidates], return_index=True)
+            claim = candidates[first]
+            slots["hash"][positions[claim]] = hashes[pending[claim]]
+            slots["row"][positions[claim]] = rows[pending[claim]]
+            keep = np.ones(len(pending), dtype=bool)
+            keep[claim] = False
+            pending = pending[keep]
+            positions = (positions[keep] + np.uint64(1)) & mask
+        return cls(slots)
+
+    @classmethod
+    def build(cls, ids: Iterable[str]) -> "IdMap":
+        """
+        Build a map from ids, in row order.
+
+        :param ids:
+        :return:
+        """
+        return cls.from_hashes(hash_ids(ids))
+
+    def lookup_hashes(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Look up rows for a batch of id hashes.
+
+        :param hashes: (Q,) uint64 hashes
+        :return: (Q,) row numbers, -1 where not found
+        """
+        rows = np.full(len(hashes), -1, dtype=np.int64)
+        pending = np.arange(len(hashes))
+        positions = hashes & self.mask
+        while len(pending):
+            slot_hashes = self.slots["hash"][positions]
+            found = slot_hashes == hashes[pending]
+            rows[pending[found]] = self.slots["row"][positions[found]]
+            keep = ~found & (slot_hashes != EMPTY)
+            pending = pending[keep]
+            positions = (positions[keep] + np.uint64(1)) & self.mask
+        return rows
+
+    def lookup(self, ids: Iterable[str]) -> np.ndarray:
+        """
+        Look up rows for a batch of ids.
+
+        :param ids:
+        :return: (Q,) row numbers, -1 where not found
+        """
+        return self.lookup_hashes(hash_ids(ids))
+
+    def save(self, path: Union[str, Path]):
+        """
+        Save as a ``.npy`` file.
+
+        :param path:
+        :return:
+        """
+        with open(path, "wb") as stream:
+            np.save(stream, self.slots, allow_pickle=False)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], memory_map=True) -> "IdMap":
+        """
+        Load a ``.npy`` file, memory mapped by default.
+
+        :param path:
+        :param memory_map:
+        :return:
+        """
+        return cls(np.load(str(path), mmap_mode="r" if memory_map else None, allow_pickle=False))
+
+
+def contract_uri(uri: str, prefix_map: dict) -> Optional[str]:
+    """
+    Contract a URI to a CURIE, using the longest matching namespace.
+
+    >>> contract_uri("http://purl.obolibrary.org/obo/HP_0000001", {"HP": "http://purl.obolibrary.org/obo/HP_"})
+    'HP:0000001'
+
+    :param uri:
+    :param prefix_map: prefix to namespace
+    :return: CURIE, or None if no namespace matches
+    """
+    best = None
+    for prefix, namespace in prefix_map.items():
+        if namespace and uri.startswith(namespace) and (best is None or len(namespace) > len(prefix_map[best])):
+            best = prefix
+    if best is None:
+        return None
+    return f"{best}:{uri[len(prefix_map[best]) :]}"
+
+
+def expand_curie(curie: str, prefix_map: dict) -> Optional[str]:
+    """
+    Expand a CURIE to a URI.
+
+    >>> expand_curie("HP:0000001", {"HP": "http://purl.obolibrary.org/obo/HP_"})
+    'http://purl.obolibrary.org/obo/HP_0000001'
+
+    :param curie:
+    :param prefix_map: prefix to namespace
+    :return: URI, or None if the prefix is unknown
+    """
+    prefix, sep, local = curie.partition(":")
+    if not sep or prefix not in prefix_map:
+        return None
+    return prefix_map[prefix] + local
+
+
+def alternative_ids(ids: List[str], prefix_map: dict) -> List[Optional[str]]:
+    """
+    Get the alternative form of each id: the CURIE of a URI, or the URI of a CURIE.
+
+    :param ids:
+    :param prefix_map: prefix to namespace
+    :return: alternative for each id, or None
+    """
+    alternatives = []
+    for x in ids:
+        alt = contract_uri(x, prefix_map)
+        if alt is None:
+            alt = expand_curie(x, prefix_map)
+        alternatives.append(alt)
+    return alternatives
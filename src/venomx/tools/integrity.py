@@ -0,0 +1,120 @@
+"""Integrity verification of index files against their recorded md5s."""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from venomx.model.embeddings_pa import ID, VALUES
+from venomx.tools.delta import segments_md5
+from venomx.tools.file_io import (
+    ContentHasher,
+    EmbeddingFormat,
+    LazyIndex,
+    content_md5,
+    iter_embeddings,
+    list_array_to_matrix,
+    open_index,
+    read_embeddings_table,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _read_chunk(path: Path, format: EmbeddingFormat, i: int) -> pa.Table:
+    """
+    Read one row group (or record batch), opening the file independently so chunks can be read in parallel.
+
+    :param path: embeddings file
+    :param format: PARQUET or ARROW
+    :param i: chunk number
+    :return:
+    """
+    if format == EmbeddingFormat.ARROW:
+        batch = pa.ipc.open_file(pa.memory_map(str(path))).get_batch(i)
+        return pa.Table.from_batches([batch]).select([ID, VALUES])
+    return pq.ParquetFile(str(path)).read_row_group(i, columns=[ID, VALUES])
+
+
+def _check_chunk(path: Path, i: int, format: EmbeddingFormat, expected: str) -> Dict:
+    table = _read_chunk(path, format, i)
+    actual = content_md5(table.column(ID), list_array_to_matrix(table.column(VALUES)))
+    return {"chunk": i, "path": str(path), "num_rows": table.num_rows, "expected": expected, "actual": actual}
+
+
+def _check_segments(lix: LazyIndex, workers: int) -> List[Dict]:
+    def check(generation, segment):
+        path = lix.metadata_path.parent / segment["path"]
+        table = read_embeddings_table(path, lix.format, columns=[ID, VALUES])
+        actual = content_md5(table.column(ID), list_array_to_matrix(table.column(VALUES)))
+        return {"segment": generation, "path": str(path), "expected": segment["md5"], "actual": actual}
+
+    segments = [(g, s) for g, s in enumerate(lix.metadata.get("segments") or [], start=1) if s.get("md5")]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda x: check(*x), segments))
+    return [r for r in results if r["expected"] != r["actual"]]
+
+
+def verify_index(
+    source: Union[str, Path], format: EmbeddingFormat = EmbeddingFormat.PARQUET, workers: Optional[int] = None
+) -> List[Dict]:
+    """
+    Verify the embeddings of an index against the md5s recorded in its metadata.
+
+    If the metadata has per-chunk md5s, chunks are hashed in parallel, and each
+    failure identifies the corrupted chunk; otherwise the whole-index md5 is
+    recomputed in a single streaming pass (and chained with the segments, see
+    :func:`segments_md5`). The files of delta segments are checked against their own md5s.
+
+    >>> from venomx.tools.file_io import IndexWriter
+    >>> import venomx as vx, numpy as np
+    >>> with IndexWriter(vx.Index(), "tests/output/verified.vx.yaml", row_group_size=10) as w:
+    ...     w.write_batch([f"X:{i}" for i in range(25)], np.ones((25, 3)))
+    >>> verify_index("tests/output/verified.vx.yaml")
+    []
+
+    :param source: path to the metadata yaml or the embeddings file
+    :param format: PARQUET or ARROW
+    :param workers: number of threads, default number of CPUs
+    :return: list of failures, each a dict with the chunk (or segment) number, first row, rows, expected and actual md5
+    """
+    lix = open_index(source, format)
+    metadata = lix.metadata
+    workers = workers or os.cpu_count()
+    failures = _check_segments(lix, workers)
+    if metadata.get("embeddings_count") is not None and metadata["embeddings_count"] != lix.num_rows:
+        failures.append({"chunk": None, "expected": metadata["embeddings_count"], "actual": lix.num_rows})
+    chunk_md5s = metadata.get("chunk_md5s") or []
+    if chunk_md5s:
+        locations = lix.chunk_locations()
+        if len(chunk_md5s) != len(locations):
+            failures.append({"chunk": None, "expected": len(chunk_md5s), "actual": len(locations)})
+            return failures
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(
+                pool.map(
+                    lambda location, expected: _check_chunk(*location, lix.format, expected), locations, chunk_md5s
+                )
+            )
+        first_row = 0
+        for chunk, result in enumerate(results):
+            result["chunk"] = chunk
+            result["first_row"] = first_row
+            first_row += result["num_rows"]
+            if result["expected"] != result["actual"]:
+                failures.append(result)
+        return failures
+    if metadata.get("md5"):
+        hasher = ContentHasher()
+        for ids, matrix in iter_embeddings(lix.metadata_path, format=lix.format, apply_segments=False):
+            hasher.update(ids, matrix)
+        actual = segments_md5(hasher.hexdigest(), metadata.get("segments") or [])
+        if actual != metadata["md5"]:
+            failures.append({"chunk": None, "expected": metadata["md5"], "actual": actual})
+        return failures
+    logger.warning(f"No md5 recorded for {source}, nothing to verify")
+    return failures
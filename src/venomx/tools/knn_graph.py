@@ -0,0 +1,236 @@
+"""Top-k neighbour graphs of all the embeddings of an index, within the index or against another index."""
+
+import logging
+import math
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Deque, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import venomx as vx
+from venomx.tools.constants import SearchMetric
+from venomx.tools.file_io import embeddings_codes, embeddings_matrix
+from venomx.tools.profiling import count, phase, profiled
+from venomx.tools.search import (
+    BYTES_PER_CELL,
+    DEFAULT_MEMORY_BUDGET,
+    DEFAULT_QUERY_BATCH_SIZE,
+    ExactSearcher,
+    QuantizedSearcher,
+    top_k,
+    top_k_merge,
+)
+
+logger = logging.getLogger(__name__)
+
+SOURCE_ID = "source_id"
+TARGET_ID = "target_id"
+SCORE = "score"
+GRAPH_SCHEMA = pa.schema([(SOURCE_ID, pa.string()), (TARGET_ID, pa.string()), (SCORE, pa.float32())])
+
+
+def tile_shape(
+    num_sources: int, num_targets: int, memory_budget: int = DEFAULT_MEMORY_BUDGET, workers: int = 1
+) -> Tuple[int, int]:
+    """
+    Get the number of source and target rows of the score tiles, so that the tiles of all workers fit a memory budget.
+
+    >>> tile_shape(100_000, 100_000, memory_budget=64 * 2**20, workers=4)
+    (1024, 1024)
+    >>> tile_shape(10, 100_000, memory_budget=64 * 2**20, workers=4)
+    (10, 100000)
+
+    :param num_sources: number of source rows
+    :param num_targets: number of target rows
+    :param memory_budget: bytes for the score tiles of all workers
+    :param workers: number of tiles scored at a time
+    :return: tuple of source rows, target rows
+    """
+    cells = max(1, memory_budget // (BYTES_PER_CELL * max(1, workers)))
+    source_rows = max(1, min(num_sources, DEFAULT_QUERY_BATCH_SIZE, math.isqrt(cells)))
+    target_rows = max(1, min(num_targets, cells // source_rows))
+    return source_rows, target_rows
+
+
+def _searcher(ix: vx.Index, metric: SearchMetric):
+    quantized = embeddings_codes(ix)
+    if quantized is not None:
+        return QuantizedSearcher(*quantized, metric=metric)
+    return ExactSearcher(*embeddings_matrix(ix), metric=metric)
+
+
+class KnnGraphBuilder:
+    """
+    Computes the top k targets of every source vector, one tile of the score matrix at a time.
+
+    Blocks of source rows are scored against blocks of target rows, keeping a running
+    top k per source row, so memory is bounded by the tile size rather than the number
+    of rows. Source blocks are scored in a thread pool (the matrix products and
+    partitions release the GIL), and returned in order.
+
+    >>> ix = vx.Index()
+    >>> ix.embeddings_frame = {"id": np.array(["A", "B", "C"]), "values": np.array([[1.0, 0], [0.9, 0.1], [0, 1.0]])}
+    >>> for batch in KnnGraphBuilder(ix, k=1).batches():
+    ...     print(batch.to_pydict())
+    {'source_id': ['A', 'B', 'C'], 'target_id': ['B', 'A', 'B'], 'score': [0.9938837289810181, 0.9938837289810181, 0.11043152958154678]}
+    """
+
+    def __init__(
+        self,
+        source: vx.Index,
+        target: Optional[vx.Index] = None,
+        k: int = 10,
+        metric: SearchMetric = SearchMetric.COSINE,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        workers: Optional[int] = None,
+        exclude_self: Optional[bool] = None,
+        threshold: Optional[float] = None,
+    ):
+        """
+        Create a builder.
+
+        :param source: index whose rows are the sources
+        :param target: index whose rows are the targets, default the source index
+        :param k: number of targets per source
+        :param metric: similarity metric; euclidean scores are distances
+        :param memory_budget: bytes for the score tiles of all workers
+        :param workers: number of threads, default number of CPUs
+        :param exclude_self: skip the row itself as a target; default if there is no target index
+        :param threshold: only keep scores at least this (at most, for euclidean distances)
+        """
+        self.metric = SearchMetric(metric)
+        self.k = k
+        self.workers = workers or os.cpu_count() or 1
+        self.exclude_self = target is None if exclude_self is None else exclude_self
+        self.threshold = threshold
+        self.source_ids, self.source_matrix = embeddings_matrix(source)
+        self.searcher = _searcher(source if target is None else target, self.metric)
+        if self.searcher.matrix.shape[1] != self.source_matrix.shape[1]:
+            raise ValueError(
+                f"Source dimensions {self.source_matrix.shape[1]} != target dimensions {self.searcher.matrix.shape[1]}"
+            )
+        self.largest = self.metric != SearchMetric.EUCLIDEAN
+        self.source_rows, self.target_rows = tile_shape(
+            len(self.source_ids), len(self.searcher.ids), memory_budget, self.workers
+        )
+        self._source_id_array = pa.array(self.source_ids, type=pa.string())
+        self._target_id_array = pa.array(self.searcher.ids, type=pa.string())
+
+    def neighbours(self, start: int, stop: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Compute the top k targets of a block of source rows.
+
+        :param start: first source row
+        :param stop: end of the source rows
+        :return: tuple of (B, k) target rows and (B, k) scores, best first; excluded entries have non-finite scores
+        """
+        queries = self.source_matrix[start:stop]
+        worst = -np.inf if self.largest else np.inf
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for a in range(0, len(self.searcher.ids), self.target_rows):
+            b = min(a + self.target_rows, len(self.searcher.ids))
+            scores = self.searcher.scores(queries, rows=slice(a, b))
+            if self.exclude_self:
+                # the diagonal of the full matrix, where a source row meets itself as a target
+                columns = np.arange(start, stop) - a
+                inside = np.flatnonzero((columns >= 0) & (columns < b - a))
+                scores[inside, columns[inside]] = worst
+            rows, scores = top_k(scores, self.k, largest=self.largest)
+            rows, scores = top_k_merge(best_rows, best_scores, rows + a, scores, self.k, self.largest)
+            best_rows, best_scores = rows, scores
+        if self.metric == SearchMetric.EUCLIDEAN:
+            np.sqrt(best_scores, out=best_scores)
+        return best_rows, best_scores
+
+    def _batch(self, start: int, rows: np.ndarray, scores: np.ndarray) -> pa.RecordBatch:
+        keep = np.isfinite(scores)
+        if self.threshold is not None:
+            keep &= scores >= self.threshold if self.largest else scores <= self.threshold
+        sources = np.broadcast_to(np.arange(start, start + len(rows))[:, None], rows.shape)[keep]
+        return pa.RecordBatch.from_arrays(
+            [self._source_id_array.take(sources), self._target_id_array.take(rows[keep]), pa.array(scores[keep])],
+            schema=GRAPH_SCHEMA,
+        )
+
+    def batches(self) -> Iterator[pa.RecordBatch]:
+        """
+        Compute the graph, one record batch of (source_id, target_id, score) rows per block of source rows.
+
+        Rows are in source order, and best first for each source; at most ``2 * workers``
+        blocks are computed ahead of the consumer.
+
+        :return:
+        """
+        logger.info(
+            f"k-NN graph of {len(self.source_ids)} x {len(self.searcher.ids)} rows, "
+            f"in tiles of {self.source_rows} x {self.target_rows}, with {self.workers} workers"
+        )
+        pending: Deque[Tuple[int, Future]] = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for start in range(0, len(self.source_ids), self.source_rows):
+                if len(pending) >= 2 * self.workers:
+                    yield self._collect(pending)
+                stop = min(start + self.source_rows, len(self.source_ids))
+                pending.append((start, pool.submit(self.neighbours, start, stop)))
+            while pending:
+                yield self._collect(pending)
+
+    def _collect(self, pending: Deque[Tuple[int, Future]]) -> pa.RecordBatch:
+        start, future = pending.popleft()
+        return self._batch(start, *future.result())
+
+
+def knn_graph(source: vx.Index, target: Optional[vx.Index] = None, k: int = 10, **kwargs) -> pa.Table:
+    """
+    Compute the top k neighbours of every embedding of an index, in memory.
+
+    With a target index, the neighbours are found in the target (e.g. to match the
+    terms of two ontologies); otherwise in the index itself, excluding each row itself.
+
+    >>> ix = vx.Index()
+    >>> ix.embeddings_frame = {"id": np.array(["A", "B", "C"]), "values": np.eye(3)}
+    >>> knn_graph(ix, k=1, metric=SearchMetric.EUCLIDEAN).column("score").to_pylist()
+    [1.4142135381698608, 1.4142135381698608, 1.4142135381698608]
+
+    :param source:
+    :param target:
+    :param k: number of neighbours per embedding
+    :param kwargs: passed to KnnGraphBuilder (metric, memory_budget, workers, exclude_self, threshold)
+    :return: table of source_id, target_id, score
+    """
+    batches: List[pa.RecordBatch] = list(KnnGraphBuilder(source, target, k, **kwargs).batches())
+    return pa.Table.from_batches(batches, schema=GRAPH_SCHEMA)
+
+
+@profiled("knn_graph")
+def save_knn_graph(
+    source: vx.Index, path: Union[str, Path], target: Optional[vx.Index] = None, k: int = 10, **kwargs
+) -> int:
+    """
+    Compute the top k neighbours of every embedding of an index, streaming them to a parquet file.
+
+    Each block of source rows is written as a row group as soon as it is computed, so
+    only a few blocks of results are held in memory.
+
+    :param source:
+    :param path: parquet file to write
+    :param target: index to find neighbours in, default the source index
+    :param k: number of neighbours per embedding
+    :param kwargs: passed to KnnGraphBuilder (metric, memory_budget, workers, exclude_self, threshold)
+    :return: number of rows written
+    """
+    builder = KnnGraphBuilder(source, target, k, **kwargs)
+    num_rows = 0
+    with pq.ParquetWriter(str(path), GRAPH_SCHEMA) as writer:
+        for batch in builder.batches():
+            with phase("write_graph", nbytes=batch.nbytes, rows=batch.num_rows):
+                writer.write_batch(batch)
+            num_rows += batch.num_rows
+    count(rows=num_rows)
+    return num_rows
@@ -0,0 +1,111 @@
+"""Lookup of embeddings by id."""
+
+import logging
+import weakref
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+
+import venomx as vx
+from venomx.tools.file_io import embeddings_ids, embeddings_rows
+from venomx.tools.id_map import IdMap, alternative_ids
+
+logger = logging.getLogger(__name__)
+
+_id_map_registry: Dict[int, Tuple[weakref.ref, int, IdMap]] = {}
+
+
+def attach_id_map(ix: vx.Index, id_map: IdMap):
+    """
+    Attach an id map (e.g. loaded from the sidecar of an index) to an index.
+
+    :param ix:
+    :param id_map:
+    :return:
+    """
+    key = id(ix)
+    _id_map_registry[key] = (
+        weakref.ref(ix, lambda _: _id_map_registry.pop(key, None)),
+        id(ix.embeddings_frame),
+        id_map,
+    )
+
+
+def get_id_map(ix: vx.Index) -> IdMap:
+    """
+    Get the id map of an index, building and caching one if none is attached.
+
+    :param ix:
+    :return:
+    """
+    entry = _id_map_registry.get(id(ix))
+    if entry is not None and entry[0]() is ix and entry[1] == id(ix.embeddings_frame):
+        return entry[2]
+    id_map = IdMap.build(embeddings_ids(ix))
+    attach_id_map(ix, id_map)
+    return id_map
+
+
+def _prefix_map(ix: vx.Index) -> dict:
+    return {p.prefix: p.namespace for p in ix.prefixes or [] if p.prefix and p.namespace}
+
+
+def get_rows(ix: vx.Index, ids: Iterable[str]) -> np.ndarray:
+    """
+    Get the embedding row numbers for a batch of ids.
+
+    Ids that are not found as given are retried in their alternative form, using the
+    prefixes of the index: URIs are contracted to CURIEs, and CURIEs expanded to URIs.
+
+    :param ix:
+    :param ids:
+    :return: (Q,) row numbers, -1 where not found
+    """
+    ids = [str(x) for x in ids]
+    index_ids = embeddings_ids(ix)
+    id_map = get_id_map(ix)
+
+    def _confirmed(query_ids, rows):
+        # only hashes are stored in the map; check the ids of the matched rows
+        rows[rows >= len(index_ids)] = -1
+        hit = rows >= 0
+        mismatched = np.flatnonzero(hit)[index_ids[rows[hit]].astype(str) != np.asarray(query_ids, dtype=str)[hit]]
+        rows[mismatched] = -1
+        return rows
+
+    rows = _confirmed(ids, id_map.lookup(ids))
+    missing = np.flatnonzero(rows < 0)
+    prefix_map = _prefix_map(ix)
+    if len(missing) and prefix_map:
+        alternatives = alternative_ids([ids[i] for i in missing], prefix_map)
+        retry = [(i, alt) for i, alt in zip(missing, alternatives, strict=True) if alt is not None]
+        if retry:
+            alt_ids = [alt for _, alt in retry]
+            rows[[i for i, _ in retry]] = _confirmed(alt_ids, id_map.lookup(alt_ids))
+    return rows
+
+
+def get_vectors(ix: vx.Index, ids: Iterable[str], strict=True) -> np.ndarray:
+    """
+    Get the embeddings for a batch of ids, as one gathered matrix.
+
+    >>> ix = vx.Index(prefixes=[{"prefix": "HP", "namespace": "http://purl.obolibrary.org/obo/HP_"}])
+    >>> ix.embeddings_frame = {"id": np.array(["HP:1", "HP:2"]), "values": np.eye(2)}
+    >>> get_vectors(ix, ["HP:2", "http://purl.obolibrary.org/obo/HP_1"]).tolist()
+    [[0.0, 1.0], [1.0, 0.0]]
+
+    :param ix:
+    :param ids:
+    :param strict: raise a KeyError for ids that are not found; otherwise their rows are NaN
+    :return: (Q, D) float32 matrix
+    """
+    ids = list(ids)
+    rows = get_rows(ix, ids)
+    missing = rows < 0
+    if missing.any() and strict:
+        raise KeyError(f"Not in index: {[x for x, m in zip(ids, missing, strict=True) if m]}")
+    if missing.all():
+        return np.full((len(ids), ix.embeddings_dimensions or 0), np.nan, dtype=np.float32)
+    vectors = embeddings_rows(ix, np.where(missing, rows.max(), rows))
+    vectors[missing] = np.nan
+    return vectors
@@ -0,0 +1,307 @@
+"""Lightweight timing and byte-count hooks for the phases of loading, saving and validating indexes."""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+_DISABLED = nullcontext()
+_profiler: Optional["Profiler"] = None
+
+
+class Phase:
+    """
+    A timed phase of an operation, with the bytes and rows it processed.
+
+    Created by :meth:`Profiler.phase`, and used as a context manager.
+    """
+
+    __slots__ = ("profiler", "name", "start", "end", "nbytes", "rows", "thread", "depth")
+
+    def __init__(self, profiler: "Profiler", name: str, nbytes: int = 0, rows: int = 0):
+        """
+        Create a phase.
+
+        :param profiler: profiler recording the phase
+        :param name: name of the phase
+        :param nbytes: bytes read or written, if known at the start
+        :param rows: rows processed, if known at the start
+        """
+        self.profiler = profiler
+        self.name = name
+        self.nbytes = nbytes
+        self.rows = rows
+        self.start = self.end = None
+        self.thread = threading.get_ident()
+        self.depth = 0
+
+    def __enter__(self) -> "Phase":
+        """Start timing."""
+        stack = self.profiler._stack()
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop timing, and record the phase."""
+        self.end = time.perf_counter()
+        self.profiler._stack().pop()
+        with self.profiler._lock:
+            self.profiler.phases.append(self)
+
+    @property
+    def seconds(self) -> float:
+        """Duration of the phase."""
+        return self.end - self.start
+
+
+class Profiler:
+    """
+    Records the phases of operations, across threads.
+
+    >>> profiler = Profiler()
+    >>> with profiler.phase("load"):
+    ...     with profiler.phase("parse", nbytes=100):
+    ...         pass
+    >>> [(p["name"], p["calls"], p["bytes"]) for p in profiler.summary()]
+    [('load', 1, 0), ('parse', 1, 100)]
+    """
+
+    def __init__(self):
+        """Create a profiler with no phases."""
+        self.phases: List[Phase] = []
+        self.origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self) -> List[Phase]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def phase(self, name: str, nbytes: int = 0, rows: int = 0) -> Phase:
+        """
+        Time a phase, nested in the current phase of the thread, if any.
+
+        :param name:
+        :param nbytes: bytes read or written, if known at the start
+        :param rows: rows processed, if known at the start
+        :return: context manager
+        """
+        return Phase(self, name, nbytes, rows)
+
+    def count(self, nbytes: int = 0, rows: int = 0):
+        """
+        Add bytes or rows to the current phase of the thread.
+
+        :param nbytes:
+        :param rows:
+        :return:
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1].nbytes += nbytes
+            stack[-1].rows += rows
+
+    def summary(self) -> List[Dict]:
+        """
+        Aggregate the phases by name, in order of first start.
+
+        Nested phases are included in the time of their parents.
+
+        :return: one dict per name, with the number of calls, total seconds, bytes and rows, and nesting depth
+        """
+        totals: Dict[str, Dict] = {}
+        for p in sorted(self.phases, key=lambda p: p.start):
+            entry = totals.setdefault(
+                p.name, {"name": p.name, "depth": p.depth, "calls": 0, "seconds": 0.0, "bytes": 0, "rows": 0}
+            )
+            entry["calls"] += 1
+            entry["seconds"] += p.seconds
+            entry["bytes"] += p.nbytes
+            entry["rows"] += p.rows
+            entry["depth"] = min(entry["depth"], p.depth)
+        return list(totals.values())
+
+    def to_dict(self) -> Dict:
+        """
+        Convert to a dictionary, with the summary and every phase, e.g. for serialization as json.
+
+        :return:
+        """
+        return {
+            "summary": self.summary(),
+            "phases": [
+                {
+                    "name": p.name,
+                    "start": p.start - self.origin,
+                    "seconds": p.seconds,
+                    "bytes": p.nbytes,
+                    "rows": p.rows,
+                    "thread": p.thread,
+                    "depth": p.depth,
+                }
+                for p in sorted(self.phases, key=lambda p: p.start)
+            ],
+        }
+
+    def to_chrome_trace(self) -> Dict:
+        """
+        Convert to the Chrome trace event format, as read by chrome://tracing and Perfetto.
+
+        :return:
+        """
+        pid = os.getpid()
+        events = [
+            {
+                "name": p.name,
+                "ph": "X",
+                "ts": (p.start - self.origin) * 1e6,
+                "dur": p.seconds * 1e6,
+                "pid": pid,
+                "tid": p.thread,
+                "args": {"bytes": p.nbytes, "rows": p.rows},
+            }
+            for p in sorted(self.phases, key=lambda p: p.start)
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path: Union[str, Path], chrome=False):
+        """
+        Save as json.
+
+        :param path:
+        :param chrome: use the Chrome trace event format
+        :return:
+        """
+        with open(path, "w", encoding="utf-8") as stream:
+            json.dump(self.to_chrome_trace() if chrome else self.to_dict(), stream, indent=2)
+
+    def __str__(self) -> str:
+        """Format the summary as a table, nested phases indented."""
+        lines = [f"{'phase':<40}{'calls':>8}{'seconds':>12}{'MB':>10}{'rows':>12}"]
+        for entry in self.summary():
+            name = "  " * entry["depth"] + entry["name"]
+            lines.append(
+                f"{name:<40}{entry['calls']:>8}{entry['seconds']:>12.4f}"
+                f"{entry['bytes'] / 2**20:>10.1f}{entry['rows']:>12}"
+            )
+        return "\n".join(lines)
+
+
+def enable() -> Profiler:
+    """
+    Start recording phases, with a new profiler.
+
+    :return: the profiler
+    """
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable() -> Optional[Profiler]:
+    """
+    Stop recording phases.
+
+    :return: the profiler that was recording, if any
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def get_profiler() -> Optional[Profiler]:
+    """Get the profiler recording phases, if any."""
+    return _profiler
+
+
+@contextmanager
+def profiling() -> Iterator[Profiler]:
+    """
+    Record phases within a block.
+
+    >>> with profiling() as profiler:
+    ...     with phase("work", rows=3):
+    ...         pass
+    >>> [p["name"] for p in profiler.summary()], get_profiler() is None
+    (['work'], True)
+    """
+    profiler = enable()
+    try:
+        yield profiler
+    finally:
+        disable()
+
+
+def phase(name: str, nbytes: int = 0, rows: int = 0):
+    """
+    Time a phase, if profiling is enabled; otherwise a shared no-op context manager.
+
+    :param name:
+    :param nbytes: bytes read or written, if known at the start
+    :param rows: rows processed, if known at the start
+    :return: context manager
+    """
+    profiler = _profiler
+    if profiler is None:
+        return _DISABLED
+    return profiler.phase(name, nbytes, rows)
+
+
+def profiled(name: str) -> Callable:
+    """
+    Decorate a function, timing each call as a phase if profiling is enabled.
+
+    :param name: name of the phase
+    :return: decorator
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.phase(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(nbytes: int = 0, rows: int = 0):
+    """
+    Add bytes or rows to the current phase, if profiling is enabled.
+
+    :param nbytes:
+    :param rows:
+    :return:
+    """
+    profiler = _profiler
+    if profiler is not None:
+        profiler.count(nbytes, rows)
+
+
+def file_size(path: Union[str, Path]) -> int:
+    """
+    Get the size of a file, or 0 if profiling is disabled, so callers don't pay for the stat.
+
+    :param path:
+    :return:
+    """
+    if _profiler is None:
+        return 0
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
@@ -0,0 +1,131 @@
+"""Reduced precision storage of embeddings: float16, and per-dimension int8 scalar quantization."""
+
+from __future__ import annotations
+
+import logging
+from typing import Optional
+
+import numpy as np
+
+import venomx as vx
+from venomx.tools.constants import StorageDtype
+
+logger = logging.getLogger(__name__)
+
+INT8_MAX = 127
+
+
+class ScalarQuantizer:
+    """
+    Per-dimension int8 scalar quantization.
+
+    Each dimension is mapped linearly onto [-127, 127]; a value is recovered as
+    ``code * scale + offset``. The scale and offset are stored in the index metadata
+    (``quantization_scale``, ``quantization_offset``).
+
+    >>> matrix = np.array([[0.0, -1.0], [1.0, 1.0], [0.5, 0.0]])
+    >>> q = ScalarQuantizer.fit(matrix)
+    >>> q.encode(matrix).tolist()
+    [[-127, -127], [127, 127], [0, 0]]
+    >>> bool(np.abs(q.decode(q.encode(matrix)) - matrix).max() < 0.01)
+    True
+    """
+
+    def __init__(self, scale: np.ndarray, offset: np.ndarray):
+        """
+        Create a quantizer.
+
+        :param scale: (D,) scale of each dimension
+        :param offset: (D,) offset of each dimension
+        """
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+
+    @classmethod
+    def fit(cls, matrix: np.ndarray) -> "ScalarQuantizer":
+        """
+        Fit the scale and offset of each dimension to the range of its values.
+
+        :param matrix: (N, D) matrix
+        :return:
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if not len(matrix):
+            return cls(np.ones(matrix.shape[1], dtype=np.float32), np.zeros(matrix.shape[1], dtype=np.float32))
+        low = np.nanmin(matrix, axis=0)
+        high = np.nanmax(matrix, axis=0)
+        scale = (high - low) / (2 * INT8_MAX)
+        scale[scale == 0] = 1.0
+        return cls(scale, (high + low) / 2)
+
+    @classmethod
+    def from_index(cls, ix: vx.Index) -> Optional["ScalarQuantizer"]:
+        """
+        Get the quantizer recorded in the metadata of an index, if any.
+
+        :param ix:
+        :return:
+        """
+        if ix.embeddings_dtype != StorageDtype.INT8.value or not ix.quantization_scale:
+            return None
+        return cls(ix.quantization_scale, ix.quantization_offset)
+
+    def encode(self, matrix: np.ndarray) -> np.ndarray:
+        """
+        Quantize a matrix; values outside the fitted range are clipped.
+
+        :param matrix: (N, D) matrix
+        :return: (N, D) int8 codes
+        """
+        codes = (np.asarray(matrix, dtype=np.float32) - self.offset) / self.scale
+        np.rint(codes, out=codes)
+        np.clip(codes, -INT8_MAX, INT8_MAX, out=codes)
+        return codes.astype(np.int8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Dequantize codes.
+
+        :param codes: (N, D) int8 codes
+        :return: (N, D) float32 matrix
+        """
+        matrix = np.asarray(codes, dtype=np.float32) * self.scale
+        matrix += self.offset
+        return matrix
+
+
+def to_storage(matrix: np.ndarray, dtype: StorageDtype, quantizer: Optional[ScalarQuantizer] = None) -> np.ndarray:
+    """
+    Convert a matrix to a storage dtype.
+
+    >>> to_storage(np.ones((1, 2)), StorageDtype.FLOAT16).dtype
+    dtype('float16')
+
+    :param matrix: (N, D) matrix
+    :param dtype: storage dtype
+    :param quantizer: quantizer, required for INT8
+    :return: (N, D) matrix of the storage dtype
+    """
+    dtype = StorageDtype(dtype)
+    if dtype == StorageDtype.INT8:
+        if quantizer is None:
+            raise ValueError("A quantizer is required for int8 storage")
+        return quantizer.encode(matrix)
+    return np.ascontiguousarray(matrix, dtype=dtype.value)
+
+
+def dequantize(ix: vx.Index, matrix: np.ndarray) -> np.ndarray:
+    """
+    Convert a matrix in the storage dtype of an index to float32.
+
+    Float32 matrices are returned as is, without copying.
+
+    :param ix: index whose metadata records the storage dtype
+    :param matrix: (N, D) matrix as stored
+    :return: (N, D) float32 matrix
+    """
+    if matrix.dtype == np.int8:
+        quantizer = ScalarQuantizer.from_index(ix)
+        if quantizer is not None:
+            return quantizer.decode(matrix)
+    return np.asarray(matrix, dtype=np.float32)
@@ -0,0 +1,482 @@
+"""Nearest neighbour search over the embeddings of an index."""
+
+import logging
+import operator
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import venomx as vx
+from venomx.tools.constants import SearchMetric
+from venomx.tools.file_io import embeddings_codes, embeddings_matrix
+from venomx.tools.quantization import ScalarQuantizer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERY_BATCH_SIZE = 1024
+DEFAULT_BLOCK_ROWS = 16384
+DEFAULT_MEMORY_BUDGET = 256 * 2**20
+# a float32 score, its negated copy, and an int64 argpartition index per cell of a tile
+BYTES_PER_CELL = 16
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    L2-normalize the rows of a matrix, leaving all-zero rows as zero.
+
+    >>> normalize_rows(np.array([[3.0, 4.0], [0.0, 0.0]])).tolist()
+    [[0.6000000238418579, 0.800000011920929], [0.0, 0.0]]
+
+    :param matrix:
+    :return: float32 matrix
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k(scores: np.ndarray, k: int, largest=True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the top k columns for each row of a score matrix, best first.
+
+    Uses argpartition, so only the k selected entries of each row are sorted.
+
+    >>> ix, sc = top_k(np.array([[0.1, 0.9, 0.5]]), 2)
+    >>> ix.tolist(), sc.tolist()
+    ([[1, 2]], [[0.9, 0.5]])
+
+    :param scores: (Q, N) matrix
+    :param k: number of columns to keep
+    :param largest: if False, keep the smallest scores
+    :return: tuple of (Q, k) column indexes and (Q, k) scores
+    """
+    n = scores.shape[1]
+    k = min(k, n)
+    keyed = -scores if largest else scores
+    if k < n:
+        part = np.argpartition(keyed, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(n), scores.shape).copy()
+    part_keys = np.take_along_axis(keyed, part, axis=1)
+    order = np.argsort(part_keys, axis=1, kind="stable")
+    indexes = np.take_along_axis(part, order, axis=1)
+    return indexes, np.take_along_axis(scores, indexes, axis=1)
+
+
+def top_k_merge(
+    rows: np.ndarray, scores: np.ndarray, other_rows: np.ndarray, other_scores: np.ndarray, k: int, largest=True
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge two top k lists per row into one.
+
+    >>> rows, scores = top_k_merge(np.array([[3, 1]]), np.array([[0.9, 0.5]]), np.array([[7]]), np.array([[0.7]]), 2)
+    >>> rows.tolist(), scores.tolist()
+    ([[3, 7]], [[0.9, 0.7]])
+
+    :param rows: (B, k1) rows
+    :param scores: (B, k1) scores
+    :param other_rows: (B, k2) rows
+    :param other_scores: (B, k2) scores
+    :param k: number of entries to keep
+    :param largest: if False, keep the smallest scores
+    :return: tuple of (B, min(k, k1 + k2)) rows and scores, best first
+    """
+    rows = np.concatenate([rows, other_rows], axis=1)
+    scores = np.concatenate([scores, other_scores], axis=1)
+    if not rows.shape[1]:
+        return rows, scores
+    indexes, scores = top_k(scores, k, largest=largest)
+    return np.take_along_axis(rows, indexes, axis=1), scores
+
+
+class ExactSearcher:
+    """
+    Brute-force searcher over a float32 matrix.
+
+    The stored matrix is prepared once for the metric (normalized for cosine, squared
+    norms for euclidean), and queries are scored in batches with a matrix product.
+
+    >>> s = ExactSearcher(np.array(["A", "B"]), np.array([[1.0, 0.0], [0.0, 1.0]]))
+    >>> ids, scores = s.search(np.array([[0.9, 0.1]]), k=1)
+    >>> ids.tolist()
+    [['A']]
+    """
+
+    def __init__(self, ids: np.ndarray, matrix: np.ndarray, metric: SearchMetric = SearchMetric.COSINE):
+        """
+        Create a searcher.
+
+        :param ids: (N,) ids
+        :param matrix: (N, D) embeddings
+        :param metric: similarity metric
+        """
+        self.ids = np.asarray(ids)
+        self.metric = SearchMetric(metric)
+        if self.metric == SearchMetric.COSINE:
+            self.matrix = normalize_rows(matrix)
+        else:
+            self.matrix = np.asarray(matrix, dtype=np.float32)
+        self.squared_norms = None
+        if self.metric == SearchMetric.EUCLIDEAN:
+            self.squared_norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+
+    def scores(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Score a batch of queries against all stored vectors, or a subset of rows.
+
+        For euclidean, the score is the squared distance (lower is better).
+
+        :param queries: (Q, D) matrix
+        :param rows: optional row numbers to restrict scoring to
+        :return: (Q, N) matrix, or (Q, len(rows))
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.metric == SearchMetric.COSINE:
+            queries = normalize_rows(queries)
+        products = self._products(queries, rows)
+        if self.metric != SearchMetric.EUCLIDEAN:
+            return products
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        squared_norms = self.squared_norms if rows is None else self.squared_norms[rows]
+        distances = query_norms[:, None] - 2 * products + squared_norms[None, :]
+        return np.maximum(distances, 0, out=distances)
+
+    def _products(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        return queries @ matrix.T
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 10,
+        batch_size: int = DEFAULT_QUERY_BATCH_SIZE,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        **kwargs,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest stored vectors for each query.
+
+        Each batch of queries is scored against tiles of the stored rows, keeping a
+        running top k, so memory is bounded by the tile size rather than the number of rows.
+
+        :param queries: (Q, D) matrix, or a single (D,) vector
+        :param k: number of results per query
+        :param batch_size: number of queries scored per matrix product
+        :param memory_budget: bytes for the score tile of a batch
+        :param kwargs: options of approximate searchers (e.g. ``nprobe``), ignored
+        :return: tuple of (Q, k) ids and (Q, k) scores; euclidean scores are distances
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if queries.shape[1] != self.matrix.shape[1]:
+            raise ValueError(f"Query dimensions {queries.shape[1]} != index dimensions {self.matrix.shape[1]}")
+        k = min(k, len(self.ids))
+        all_ids = np.empty((len(queries), k), dtype=self.ids.dtype)
+        all_scores = np.empty((len(queries), k), dtype=np.float32)
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start : start + batch_size]
+            indexes, scores = self._top_k(batch, k, memory_budget)
+            all_ids[start : start + len(batch)] = self.ids[indexes]
+            all_scores[start : start + len(batch)] = scores
+        if self.metric == SearchMetric.EUCLIDEAN:
+            np.sqrt(all_scores, out=all_scores)
+        return all_ids, all_scores
+
+    def _top_k(self, queries: np.ndarray, k: int, memory_budget: int) -> Tuple[np.ndarray, np.ndarray]:
+        largest = self.metric != SearchMetric.EUCLIDEAN
+        tile_rows = max(1, memory_budget // (BYTES_PER_CELL * len(queries)))
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for a in range(0, len(self.ids), tile_rows):
+            rows, scores = top_k(self.scores(queries, rows=slice(a, a + tile_rows)), k, largest=largest)
+            best_rows, best_scores = top_k_merge(best_rows, best_scores, rows + a, scores, k, largest)
+        return best_rows, best_scores
+
+
+class QuantizedSearcher(ExactSearcher):
+    """
+    Brute-force searcher that scores int8 quantized vectors directly.
+
+    With per-dimension ``x = code * scale + offset``, a product is
+    ``q . x = (q * scale) . code + q . offset``, so the stored codes are never
+    dequantized as a whole; they are widened one block of rows at a time.
+
+    >>> codes = np.array([[127, -127], [-127, 127]], dtype=np.int8)
+    >>> s = QuantizedSearcher(np.array(["A", "B"]), codes, ScalarQuantizer(np.full(2, 1 / 127), np.zeros(2)))
+    >>> ids, scores = s.search(np.array([[0.9, -0.1]]), k=1)
+    >>> ids.tolist()
+    [['A']]
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        codes: np.ndarray,
+        quantizer: ScalarQuantizer,
+        metric: SearchMetric = SearchMetric.COSINE,
+        block_rows: int = DEFAULT_BLOCK_ROWS,
+    ):
+        """
+        Create a searcher.
+
+        :param ids: (N,) ids
+        :param codes: (N, D) int8 codes
+        :param quantizer: quantizer the codes were encoded with
+        :param metric: similarity metric
+        :param block_rows: number of rows widened to float32 at a time
+        """
+        self.ids = np.asarray(ids)
+        self.metric = SearchMetric(metric)
+        self.matrix = codes
+        self.quantizer = quantizer
+        self.block_rows = block_rows
+        squared_norms = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), block_rows):
+            block = quantizer.decode(codes[start : start + block_rows])
+            squared_norms[start : start + len(block)] = np.einsum("ij,ij->i", block, block)
+        self.squared_norms = squared_norms
+        self.inverse_norms = None
+        if self.metric == SearchMetric.COSINE:
+            norms = np.sqrt(squared_norms)
+            norms[norms == 0] = 1.0
+            self.inverse_norms = 1.0 / norms
+
+    def _products(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        codes = self.matrix if rows is None else self.matrix[rows]
+        scaled = queries * self.quantizer.scale
+        products = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), self.block_rows):
+            block = codes[start : start + self.block_rows].astype(np.float32)
+            products[:, start : start + len(block)] = scaled @ block.T
+        products += (queries @ self.quantizer.offset)[:, None]
+        if self.inverse_norms is not None:
+            products *= self.inverse_norms if rows is None else self.inverse_norms[rows]
+        return products
+
+
+class ShardedSearcher:
+    """
+    Fans a search out over the searchers of the shards of an index, in a thread pool.
+
+    Each shard returns its own top k, and these are merged into the overall top k,
+    which is the same as that of a single searcher over all rows. The thread pool is
+    created by the first search and reused by the following ones, until :meth:`close`.
+
+    >>> s = ShardedSearcher([ExactSearcher(np.array(["A"]), np.array([[1.0, 0.0]])),
+    ...                      ExactSearcher(np.array(["B"]), np.array([[0.0, 1.0]]))])
+    >>> ids, scores = s.search(np.array([[0.1, 0.9]]), k=2)
+    >>> ids.tolist()
+    [['B', 'A']]
+    """
+
+    def __init__(self, searchers: List[Any], workers: Optional[int] = None):
+        """
+        Create a searcher.
+
+        :param searchers: one searcher per shard, all with the same metric
+        :param workers: number of threads, default one per shard up to the number of CPUs
+        """
+        self.searchers = searchers
+        self.metric = searchers[0].metric
+        self.workers = workers or min(len(searchers), os.cpu_count() or 1)
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="venomx-shard")
+            return self._pool
+
+    def search(self, queries: np.ndarray, k: int = 10, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest vectors over all shards for each query.
+
+        :param queries: (Q, D) matrix, or a single (D,) vector
+        :param k: number of results per query
+        :param kwargs: passed to the shard searchers
+        :return: tuple of (Q, k) ids and (Q, k) scores
+        """
+        if self.workers > 1 and len(self.searchers) > 1:
+            results = list(self._executor().map(lambda searcher: searcher.search(queries, k, **kwargs), self.searchers))
+        else:
+            results = [searcher.search(queries, k, **kwargs) for searcher in self.searchers]
+        ids = np.concatenate([r[0] for r in results], axis=1)
+        scores = np.concatenate([r[1] for r in results], axis=1)
+        indexes, scores = top_k(scores, k, largest=self.metric != SearchMetric.EUCLIDEAN)
+        return np.take_along_axis(ids, indexes, axis=1), scores
+
+    def close(self):
+        """Stop the threads searching the shards; a later search starts them again."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def __del__(self):
+        """Stop the threads when the searcher is dropped, e.g. from the searcher cache."""
+        if hasattr(self, "_lock"):
+            self.close()
+
+
+def _shard_bounds(ix: vx.Index, num_rows: int) -> Optional[np.ndarray]:
+    counts = [shard.count for shard in ix.shards or []]
+    if len(counts) < 2 or None in counts or sum(counts) != num_rows:
+        return None
+    return np.concatenate([[0], np.cumsum(counts)])
+
+
+_searcher_cache: Dict[Tuple[int, SearchMetric, bool], Tuple[weakref.ref, tuple, Any]] = {}
+_ann_registry: Dict[int, Tuple[weakref.ref, Any]] = {}
+
+
+def attach_ann(ix: vx.Index, ann: Any):
+    """
+    Attach an approximate nearest neighbour index (e.g. an IVFIndex) to an index.
+
+    Subsequent searches with the metric the ANN index was built for will use it,
+    unless ``exact=True`` is passed.
+
+    :param ix:
+    :param ann: object with a ``metric`` and a ``searcher(ids, matrix)`` method
+    :return:
+    """
+    key = id(ix)
+    _ann_registry[key] = (weakref.ref(ix, lambda _: _ann_registry.pop(key, None)), ann)
+
+
+def get_ann(ix: vx.Index) -> Optional[Any]:
+    """
+    Get the approximate nearest neighbour index attached to an index, if any.
+
+    :param ix:
+    :return:
+    """
+    entry = _ann_registry.get(id(ix))
+    if entry is not None and entry[0]() is ix:
+        return entry[1]
+    return None
+
+
+def _exact_searcher(ix: vx.Index, metric: SearchMetric, quantized: Optional[tuple]) -> Any:
+    """
+    Create a brute-force searcher, fanning out over the shards of a sharded index.
+
+    :param ix:
+    :param metric:
+    :param quantized: tuple of ids, int8 codes and quantizer, if the frame is quantized
+    :return:
+    """
+    if quantized is not None:
+        ids, matrix, quantizer = quantized
+    else:
+        ids, matrix = embeddings_matrix(ix)
+
+    def _searcher(rows: slice):
+        if quantized is not None:
+            return QuantizedSearcher(ids[rows], matrix[rows], quantizer, metric)
+        return ExactSearcher(ids[rows], matrix[rows], metric)
+
+    bounds = _shard_bounds(ix, len(ids))
+    if bounds is None:
+        return _searcher(slice(None))
+    return ShardedSearcher([_searcher(slice(a, b)) for a, b in zip(bounds[:-1], bounds[1:], strict=True)])
+
+
+def _frame_state(ix: vx.Index) -> tuple:
+    """
+    Get what the searcher of an index is built from: its embeddings frame, the arrays of a numpy frame, and its md5.
+
+    The frame and arrays are held (so that their ids are not reused) and compared by identity.
+
+    :param ix:
+    :return:
+    """
+    frame = ix.embeddings_frame
+    return (frame, *(frame.values() if isinstance(frame, dict) else ())), ix.md5
+
+
+def _same_state(state: tuple, other: tuple) -> bool:
+    objects, md5 = state
+    other_objects, other_md5 = other
+    return md5 == other_md5 and len(objects) == len(other_objects) and all(map(operator.is_, objects, other_objects))
+
+
+def clear_searcher_cache(ix: Optional[vx.Index] = None):
+    """
+    Drop the cached searchers of an index, or of all indexes.
+
+    Replacing the embeddings frame, or an array of a numpy frame, is noticed by
+    :func:`get_searcher`; writing into the arrays in place is not, and needs this.
+
+    :param ix: index, default all
+    :return:
+    """
+    for key in [key for key in _searcher_cache if ix is None or key[0] == id(ix)]:
+        _searcher_cache.pop(key, None)
+
+
+def get_searcher(ix: vx.Index, metric: SearchMetric = SearchMetric.COSINE, exact=False) -> Any:
+    """
+    Get a searcher for an index, reusing a cached one while the embeddings frame and md5 are unchanged.
+
+    :param ix:
+    :param metric:
+    :param exact: ignore any attached approximate index
+    :return: an ExactSearcher (a QuantizedSearcher for int8 frames, a ShardedSearcher over them for sharded
+        indexes), or the searcher of the attached approximate index
+    """
+    metric = SearchMetric(metric)
+    ann = None if exact else get_ann(ix)
+    if ann is not None and ann.metric != metric:
+        ann = None
+    key = (id(ix), metric, ann is not None)
+    state = _frame_state(ix)
+    cached = _searcher_cache.get(key)
+    if cached is not None:
+        ref, cached_state, searcher = cached
+        if ref() is ix and _same_state(cached_state, state):
+            return searcher
+    quantized = embeddings_codes(ix) if ann is None else None
+    if ann is not None:
+        searcher = ann.searcher(*embeddings_matrix(ix))
+    else:
+        searcher = _exact_searcher(ix, metric, quantized)
+    _searcher_cache[key] = (weakref.ref(ix, lambda _: _searcher_cache.pop(key, None)), state, searcher)
+    return searcher
+
+
+def search(
+    ix: vx.Index,
+    queries: np.ndarray,
+    k: int = 10,
+    metric: SearchMetric = SearchMetric.COSINE,
+    exact=False,
+    **kwargs,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the k nearest neighbours in an index for a batch of query vectors.
+
+    The prepared (e.g. normalized) matrix is cached per index, so repeated calls only
+    pay for the batched matrix products. If an approximate index has been attached
+    (see :func:`attach_ann`) it is used, unless ``exact`` is set.
+
+    >>> ix = vx.Index()
+    >>> ix.embeddings_frame = {"id": np.array(["A", "B", "C"]), "values": np.eye(3)}
+    >>> ids, scores = search(ix, [[1.0, 0.1, 0.0]], k=2)
+    >>> ids.tolist()
+    [['A', 'B']]
+
+    :param ix: index with an embeddings frame
+    :param queries: (Q, D) matrix, or a single (D,) vector
+    :param k: number of results per query
+    :param metric: similarity metric
+    :param exact: always use exact search
+    :param kwargs: passed to the searcher, e.g. ``nprobe`` for approximate search
+    :return: tuple of (Q, k) ids and (Q, k) scores
+    """
+    return get_searcher(ix, metric, exact=exact).search(queries, k, **kwargs)
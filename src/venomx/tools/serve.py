@@ -0,0 +1,606 @@
+"""
+A local query server keeping indexes resident, with micro-batching of concurrent queries.
+
+The server speaks a minimal HTTP/1.1 with JSON bodies, over TCP or a unix socket,
+using only asyncio:
+
+- ``GET /indexes``: the names, sizes and dimensions of the indexes
+- ``POST /indexes/{name}/lookup``: ``{"ids": [...]}`` to ``{"vectors": [...]}``, null where not found
+- ``POST /indexes/{name}/search``: ``{"vector": [...]}`` or ``{"id": ...}``, with optional ``k`` and
+  ``metric``, to ``{"results": [{"id": ..., "score": ...}, ...]}``
+- ``GET /metrics``: request counts, latency percentiles, batch sizes and throughput
+- ``GET /health``
+
+Search queries that arrive within a short window of each other are scored together,
+as one matrix product per batch, in a worker thread so that the event loop keeps
+accepting requests.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+import venomx as vx
+from venomx.tools.constants import (
+    DEFAULT_BATCH_WINDOW,
+    DEFAULT_MAX_BATCH_SIZE,
+    DEFAULT_SERVE_HOST,
+    DEFAULT_SERVE_PORT,
+    SearchMetric,
+)
+from venomx.tools.file_io import embeddings_ids, embeddings_rows
+from venomx.tools.lookup import get_rows
+from venomx.tools.search import get_searcher
+
+logger = logging.getLogger(__name__)
+
+# latencies kept per endpoint for the percentiles
+LATENCY_WINDOW = 10000
+MAX_BODY_BYTES = 64 * 2**20
+# how long the rest of a rejected request is read before closing the connection
+LINGER_SECONDS = 1.0
+STATUS_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    431: "Request Header Fields Too Large",
+    500: "Server Error",
+}
+
+
+def _shape(ix: vx.Index) -> Tuple[int, Optional[int]]:
+    # the dimensions are not known until validation for frames assigned in memory; convert one row to get them
+    count = len(embeddings_ids(ix))
+    dimensions = ix.embeddings_dimensions
+    if dimensions is None and count:
+        dimensions = embeddings_rows(ix, np.zeros(1, dtype=np.int64)).shape[1]
+    return count, dimensions
+
+
+class RequestError(ValueError):
+    """A request that cannot be answered, with its HTTP status."""
+
+    def __init__(self, message: str, status: int = 400):
+        """
+        Create an error.
+
+        :param message:
+        :param status: HTTP status code
+        """
+        super().__init__(message)
+        self.status = status
+
+
+class ServerMetrics:
+    """
+    Request counts and latencies per endpoint, and the sizes of the search batches.
+
+    >>> metrics = ServerMetrics()
+    >>> metrics.record("search", 0.004)
+    >>> metrics.record_batch(3)
+    >>> summary = metrics.summary()
+    >>> summary["endpoints"]["search"]["requests"], summary["batches"]["mean_size"]
+    (1, 3.0)
+    """
+
+    def __init__(self):
+        """Create empty metrics."""
+        self.started = time.monotonic()
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self.num_batches = 0
+        self.num_batched_queries = 0
+        self.max_batch_size = 0
+
+    def record(self, endpoint: str, seconds: float, error=False):
+        """
+        Record a request.
+
+        :param endpoint: name of the endpoint
+        :param seconds: time from reading the request to writing the response
+        :param error: the request failed
+        :return:
+        """
+        self.requests[endpoint] += 1
+        if error:
+            self.errors[endpoint] += 1
+        self.latencies[endpoint].append(seconds)
+
+    def record_batch(self, size: int):
+        """
+        Record a batch of search queries scored together.
+
+        :param size: number of queries
+        :return:
+        """
+        self.num_batches += 1
+        self.num_batched_queries += size
+        self.max_batch_size = max(self.max_batch_size, size)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the metrics, with latencies in milliseconds.
+
+        :return:
+        """
+        uptime = time.monotonic() - self.started
+        endpoints = {}
+        for endpoint, num_requests in self.requests.items():
+            latencies = np.array(self.latencies[endpoint]) * 1000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist() if len(latencies) else (None,) * 3
+            endpoints[endpoint] = {
+                "requests": num_requests,
+                "errors": self.errors[endpoint],
+                "requests_per_second": num_requests / uptime if uptime else None,
+                "latency_ms": {"p50": p50, "p95": p95, "p99": p99},
+            }
+        return {
+            "uptime_seconds": uptime,
+            "endpoints": endpoints,
+            "batches": {
+                "count": self.num_batches,
+                "queries": self.num_batched_queries,
+                "mean_size": self.num_batched_queries / self.num_batches if self.num_batches else None,
+                "max_size": self.max_batch_size,
+            },
+        }
+
+
+class MicroBatcher:
+    """
+    Merges concurrent single-vector searches of an index into batches.
+
+    The first query of a batch starts a timer; the batch is scored when the timer
+    expires, or as soon as it is full. Each batch is searched with the largest k of
+    its queries, and the results are truncated to the k of each query.
+    """
+
+    def __init__(
+        self,
+        searcher: Any,
+        executor: ThreadPoolExecutor,
+        window: float = DEFAULT_BATCH_WINDOW,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        metrics: Optional[ServerMetrics] = None,
+    ):
+        """
+        Create a batcher.
+
+        :param searcher: searcher of the index (see :func:`get_searcher`)
+        :param executor: threads scoring the batches
+        :param window: seconds to wait for more queries after the first of a batch
+        :param max_batch_size: number of queries after which a batch is scored without waiting
+        :param metrics: metrics recording the batch sizes
+        """
+        self.searcher = searcher
+        self.executor = executor
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics
+        self._pending: List[Tuple[np.ndarray, int, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # the event loop only keeps weak references to tasks
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search for one query vector, in a batch with the queries arriving at about the same time.
+
+        :param query: (D,) vector
+        :param k: number of results
+        :return: tuple of (k,) ids and (k,) scores
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, k, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[np.ndarray, int, asyncio.Future]]):
+        k = max(query_k for _, query_k, _ in batch)
+        try:
+            queries = np.vstack([query for query, _, _ in batch])
+            loop = asyncio.get_running_loop()
+            ids, scores = await loop.run_in_executor(self.executor, self.searcher.search, queries, k)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if self.metrics is not None:
+            self.metrics.record_batch(len(batch))
+        for i, (_, query_k, future) in enumerate(batch):
+            if not future.done():
+                future.set_result((ids[i, :query_k], scores[i, :query_k]))
+
+
+class IndexServer:
+    """
+    Answers lookups and k-NN searches over resident indexes.
+
+    Requests are routed by :meth:`handle`, which can be called directly; :meth:`start`
+    serves them over HTTP.
+
+    >>> ix = vx.Index()
+    >>> ix.embeddings_frame = {"id": np.array(["A", "B"]), "values": np.eye(2)}
+    >>> server = IndexServer({"test": ix})
+    >>> status, response = asyncio.run(server.handle("POST", "/indexes/test/search", {"vector": [1.0, 0.1], "k": 1}))
+    >>> status, [result["id"] for result in response["results"]]
+    (200, ['A'])
+    """
+
+    def __init__(
+        self,
+        indexes: Dict[str, vx.Index],
+        metric: SearchMetric = SearchMetric.COSINE,
+        window: float = DEFAULT_BATCH_WINDOW,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        workers: int = 1,
+        exact=False,
+    ):
+        """
+        Create a server.
+
+        :param indexes: indexes by name, with their embeddings frames loaded
+        :param metric: default similarity metric of searches
+        :param window: seconds to wait for more queries after the first of a batch
+        :param max_batch_size: maximum number of queries per batch
+        :param workers: number of threads scoring batches
+        :param exact: ignore any attached approximate indexes
+        """
+        self.indexes = indexes
+        self.metric = SearchMetric(metric)
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.exact = exact
+        self.metrics = ServerMetrics()
+        self.shapes = {name: _shape(ix) for name, ix in indexes.items()}
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._batchers: Dict[Tuple[str, SearchMetric], MicroBatcher] = {}
+
+    def batcher(self, name: str, metric: SearchMetric) -> MicroBatcher:
+        """
+        Get the batcher of an index and metric, preparing its searcher on first use.
+
+        :param name: index name
+        :param metric:
+        :return:
+        """
+        key = (name, metric)
+        if key not in self._batchers:
+            searcher = get_searcher(self._index(name), metric, exact=self.exact)
+            self._batchers[key] = MicroBatcher(
+                searcher, self.executor, self.window, self.max_batch_size, metrics=self.metrics
+            )
+        return self._batchers[key]
+
+    def _index(self, name: str) -> vx.Index:
+        if name not in self.indexes:
+            raise RequestError(f"Unknown index: {name}", status=404)
+        return self.indexes[name]
+
+    def describe(self) -> Dict[str, dict]:
+        """
+        Describe the indexes.
+
+        :return: count and dimensions by index name
+        """
+        return {name: {"count": count, "dimensions": dimensions} for name, (count, dimensions) in self.shapes.items()}
+
+    async def search(self, name: str, body: dict) -> dict:
+        """
+        Answer a search request.
+
+        :param name: index name
+        :param body: with a ``vector`` or an ``id``, and optional ``k`` and ``metric``
+        :return: results, best first
+        """
+        ix = self._index(name)
+        try:
+            metric = SearchMetric(body.get("metric", self.metric))
+            k = int(body.get("k", 10))
+        except (TypeError, ValueError) as e:
+            raise RequestError(str(e)) from e
+        if k <= 0:
+            raise RequestError(f"Expected a positive k, got {k}")
+        if "vector" in body:
+            query = _query_vector(body["vector"], self.shapes[name][1])
+        elif "id" in body:
+            rows = get_rows(ix, [str(body["id"])])
+            if rows[0] < 0:
+                raise RequestError(f"Not in index: {body['id']}", status=404)
+            query = embeddings_rows(ix, rows)[0]
+        else:
+            raise RequestError("Expected a vector or an id")
+        ids, scores = await self.batcher(name, metric).search(query, k)
+        return {
+            "results": [
+                {"id": str(x), "score": float(score)} for x, score in zip(ids, scores, strict=True) if x is not None
+            ]
+        }
+
+    def lookup(self, name: str, body: dict) -> dict:
+        """
+        Answer a lookup request.
+
+        :param name: index name
+        :param body: with a list of ``ids``; CURIEs and URIs match either form
+        :return: vectors, null for ids that are not found
+        """
+        ids = body.get("ids")
+        if not isinstance(ids, list):
+            raise RequestError("Expected a list of ids")
+        ix = self._index(name)
+        rows = get_rows(ix, [str(x) for x in ids])
+        found = rows >= 0
+        vectors = iter(embeddings_rows(ix, rows[found]).tolist() if found.any() else [])
+        return {"vectors": [next(vectors) if f else None for f in found]}
+
+    async def handle(self, method: str, path: str, body: Optional[dict] = None) -> Tuple[int, dict]:
+        """
+        Route a request, recording its latency.
+
+        :param method: GET or POST
+        :param path: request path
+        :param body: decoded json body
+        :return: tuple of status and json response
+        """
+        start = time.perf_counter()
+        parts = [part for part in path.split("?")[0].split("/") if part]
+        endpoint = parts[-1] if parts else "/"
+        try:
+            status, response = 200, await self._route(method, parts, body or {})
+        except RequestError as e:
+            status, response = e.status, {"error": str(e)}
+        except Exception as e:
+            logger.exception(f"Failed {method} {path}")
+            status, response = 500, {"error": str(e)}
+        self.metrics.record(endpoint, time.perf_counter() - start, error=status != 200)
+        return status, response
+
+    async def _route(self, method: str, parts: List[str], body: dict) -> dict:
+        if parts in (["health"], ["metrics"], ["indexes"]):
+            if method != "GET":
+                raise RequestError(f"{method} not allowed", status=405)
+            if parts == ["metrics"]:
+                return self.metrics.summary()
+            return self.describe() if parts == ["indexes"] else {"status": "ok"}
+        if len(parts) == 3 and parts[0] == "indexes" and parts[2] in ("search", "lookup"):
+            if method != "POST":
+                raise RequestError(f"{method} not allowed", status=405)
+            if parts[2] == "search":
+                return await self.search(parts[1], body)
+            return self.lookup(parts[1], body)
+        raise RequestError(f"Not found: /{'/'.join(parts)}", status=404)
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # one connection, with keep-alive; each request is handled as it is read
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except (asyncio.LimitOverrunError, ValueError):
+                    # a request line or header over the stream limit; the end of the request is unknown
+                    request = "GET", "/", RequestError("Request header too large", status=431), False
+                if request is None:
+                    break
+                method, path, body, keep_alive = request
+                if isinstance(body, RequestError):
+                    status, response = body.status, {"error": str(body)}
+                else:
+                    status, response = await self.handle(method, path, body)
+                _write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    if isinstance(body, RequestError):
+                        await _discard_input(reader, writer)
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(
+        self, host: str = DEFAULT_SERVE_HOST, port: int = DEFAULT_SERVE_PORT, socket_path: Optional[str] = None
+    ) -> asyncio.AbstractServer:
+        """
+        Start serving, on a unix socket if a path is given, otherwise over TCP.
+
+        :param host:
+        :param port: TCP port; 0 picks a free one
+        :param socket_path: path of a unix socket
+        :return: the asyncio server
+        """
+        for name in self.indexes:
+            # prepare the searchers (e.g. normalized matrices) before the first request
+            self.batcher(name, self.metric)
+        if socket_path:
+            return await asyncio.start_unix_server(self._client, path=socket_path)
+        return await asyncio.start_server(self._client, host, port)
+
+    def close(self):
+        """Stop the scoring threads."""
+        self.executor.shutdown(wait=False)
+
+
+def _query_vector(vector: Any, dimensions: int) -> np.ndarray:
+    """
+    Check the vector of a search request.
+
+    >>> _query_vector([1, 0.5], 2).tolist()
+    [1.0, 0.5]
+
+    :param vector: json value of the request
+    :param dimensions: dimensions of the index
+    :return: (D,) float32 vector
+    """
+    error = RequestError(f"Expected a vector of {dimensions} finite numbers")
+    if not isinstance(vector, list) or len(vector) != dimensions:
+        raise error
+    if not all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in vector):
+        raise error
+    query = np.asarray(vector, dtype=np.float32)
+    if not np.isfinite(query).all():
+        raise error
+    return query
+
+
+def _content_length(headers: Dict[str, str]) -> int:
+    """
+    Get the length of a request body from its headers.
+
+    >>> _content_length({"content-length": "12"}), _content_length({}), _content_length({"content-length": "ten"})
+    (12, 0, -1)
+
+    :param headers: headers, with lower case names
+    :return: -1 if the header is not a valid length
+    """
+    try:
+        return int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        return -1
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[tuple]:
+    """
+    Read an HTTP request.
+
+    :param reader:
+    :return: tuple of method, path, body (or a RequestError if it is not json) and keep-alive; None at end of stream
+    """
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, path, version = line.decode("latin-1").split()
+    except ValueError:
+        return "GET", "/", RequestError("Malformed request line"), False
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = header.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    connection = headers.get("connection", "").lower()
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    length = _content_length(headers)
+    if length < 0:
+        # the end of the body is unknown, so the connection is closed after the error
+        return method, path, RequestError("Invalid Content-Length"), False
+    if length > MAX_BODY_BYTES:
+        return method, path, RequestError("Request body too large"), False
+    body = None
+    if length:
+        data = await reader.readexactly(length)
+        try:
+            body = json.loads(data)
+        except ValueError:
+            body = RequestError("Request body is not json")
+        if not isinstance(body, (dict, RequestError)):
+            body = RequestError("Request body is not a json object")
+    return method.upper(), path, body, keep_alive
+
+
+async def _discard_input(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Read and drop what a client still sends after its request was rejected, for a moment.
+
+    Closing a socket with unread input resets the connection, and the client may then
+    lose the error response before reading it.
+
+    :param reader:
+    :param writer:
+    :return:
+    """
+    if writer.can_write_eof():
+        writer.write_eof()
+
+    async def _drain():
+        while await reader.read(2**16):
+            pass
+
+    try:
+        await asyncio.wait_for(_drain(), LINGER_SECONDS)
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+
+
+def _write_response(writer: asyncio.StreamWriter, status: int, response: dict, keep_alive: bool):
+    data = json.dumps(response).encode("utf-8")
+    head = (
+        f"HTTP/1.1 {status} {STATUS_REASONS.get(status, '')}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + data)
+
+
+def index_name(path: Union[str, Path]) -> str:
+    """
+    Get the default name of an index served from a file.
+
+    >>> index_name("data/hp.vx.yaml")
+    'hp'
+
+    :param path:
+    :return: the file name without its suffixes
+    """
+    return Path(path).name.split(".")[0]
+
+
+def serve(
+    indexes: Dict[str, vx.Index],
+    host: str = DEFAULT_SERVE_HOST,
+    port: int = DEFAULT_SERVE_PORT,
+    socket_path: Optional[str] = None,
+    **kwargs,
+):
+    """
+    Serve indexes until interrupted.
+
+    :param indexes: indexes by name
+    :param host:
+    :param port:
+    :param socket_path: path of a unix socket, instead of TCP
+    :param kwargs: passed to IndexServer (metric, window, max_batch_size, workers, exact)
+    :return:
+    """
+    server = IndexServer(indexes, **kwargs)
+
+    async def _serve():
+        aio_server = await server.start(host, port, socket_path)
+        addresses = ", ".join(str(sock.getsockname()) for sock in aio_server.sockets)
+        logger.info(f"Serving {sorted(indexes)} on {addresses}")
+        async with aio_server:
+            await aio_server.serve_forever()
+
+    try:
+        asyncio.run(_serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
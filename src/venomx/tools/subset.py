@@ -0,0 +1,259 @@
+"""Subsets of an index by id prefix, id list or object metadata, read with predicate pushdown."""
+
+import logging
+import operator
+from functools import reduce
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+import venomx as vx
+from venomx.model.embeddings_pa import ID, VALUES
+from venomx.model.objects_pa import METADATA, ObjectTable
+from venomx.tools.constants import SUFFIX_MAP, EmbeddingFormat, LoadMode
+from venomx.tools.file_io import (
+    _embeddings_paths,
+    _frame,
+    _index_from_metadata,
+    _load_metadata,
+    embeddings_file_tuple,
+    embeddings_table,
+    list_array_to_matrix,
+    load_index,
+    to_fixed_size_table,
+)
+from venomx.tools.id_map import alternative_ids
+from venomx.tools.lookup import _prefix_map
+from venomx.tools.profiling import count, phase, profiled
+from venomx.tools.quantization import dequantize
+
+logger = logging.getLogger(__name__)
+
+DATASET_FORMATS = {EmbeddingFormat.PARQUET: "parquet", EmbeddingFormat.ARROW: "ipc"}
+
+
+def prefix_patterns(ix: vx.Index, prefixes: Iterable[str]) -> List[str]:
+    """
+    Resolve prefixes to the strings that ids start with.
+
+    A CURIE prefix of the index (with or without the colon) matches both its CURIEs
+    and its URIs, as does its namespace; anything else is used as is.
+
+    >>> ix = vx.Index(prefixes=[{"prefix": "HP", "namespace": "http://purl.obolibrary.org/obo/HP_"}])
+    >>> prefix_patterns(ix, ["HP", "MONDO", "GO:0008"])
+    ['HP:', 'http://purl.obolibrary.org/obo/HP_', 'MONDO:', 'GO:0008']
+
+    :param ix: index whose prefix map is used
+    :param prefixes: CURIE prefixes, namespaces, or leading parts of ids
+    :return: id prefixes
+    """
+    prefix_map = _prefix_map(ix)
+    namespaces = {namespace: prefix for prefix, namespace in prefix_map.items()}
+    patterns = []
+    for prefix in prefixes:
+        name = prefix[:-1] if prefix.endswith(":") else prefix
+        if name in prefix_map:
+            patterns += [f"{name}:", prefix_map[name]]
+        elif prefix in namespaces:
+            patterns += [f"{namespaces[prefix]}:", prefix]
+        elif ":" in prefix or "/" in prefix:
+            patterns.append(prefix)
+        else:
+            patterns.append(f"{prefix}:")
+    return list(dict.fromkeys(patterns))
+
+
+def _starts_with(pattern: str) -> pc.Expression:
+    # a range rather than starts_with, so that row groups can be skipped by their min/max statistics
+    field = pc.field(ID)
+    upper = pattern[:-1] + chr(ord(pattern[-1]) + 1) if pattern and ord(pattern[-1]) < 0x10FFFF else None
+    if upper is None:
+        return pc.starts_with(field, pattern)
+    return (field >= pattern) & (field < upper)
+
+
+def _isin(ids: List[str]) -> pc.Expression:
+    # the bounds let row groups outside the range of the ids be skipped
+    field = pc.field(ID)
+    return (field >= min(ids)) & (field <= max(ids)) & field.isin(ids)
+
+
+def object_ids(
+    ix: vx.Index, metadata: Optional[Iterable[str]] = None, predicate: Optional[Callable] = None
+) -> List[str]:
+    """
+    Get the ids of the objects of an index with any of a set of metadata values, and/or matching a predicate.
+
+    >>> ix = vx.Index(objects=[{"id": "A", "metadata": ["obsolete"]}, {"id": "B"}])
+    >>> object_ids(ix, metadata=["obsolete"]), object_ids(ix, predicate=lambda obj: obj.id > "A")
+    (['A'], ['B'])
+
+    :param ix:
+    :param metadata: metadata values, one of which objects must have
+    :param predicate: function of a NamedObject
+    :return: object ids
+    """
+    objects = ix.objects if isinstance(ix.objects, ObjectTable) else ObjectTable.from_objects(ix.objects or [])
+    if metadata is not None:
+        column = objects.table.column(METADATA).combine_chunks()
+        found = pc.is_in(pc.list_flatten(column), value_set=pa.array(list(metadata), type=pa.string()))
+        rows = np.unique(pc.list_parent_indices(column).to_numpy()[found.to_numpy(zero_copy_only=False)])
+        mask = np.zeros(len(objects), dtype=bool)
+        mask[rows] = True
+        objects = objects.filter(mask)
+    if predicate is not None:
+        objects = objects.filter(np.array([bool(predicate(obj)) for obj in objects], dtype=bool))
+    return objects.ids.to_pylist()
+
+
+def id_filter(
+    ix: vx.Index,
+    prefixes: Optional[Iterable[str]] = None,
+    ids: Optional[Iterable[str]] = None,
+    metadata: Optional[Iterable[str]] = None,
+    predicate: Optional[Callable] = None,
+) -> Optional[pc.Expression]:
+    """
+    Get a filter on the ids of the embeddings of an index; rows must meet all the criteria given.
+
+    Ids are matched as CURIEs or URIs, using the prefixes of the index.
+
+    >>> print(id_filter(vx.Index(), prefixes=["HP"]))
+    ((id >= "HP:") and (id < "HP;"))
+
+    :param ix: index whose prefix map and objects are used
+    :param prefixes: id prefixes (see :func:`prefix_patterns`)
+    :param ids: ids
+    :param metadata: object metadata values (see :func:`object_ids`)
+    :param predicate: function of a NamedObject (see :func:`object_ids`)
+    :return: filter expression, None if no criteria are given
+    """
+    expressions = []
+    if prefixes is not None:
+        patterns = prefix_patterns(ix, prefixes)
+        expressions.append(reduce(operator.or_, [_starts_with(p) for p in patterns]) if patterns else pc.scalar(False))
+    for selected in [ids, object_ids(ix, metadata, predicate) if metadata or predicate else None]:
+        if selected is None:
+            continue
+        selected = [str(x) for x in selected]
+        selected += [alt for alt in alternative_ids(selected, _prefix_map(ix)) if alt is not None]
+        expressions.append(_isin(selected) if selected else pc.scalar(False))
+    return reduce(operator.and_, expressions) if expressions else None
+
+
+def read_filtered(paths: List[Path], format: EmbeddingFormat, expression: Optional[pc.Expression]) -> pa.Table:
+    """
+    Read the rows of embeddings files matching a filter.
+
+    Parquet row groups whose id statistics cannot match are skipped without being read,
+    so a subset of an index written with ``sort_ids`` costs about its share of the I/O.
+
+    :param paths: embeddings files
+    :param format: PARQUET or ARROW
+    :param expression: filter on the ids
+    :return: table of id, values
+    """
+    dataset = ds.dataset([str(path) for path in paths], format=DATASET_FORMATS[EmbeddingFormat(format)])
+    if format == EmbeddingFormat.PARQUET and expression is not None:
+        fragments = list(dataset.get_fragments())
+        row_groups = [rg for fragment in fragments for rg in fragment.split_by_row_group(expression)]
+        total = sum(fragment.metadata.num_row_groups for fragment in fragments)
+        logger.info(f"Reading {len(row_groups)} of {total} row groups")
+        dataset = ds.FileSystemDataset(row_groups, dataset.schema, dataset.format, dataset.filesystem)
+    return dataset.to_table(columns=[ID, VALUES], filter=expression)
+
+
+def _subset_objects(ix: vx.Index, ids: pa.Array):
+    if ix.objects is None:
+        return None
+    if isinstance(ix.objects, ObjectTable):
+        return ix.objects.filter(pc.is_in(ix.objects.ids, value_set=ids))
+    selected = set(ids.to_pylist())
+    return [obj for obj in ix.objects if obj.id in selected]
+
+
+def _subset_index(ix: vx.Index, frame, ids: pa.Array) -> vx.Index:
+    # the checksums, shards and segments describe the files of the whole index
+    return ix.model_copy(
+        update={
+            "objects": _subset_objects(ix, ids),
+            "embeddings_frame": frame,
+            "embeddings_count": len(ids),
+            "md5": None,
+            "chunk_md5s": [],
+            "shards": [],
+            "segments": [],
+        }
+    )
+
+
+def _table_frame(ix: vx.Index, table: pa.Table, mode: LoadMode):
+    if mode == LoadMode.ARROW and not pa.types.is_int8(table.schema.field(VALUES).type.value_type):
+        return to_fixed_size_table(table)
+    matrix = dequantize(ix, list_array_to_matrix(table.column(VALUES), dtype=None))
+    return _frame(mode, table.column(ID).to_numpy(zero_copy_only=False), matrix)
+
+
+def _in_memory_subset(ix: vx.Index, expression: Optional[pc.Expression], mode: LoadMode) -> vx.Index:
+    table = embeddings_table(ix)
+    if expression is not None:
+        table = table.filter(expression)
+    return _subset_index(ix, _table_frame(ix, table, mode), table.column(ID).combine_chunks())
+
+
+@profiled("load_subset")
+def load_subset(
+    source: Union[str, Path],
+    format: EmbeddingFormat = EmbeddingFormat.PARQUET,
+    prefixes: Optional[Iterable[str]] = None,
+    ids: Optional[Iterable[str]] = None,
+    metadata: Optional[Iterable[str]] = None,
+    predicate: Optional[Callable] = None,
+    mode: LoadMode = LoadMode.NUMPY,
+) -> vx.Index:
+    """
+    Load the embeddings of an index whose ids meet all the criteria given, and their objects.
+
+    Only the rows that match are read from PARQUET and ARROW embeddings files: the
+    filter is pushed down to the reader, which skips the parquet row groups outside
+    the requested ids (see ``save_index(sort_ids=True)``). Indexes with delta segments,
+    and all-in-one formats, are loaded in full and filtered in memory.
+
+    >>> from venomx.tools.file_io import save_index
+    >>> ix = vx.Index(prefixes=[{"prefix": "HP", "namespace": "http://purl.obolibrary.org/obo/HP_"}])
+    >>> ix.embeddings_frame = {"id": np.array(["MONDO:1", "HP:1", "HP:2"]), "values": np.eye(3)}
+    >>> save_index(ix, "tests/output/subset.vx.yaml", sort_ids=True)
+    >>> load_subset("tests/output/subset.vx.yaml", prefixes=["HP"]).embeddings_frame["id"].tolist()
+    ['HP:1', 'HP:2']
+    >>> load_subset("tests/output/subset.vx.yaml", ids=["http://purl.obolibrary.org/obo/HP_2"]).embeddings_count
+    1
+
+    :param source: path to the metadata yaml or the embeddings file
+    :param format: format of the index
+    :param prefixes: id prefixes (see :func:`prefix_patterns`)
+    :param ids: ids
+    :param metadata: object metadata values (see :func:`object_ids`)
+    :param predicate: function of a NamedObject (see :func:`object_ids`)
+    :param mode: how to materialize the embeddings frame
+    :return: index of the subset
+    """
+    format = EmbeddingFormat(format)
+    mode = LoadMode(mode)
+    criteria = {"prefixes": prefixes, "ids": ids, "metadata": metadata, "predicate": predicate}
+    if format not in SUFFIX_MAP:
+        ix = load_index(source, format=format, mode=LoadMode.NUMPY, check=False)
+        return _in_memory_subset(ix, id_filter(ix, **criteria), mode)
+    metadata_path, embeddings, ef = embeddings_file_tuple(source, format, allow_bundled=True)
+    ix = _index_from_metadata(_load_metadata(metadata_path, format), metadata_path)
+    if ix.segments:
+        full = load_index(source, format=format, mode=LoadMode.NUMPY, check=False)
+        return _in_memory_subset(full, id_filter(full, **criteria), mode)
+    expression = id_filter(ix, **criteria)
+    with phase("read_subset"):
+        table = read_filtered(_embeddings_paths(ix, metadata_path, embeddings), ef, expression)
+        count(nbytes=table.nbytes, rows=table.num_rows)
+    return _subset_index(ix, _table_frame(ix, table, mode), table.column(ID).combine_chunks())
@@ -0,0 +1,262 @@
+"""Columnar integrity checks for the embeddings of an index."""
+
+import logging
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+logger = logging.getLogger(__name__)
+
+MAX_EXAMPLE_ROWS = 10
+
+
+class IssueKind(str, Enum):
+    NULL_VECTOR = "null_vector"
+    INCONSISTENT_DIMENSIONS = "inconsistent_dimensions"
+    COUNT_MISMATCH = "count_mismatch"
+    NON_FINITE = "non_finite"
+    ZERO_VECTOR = "zero_vector"
+    DUPLICATE_ID = "duplicate_id"
+    MISSING_OBJECT = "missing_object"
+
+
+# issues that make an index unusable; the others are reported as warnings
+ERROR_KINDS = {IssueKind.NULL_VECTOR, IssueKind.INCONSISTENT_DIMENSIONS, IssueKind.COUNT_MISMATCH}
+
+
+class ValidationReport:
+    """
+    The result of validating an index.
+
+    Holds the number of rows checked, and for each kind of issue found, the number
+    of offending rows and the first few of them.
+
+    >>> report = ValidationReport(num_rows=3, dimensions=2)
+    >>> report.add(IssueKind.ZERO_VECTOR, np.array([1]))
+    >>> report.ok, report.to_dict()["issues"]
+    (True, {'zero_vector': {'count': 1, 'rows': [1], 'message': None, 'severity': 'warning'}})
+    """
+
+    def __init__(self, num_rows: int = 0, dimensions: Optional[int] = None):
+        """
+        Create an empty report.
+
+        :param num_rows: number of rows checked
+        :param dimensions: number of dimensions of the embeddings
+        """
+        self.num_rows = num_rows
+        self.dimensions = dimensions
+        self.issues: Dict[IssueKind, dict] = {}
+
+    def add(self, kind: IssueKind, rows: Optional[np.ndarray] = None, message: Optional[str] = None, count=None):
+        """
+        Record offending rows for a kind of issue.
+
+        :param kind:
+        :param rows: row numbers, in increasing order
+        :param message: description of the issue
+        :param count: number of occurrences, default the number of rows
+        :return:
+        """
+        rows = np.asarray([] if rows is None else rows, dtype=np.int64)
+        if count is None:
+            count = len(rows)
+        if not count:
+            return
+        entry = self.issues.setdefault(IssueKind(kind), {"count": 0, "rows": [], "message": message})
+        entry["count"] += int(count)
+        entry["rows"].extend(rows[: MAX_EXAMPLE_ROWS - len(entry["rows"])].tolist())
+        if message and not entry["message"]:
+            entry["message"] = message
+
+    @property
+    def errors(self) -> List[IssueKind]:
+        """Kinds of issue found that make the index unusable."""
+        return [k for k in self.issues if k in ERROR_KINDS]
+
+    @property
+    def warnings(self) -> List[IssueKind]:
+        """Kinds of issue found that do not prevent the index being used."""
+        return [k for k in self.issues if k not in ERROR_KINDS]
+
+    @property
+    def ok(self) -> bool:
+        """True if no errors were found."""
+        return not self.errors
+
+    def raise_for_errors(self):
+        """
+        Raise a ValueError describing the errors found, if any.
+
+        :return:
+        """
+        if self.errors:
+            raise ValueError("; ".join(self._describe(k) for k in self.errors))
+
+    def _describe(self, kind: IssueKind) -> str:
+        entry = self.issues[kind]
+        text = f"{kind.value}: {entry['count']}"
+        if entry["message"]:
+            text += f" ({entry['message']})"
+        if entry["rows"]:
+            text += f", first rows {entry['rows']}"
+        return text
+
+    def to_dict(self) -> dict:
+        """
+        Convert to a dictionary, e.g. for serialization as json.
+
+        :return:
+        """
+        return {
+            "num_rows": self.num_rows,
+            "dimensions": self.dimensions,
+            "ok": self.ok,
+            "issues": {
+                k.value: {**v, "severity": "error" if k in ERROR_KINDS else "warning"} for k, v in self.issues.items()
+            },
+        }
+
+    def __str__(self) -> str:
+        """Format as one line per issue."""
+        lines = [f"Rows: {self.num_rows}", f"Dimensions: {self.dimensions}"]
+        for kind in self.issues:
+            severity = "ERROR" if kind in ERROR_KINDS else "WARNING"
+            lines.append(f"{severity} {self._describe(kind)}")
+        return "\n".join(lines)
+
+
+def _list_layout(values: pa.Array) -> tuple:
+    """
+    Get the row offsets into the flat values of a list array, read from its buffers.
+
+    :param values: list, large list or fixed size list array
+    :return: tuple of (N+1,) offsets into the flat numpy values, and the flat values
+    """
+    n = len(values)
+    if pa.types.is_fixed_size_list(values.type):
+        size = values.type.list_size
+        offsets = (values.offset + np.arange(n + 1, dtype=np.int64)) * size
+    else:
+        offset_type = np.int64 if pa.types.is_large_list(values.type) else np.int32
+        offsets = np.frombuffer(values.buffers()[1], dtype=offset_type)[values.offset : values.offset + n + 1]
+    start, end = int(offsets[0]), int(offsets[-1])
+    flat = values.values.slice(start, end - start).to_numpy(zero_copy_only=False)
+    return offsets.astype(np.int64) - start, flat
+
+
+class Validator:
+    """
+    Accumulates integrity checks over the batches of an index.
+
+    All checks are vectorized over the arrow offsets buffer and the flat values array
+    of each batch; no per-row python objects are created.
+
+    >>> v = Validator(object_ids=["A", "B"])
+    >>> values = pa.array([[1.0, 0.0], [0.0, 0.0], [float("nan"), 1.0]], type=pa.list_(pa.float32()))
+    >>> v.update(pa.array(["A", "B", "A"]), values)
+    >>> sorted(k.value for k in v.finish().issues)
+    ['duplicate_id', 'non_finite', 'zero_vector']
+    """
+
+    def __init__(
+        self,
+        dimensions: Optional[int] = None,
+        object_ids: Optional[Union[Iterable[str], pa.Array, pa.ChunkedArray]] = None,
+        expected_count: Optional[int] = None,
+    ):
+        """
+        Create a validator.
+
+        :param dimensions: expected number of dimensions, default that of the first vector
+        :param object_ids: ids of the objects of the index; if set, embedding ids not in it are reported
+        :param expected_count: expected number of rows
+        """
+        self.dimensions = dimensions
+        if isinstance(object_ids, pa.ChunkedArray):
+            object_ids = object_ids.combine_chunks()
+        elif object_ids is not None and not isinstance(object_ids, pa.Array):
+            object_ids = pa.array(list(object_ids), type=pa.string())
+        self.object_ids = object_ids if object_ids is not None and len(object_ids) else None
+        self.expected_count = expected_count
+        self.report = ValidationReport(dimensions=dimensions)
+        self._ids: List[pa.Array] = []
+
+    def update(self, ids: Union[pa.Array, pa.ChunkedArray], values: Union[pa.Array, pa.ChunkedArray]):
+        """
+        Check a batch of rows.
+
+        :param ids: string array
+        :param values: list array
+        :return:
+        """
+        offset = self.report.num_rows
+        ids_chunks = ids.chunks if isinstance(ids, pa.ChunkedArray) else [ids]
+        self._ids.extend(c.cast(pa.string()) for c in ids_chunks)
+        if self.object_ids is not None:
+            for chunk in ids_chunks:
+                missing = np.flatnonzero(~pc.is_in(chunk, value_set=self.object_ids).to_numpy(zero_copy_only=False))
+                self.report.add(IssueKind.MISSING_OBJECT, offset + missing, "ids not in objects")
+                offset += len(chunk)
+        offset = self.report.num_rows
+        for chunk in values.chunks if isinstance(values, pa.ChunkedArray) else [values]:
+            self._check_values(chunk, offset)
+            offset += len(chunk)
+        self.report.num_rows = offset
+
+    def _check_values(self, values: pa.Array, offset: int):
+        if not len(values):
+            return
+        offsets, flat = _list_layout(values)
+        lengths = np.diff(offsets)
+        valid = values.is_valid().to_numpy(zero_copy_only=False)
+        self.report.add(IssueKind.NULL_VECTOR, offset + np.flatnonzero(~valid))
+        if self.dimensions is None and valid.any():
+            self.dimensions = self.report.dimensions = int(lengths[np.argmax(valid)])
+        wrong = np.flatnonzero(valid & (lengths != self.dimensions))
+        if len(wrong):
+            found = sorted(set(np.unique(lengths[wrong]).tolist()))
+            self.report.add(
+                IssueKind.INCONSISTENT_DIMENSIONS, offset + wrong, f"expected {self.dimensions}, found {found}"
+            )
+        # reduce over the non-empty rows only; each segment then ends where the next one starts
+        nonempty = np.flatnonzero(valid & (lengths > 0))
+        if not len(nonempty) or flat.dtype.kind != "f":
+            # int8 values are quantization codes, which can be neither non-finite nor meaningfully zero
+            return
+        starts = offsets[nonempty]
+        finite = np.isfinite(flat)
+        if not finite.all():
+            bad = ~np.logical_and.reduceat(finite, starts)
+            self.report.add(IssueKind.NON_FINITE, offset + nonempty[bad], "NaN or infinite values")
+        zero = ~np.logical_or.reduceat(flat != 0, starts)
+        self.report.add(IssueKind.ZERO_VECTOR, offset + nonempty[zero], "all-zero vectors")
+
+    def _check_ids(self):
+        all_ids = pa.chunked_array(self._ids, type=pa.string())
+        counts = pc.value_counts(all_ids)
+        repeated = counts.field("values").filter(pc.greater(counts.field("counts"), 1))
+        if not len(repeated):
+            return
+        candidates = np.flatnonzero(pc.is_in(all_ids, value_set=repeated).to_numpy(zero_copy_only=False))
+        _, first = np.unique(all_ids.take(pa.array(candidates)).to_numpy(zero_copy_only=False), return_index=True)
+        repeats = np.delete(candidates, first)
+        self.report.add(IssueKind.DUPLICATE_ID, repeats, f"{len(repeated)} ids occur more than once")
+
+    def finish(self) -> ValidationReport:
+        """
+        Run the checks that need all rows, and get the report.
+
+        :return:
+        """
+        if self._ids:
+            self._check_ids()
+        num_rows = self.report.num_rows
+        if self.expected_count is not None and num_rows != self.expected_count:
+            self.report.add(
+                IssueKind.COUNT_MISMATCH, message=f"{num_rows} rows != embeddings_count {self.expected_count}", count=1
+            )
+        return self.report
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+from venomx.tools.benchmark import benchmark_cases, compare_results, parse_scale, run_benchmarks
+from venomx.tools.cli import main
+from venomx.tools.file_io import EmbeddingFormat
+
+from tests import OUTPUT_DIR
+
+
+def test_parse_scale():
+    assert parse_scale("10M x 3072") == (10_000_000, 3072)
+    with pytest.raises(ValueError):
+        parse_scale("10k")
+
+
+def test_run_benchmarks():
+    formats = [EmbeddingFormat.PARQUET, EmbeddingFormat.YAML]
+    results = run_benchmarks(["50x4"], formats, OUTPUT_DIR / "benchmark", isolate=False)
+    names = [r["name"] for r in results["results"]]
+    assert names == [c["name"] for c in benchmark_cases(formats)]
+    assert "convert:yaml->parquet" in names
+    assert "search:ann" in names
+    for result in results["results"]:
+        assert (result["rows"], result["dims"]) == (50, 4)
+        assert result["seconds"] > 0
+    assert results["environment"]["venomx"]
+    json.dumps(results)
+    comparisons = compare_results(results, results)
+    assert len(comparisons) == len(names)
+    assert not any(c["regression"] for c in comparisons)
+
+
+def test_isolated_run():
+    results = run_benchmarks(["20x4"], [EmbeddingFormat.ARROW], OUTPUT_DIR / "benchmark", operations=["load"])
+    assert [r["name"] for r in results["results"]] == ["load:arrow"]
+    assert results["results"][0]["peak_rss_bytes"] > 0
+
+
+def test_benchmark_command(runner):
+    output = OUTPUT_DIR / "benchmark.json"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    args = ["benchmark", "--scale", "30x4", "--operation", "validate", "--no-isolate", "-o", str(output)]
+    result = runner.invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert "validate:parquet\t30\t4" in result.output
+    with open(output) as stream:
+        baseline = json.load(stream)
+    for row in baseline["results"]:
+        row["seconds"] /= 100
+    with open(output, "w") as stream:
+        json.dump(baseline, stream)
+    result = runner.invoke(main, args[:-2] + ["--baseline", str(output), "--fail-on-regression"])
+    assert result.exit_code != 0
+    assert "REGRESSION" in result.output
+    # a 100x slowdown is within a threshold of 1000x
+    result = runner.invoke(main, args[:-2] + ["--baseline", str(output), "--threshold", "1000", "--fail-on-regression"])
+    assert result.exit_code == 0, result.output
+    assert "REGRESSION" not in result.output
@@ -20,11 +20,21 @@ def test_help(runner):
     "command,options,arguments,passes,outpath,expected",
     [
         ("validate", ["--help"], [], True, None, "validate"),
-        ("validate", [str(TEMP_TEST_YAML)], [], True, None, ""),
+        ("validate", [str(TEMP_TEST_YAML)], [], True, None, "Rows: 10"),
+        ("validate", [str(TEMP_TEST_YAML)], ["--json"], True, None, '"ok": true'),
         ("validate", [str(TEMP_COMBINED_YAML)], ["-f", "yaml"], True, None, ""),
         ("convert", [str(TEMP_TEST_YAML)], ["-o", str(OUTPUT_DIR / "tmp.yaml")], True, None, ""),
         ("convert", [str(TEMP_TEST_YAML)], ["-f", "parquet", "-o", str(OUTPUT_DIR / "tmp.yaml")], True, None, ""),
         ("convert", [str(TEMP_TEST_YAML)], ["-t", "yaml", "-o", str(OUTPUT_DIR / "all_in_one.yaml")], True, None, ""),
+        ("convert", [str(TEMP_TEST_YAML)], ["--dtype", "int8", "-o", str(OUTPUT_DIR / "int8.yaml")], True, None, ""),
+        ("convert", [str(TEMP_TEST_YAML)], ["--shards", "3", "-o", str(OUTPUT_DIR / "sharded.yaml")], True, None, ""),
+        ("info", [str(OUTPUT_DIR / "sharded.yaml")], [], True, None, "Shards: 3"),
+        ("info", [str(TEMP_TEST_YAML)], [], True, None, "Num embeddings: 10"),
+        ("info", [str(TEMP_COMBINED_YAML)], ["-f", "yaml"], True, None, "Dimensions: 20"),
+        ("search", [str(TEMP_TEST_YAML)], ["-i", "X:1", "-k", "3"], True, None, "X:1\tX:1\t1.000000"),
+        ("search", [str(TEMP_TEST_YAML)], ["-i", "X:1", "-m", "euclidean"], True, None, "X:1\tX:1\t"),
+        ("search", [str(TEMP_TEST_YAML)], ["-i", "NOT:1"], False, None, ""),
+        ("search", [str(TEMP_TEST_YAML)], [], False, None, ""),
         (
             "convert",
             [str(TEMP_COMBINED_YAML)],
@@ -0,0 +1,96 @@
+import shutil
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import venomx as vx
+import yaml
+from venomx.tools.cli import main
+from venomx.tools.constants import EmbeddingFormat
+from venomx.tools.convert import convert_index, convert_many, expand_inputs
+from venomx.tools.file_io import embeddings_matrix, load_index, save_index
+
+from tests import OUTPUT_DIR
+
+EXAMPLE = "tests/input/example.combined.yaml"
+
+
+def _index(n=500, d=12) -> vx.Index:
+    ids = np.array([f"X:{i}" for i in range(n)])
+    ix = vx.Index(objects=[{"id": x} for x in ids])
+    ix.embeddings_frame = {"id": ids, "values": np.random.default_rng(0).random((n, d))}
+    return ix
+
+
+@pytest.mark.parametrize("input_format", ["parquet", "arrow", "yaml"])
+@pytest.mark.parametrize("output_format", ["parquet", "arrow"])
+def test_pipelined_convert(input_format, output_format):
+    source = OUTPUT_DIR / f"pipeline_in_{input_format}.vx.yaml"
+    save_index(_index(), source, format=input_format)
+    targets = {}
+    for pipeline in [False, True]:
+        targets[pipeline] = OUTPUT_DIR / f"pipeline_{input_format}_{output_format}_{pipeline}.vx.yaml"
+        n = convert_index(source, targets[pipeline], input_format, output_format, pipeline=pipeline, batch_size=64)
+        assert n == 500
+    metadata = [yaml.safe_load(open(target)) for target in targets.values()]
+    assert metadata[0]["md5"] == metadata[1]["md5"]
+    # one row group per batch
+    assert len(metadata[1]["chunk_md5s"]) == 8
+    loaded = [embeddings_matrix(load_index(target, format=output_format)) for target in targets.values()]
+    assert loaded[0][0].tolist() == loaded[1][0].tolist()
+    assert np.array_equal(loaded[0][1], loaded[1][1])
+
+
+def test_pipelined_convert_options():
+    source = OUTPUT_DIR / "pipeline_options_in.vx.yaml"
+    save_index(_index(), source)
+    targets = {}
+    for pipeline in [False, True]:
+        targets[pipeline] = OUTPUT_DIR / f"pipeline_options_{pipeline}.vx.yaml"
+        convert_index(source, targets[pipeline], pipeline=pipeline, batch_size=100, fixed_size=True, row_group_size=50)
+    metadata = [yaml.safe_load(open(target)) for target in targets.values()]
+    assert metadata[0]["md5"] == metadata[1]["md5"]
+    assert metadata[0]["chunk_md5s"] == metadata[1]["chunk_md5s"]
+    embeddings = pq.ParquetFile(str(targets[True]).replace(".yaml", ".parquet"))
+    assert pa.types.is_fixed_size_list(embeddings.schema_arrow.field("values").type)
+    assert embeddings.metadata.num_row_groups == 10
+
+
+def test_pipelined_convert_invalid():
+    source = OUTPUT_DIR / "pipeline_invalid.vx.yaml"
+    target = OUTPUT_DIR / "pipeline_invalid_out.vx.yaml"
+    save_index(_index(), source)
+    # a wrong count is only found once all the batches are read
+    metadata = yaml.safe_load(open(source))
+    metadata["embeddings_count"] += 1
+    source.write_text(yaml.safe_dump(metadata))
+    target.unlink(missing_ok=True)
+    with pytest.raises(ValueError):
+        convert_index(source, target, pipeline=True, batch_size=64)
+    # nothing is written for an invalid index
+    assert not target.exists()
+
+
+def test_convert_many(runner):
+    input_dir = OUTPUT_DIR / "many_in"
+    output_dir = OUTPUT_DIR / "many_out"
+    shutil.rmtree(input_dir, ignore_errors=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    input_dir.mkdir(parents=True)
+    for i in range(4):
+        shutil.copy(EXAMPLE, input_dir / f"example{i}.yaml")
+    (input_dir / "broken.yaml").write_text("embeddings: [")
+    assert len(expand_inputs(input_dir, EmbeddingFormat.YAML)) == 5
+    assert len(expand_inputs(input_dir / "example*.yaml")) == 4
+    result = runner.invoke(main, ["convert", "-f", "yaml", str(input_dir), "-o", str(output_dir), "--jobs", "2"])
+    assert result.exit_code != 0
+    assert "1 of 5 conversions failed" in result.output
+    assert "10 embeddings" in result.output
+    for i in range(4):
+        assert load_index(output_dir / f"example{i}.yaml").embeddings_count == 10
+    results = convert_many(sorted(input_dir.glob("example*.yaml")), output_dir, jobs=1, input_format="yaml")
+    assert [r["rows"] for r in results] == [10] * 4
+    # converting in place is refused
+    results = convert_many([output_dir / "example0.yaml"], output_dir)
+    assert "overwrite" in results[0]["error"]
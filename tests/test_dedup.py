@@ -0,0 +1,121 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+import venomx as vx
+from venomx.tools import dedup
+from venomx.tools.cli import main
+from venomx.tools.dedup import ALIAS_PREFIX, connected_components, deduplicate, duplicate_labels, find_duplicates
+from venomx.tools.file_io import embeddings_matrix, load_index, save_index
+
+from tests import OUTPUT_DIR
+
+
+def _matrix(n=2000, d=32, num_duplicates=100, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((20, d))
+    matrix = centers[rng.integers(0, 20, n)] + 0.7 * rng.standard_normal((n, d))
+    originals = rng.choice(n, num_duplicates, replace=False)
+    copies = matrix[originals] + 0.005 * rng.standard_normal((num_duplicates, d))
+    return np.vstack([matrix, copies]).astype(np.float32), originals
+
+
+def _exact_labels(matrix, threshold):
+    normalized = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    i, j = np.nonzero(np.triu(normalized @ normalized.T >= threshold, 1))
+    return connected_components(len(matrix), i, j)
+
+
+def test_duplicate_labels():
+    matrix, originals = _matrix()
+    labels = duplicate_labels(matrix, threshold=0.98)
+    # each copy is grouped with its original, which comes first
+    assert labels[2000:].tolist() == originals.tolist()
+    assert np.array_equal(labels, _exact_labels(matrix, 0.98))
+    # zero vectors are not duplicates of anything
+    assert duplicate_labels(np.zeros((3, 4))).tolist() == [0, 1, 2]
+
+
+@pytest.mark.parametrize("band_bits", [8, 16, 64])
+def test_band_bits(band_bits):
+    matrix, originals = _matrix(n=500, num_duplicates=20)
+    assert duplicate_labels(matrix, threshold=0.98, band_bits=band_bits)[500:].tolist() == originals.tolist()
+    with pytest.raises(ValueError):
+        duplicate_labels(matrix, band_bits=12)
+
+
+def test_large_buckets():
+    # many copies of a vector share every band, and are compared block by block
+    matrix = np.vstack([np.tile([[1.0, 2.0, 3.0]], (500, 1)), np.eye(3)])
+    labels = duplicate_labels(matrix)
+    assert (labels[:500] == 0).all()
+    assert labels[500:].tolist() == [500, 501, 502]
+
+
+def test_many_copies():
+    rng = np.random.default_rng(0)
+    copies = np.tile(rng.standard_normal((1, 64)), (5000, 1)) + 1e-4 * rng.standard_normal((5000, 64))
+    matrix = np.vstack([copies, rng.standard_normal((1000, 64))]).astype(np.float32)
+    tracemalloc.start()
+    labels = duplicate_labels(matrix)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert (labels[:5000] == 0).all()
+    assert labels[5000:].tolist() == list(range(5000, 6000))
+    # the similar pairs of the copies (12.5M) are never listed
+    assert peak < 100 * 2**20
+
+
+@pytest.mark.parametrize("threshold", [0.98, 0.6])
+def test_large_bucket_exact(threshold):
+    # a bucket compared block by block gets the groups of all its similar pairs
+    matrix, _ = _matrix(n=300, num_duplicates=30)
+    labels = np.arange(len(matrix))
+    rows = np.random.default_rng(1).permutation(len(matrix))
+    dedup._link_similar(matrix, np.linalg.norm(matrix, axis=1), rows, threshold, labels)
+    assert np.array_equal(dedup._find(labels, np.arange(len(matrix))), _exact_labels(matrix, threshold))
+
+
+def test_deduplicate():
+    matrix, originals = _matrix(n=200, num_duplicates=10)
+    ids = np.array([f"X:{i}" for i in range(len(matrix))])
+    ix = vx.Index(objects=[{"id": x, "label": x.lower(), "metadata": ["m"]} for x in ids])
+    ix.embeddings_frame = {"id": ids, "values": matrix}
+    duplicates = find_duplicates(ix, threshold=0.98)
+    assert duplicates.num_rows == 10
+    assert min(duplicates.column("score").to_pylist()) >= 0.98
+    deduped, removed = deduplicate(ix, threshold=0.98)
+    assert removed.equals(duplicates)
+    assert deduped.embeddings_count == len(deduped.objects) == 200
+    assert embeddings_matrix(deduped)[0].tolist() == ids[:200].tolist()
+    obj = deduped.objects[int(originals[0])]
+    assert obj.label == ids[originals[0]].lower()
+    assert obj.metadata == ["m", f"{ALIAS_PREFIX}X:200"]
+    # an index without objects gets one per kept embedding
+    ix.objects = None
+    deduped, _ = deduplicate(ix, threshold=0.98)
+    assert deduped.objects.ids.to_pylist() == ids[:200].tolist()
+    assert deduped.objects[int(originals[0])].metadata == [f"{ALIAS_PREFIX}X:200"]
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "yaml"])
+def test_dedup_command(runner, output_format):
+    matrix, originals = _matrix(n=100, num_duplicates=5)
+    ids = np.array([f"X:{i}" for i in range(len(matrix))])
+    ix = vx.Index(objects=[{"id": x} for x in ids])
+    ix.embeddings_frame = {"id": ids, "values": matrix}
+    source = OUTPUT_DIR / "dedup_in.vx.yaml"
+    output = OUTPUT_DIR / f"dedup_out_{output_format}.vx.yaml"
+    save_index(ix, source)
+    result = runner.invoke(main, ["dedup", str(source), "--threshold", "0.98"])
+    assert result.exit_code == 0, result.output
+    rows = [line.split("\t") for line in result.stdout.splitlines()]
+    assert [(row[0], row[1]) for row in rows] == sorted(
+        [(f"X:{100 + i}", f"X:{x}") for i, x in enumerate(originals)], key=lambda row: int(row[1][2:])
+    )
+    assert "Duplicates: 5 in 5 groups" in result.stderr
+    result = runner.invoke(main, ["dedup", str(source), "-o", str(output), "-t", output_format, "--threshold", "0.98"])
+    assert result.exit_code == 0, result.output
+    deduped = load_index(output, format=output_format)
+    assert deduped.embeddings_count == 100
+    assert sum(len(obj.metadata or []) for obj in deduped.objects) == 5
@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+import venomx as vx
+import yaml
+from click.testing import CliRunner
+from venomx.tools.cli import main
+from venomx.tools import delta
+from venomx.tools.delta import append, compact, delete, upsert
+from venomx.tools.file_io import (
+    EmbeddingFormat,
+    LoadMode,
+    content_md5,
+    iter_embeddings,
+    load_index,
+    open_index,
+    save_index,
+    validate_file,
+)
+from venomx.tools.integrity import verify_index
+from venomx.tools.quantization import StorageDtype
+
+from tests import OUTPUT_DIR
+
+
+def _save(name, format, n=20, dim=4, **kwargs):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    outpath = OUTPUT_DIR / f"{name}.{format.value}.vx.yaml"
+    ids = [f"X:{i:03d}" for i in range(n)]
+    values = np.random.rand(n, dim).astype(np.float32)
+    ix = vx.Index(objects=[vx.NamedObject(id=x) for x in ids])
+    ix.embeddings_frame = {"id": np.array(ids, dtype=object), "values": values}
+    save_index(ix, outpath, format=format, **kwargs)
+    return outpath, ids, values
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW])
+@pytest.mark.parametrize("num_shards", [None, 3])
+def test_append_upsert_delete_compact(format, num_shards):
+    outpath, ids, values = _save("delta", format, num_shards=num_shards, row_group_size=5)
+    new = np.random.rand(2, 4).astype(np.float32)
+    append(outpath, ["Y:1", "Y:2"], new, objects=[vx.NamedObject(id="Y:1")], format=format)
+    with pytest.raises(ValueError):
+        append(outpath, ["X:000"], new[:1], format=format)
+    upsert(outpath, ["X:001", "Y:3"], new, format=format)
+    delete(outpath, ["X:002", "Y:1", "Z:404"], format=format)
+    expected_ids = ["X:000"] + ids[3:] + ["Y:2", "X:001", "Y:3"]
+    expected_values = np.vstack([values[:1], values[3:], new[1:], new])
+
+    ix = load_index(outpath, format=format, mode=LoadMode.NUMPY)
+    assert len(ix.segments) == 3
+    assert ix.segments[2].tombstones == ["X:002", "Y:1"]
+    assert ix.embeddings_count == len(expected_ids)
+    assert ix.embeddings_frame["id"].tolist() == expected_ids
+    assert np.array_equal(ix.embeddings_frame["values"], expected_values)
+    object_ids = [obj.id for obj in ix.objects]
+    assert "X:002" not in object_ids and "Y:1" not in object_ids
+    batches = list(iter_embeddings(outpath, batch_size=4, format=format))
+    assert np.concatenate([b[0] for b in batches]).tolist() == expected_ids
+    assert open_index(outpath, format=format).summary()["num_segments"] == 3
+    assert validate_file(outpath, format=format).ok
+    assert verify_index(outpath, format=format) == []
+
+    compacted = compact(outpath, format=format)
+    assert compacted.embeddings_count == len(expected_ids)
+    assert not list(OUTPUT_DIR.glob(f"{outpath.stem}.delta-*"))
+    ix2 = load_index(outpath, format=format, mode=LoadMode.NUMPY)
+    assert not ix2.segments
+    assert len(ix2.shards) == (num_shards or 0)
+    assert ix2.embeddings_frame["id"].tolist() == expected_ids
+    assert np.array_equal(ix2.embeddings_frame["values"], expected_values)
+    assert verify_index(outpath, format=format) == []
+
+
+def test_segments_change_md5():
+    format = EmbeddingFormat.PARQUET
+    outpath, ids, values = _save("delta_md5", format)
+    md5s = [load_index(outpath, mode=LoadMode.NUMPY).md5]
+    new = np.random.rand(1, 4).astype(np.float32)
+    append(outpath, ["Y:1"], new)
+    md5s.append(load_index(outpath, mode=LoadMode.NUMPY).md5)
+    delete(outpath, ["X:000"])
+    md5s.append(load_index(outpath, mode=LoadMode.NUMPY).md5)
+    assert len(set(md5s)) == 3
+    # without chunk md5s, the whole-index md5 is checked, chained with the segments
+    metadata = yaml.safe_load(open(outpath))
+    metadata.pop("chunk_md5s")
+    outpath.write_text(yaml.safe_dump(metadata))
+    assert verify_index(outpath) == []
+    metadata["md5"] = md5s[1]
+    outpath.write_text(yaml.safe_dump(metadata))
+    assert len(verify_index(outpath)) == 1
+
+    compact(outpath)
+    ix = load_index(outpath, mode=LoadMode.NUMPY)
+    assert ix.md5 == content_md5(np.array(ids[1:] + ["Y:1"]), np.vstack([values[1:], new]))
+    assert ix.chunk_md5s and verify_index(outpath) == []
+
+
+def test_failed_compact_leaves_index(monkeypatch):
+    format = EmbeddingFormat.PARQUET
+    outpath, ids, values = _save("delta_failed", format)
+    append(outpath, ["Y:1"], np.ones((1, 4)))
+    before = {path: path.read_bytes() for path in OUTPUT_DIR.glob(f"{outpath.stem}*")}
+
+    def failing_save(ix, target, **kwargs):
+        save_index(ix, target, **kwargs)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(delta, "save_index", failing_save)
+    with pytest.raises(OSError):
+        compact(outpath)
+    assert {path: path.read_bytes() for path in OUTPUT_DIR.glob(f"{outpath.stem}*")} == before
+    assert not list(OUTPUT_DIR.glob(".compact-*"))
+    assert load_index(outpath, mode=LoadMode.NUMPY).embeddings_frame["id"].tolist() == ids + ["Y:1"]
+
+
+def test_quantized_segments():
+    outpath, ids, values = _save("delta_int8", EmbeddingFormat.PARQUET, dtype=StorageDtype.INT8)
+    upsert(outpath, ["X:000"], values[:1] + 0.001)
+    ix = load_index(outpath, mode=LoadMode.NUMPY)
+    assert ix.embeddings_frame["id"].tolist() == ids[1:] + ["X:000"]
+    assert np.abs(ix.embeddings_frame["values"][-1] - values[0]).max() < 0.01
+    # compaction keeps the quantizer, and the codes of all the rows
+    before = load_index(outpath, mode=LoadMode.NUMPY, dequantize=False)
+    for _ in range(2):
+        compact(outpath)
+        after = load_index(outpath, mode=LoadMode.NUMPY, dequantize=False)
+        assert after.quantization_scale == before.quantization_scale
+        assert after.embeddings_frame["id"].tolist() == before.embeddings_frame["id"].tolist()
+        assert np.array_equal(after.embeddings_frame["values"], before.embeddings_frame["values"])
+
+
+def test_merge_and_compact_commands():
+    outpath, ids, _ = _save("delta_cli", EmbeddingFormat.PARQUET)
+    delta_path, _, _ = _save("delta_cli_new", EmbeddingFormat.PARQUET, n=25)
+    runner = CliRunner()
+    result = runner.invoke(main, ["merge", str(outpath), str(delta_path), "--mode", "append"])
+    assert result.exit_code != 0
+    result = runner.invoke(main, ["merge", str(outpath), str(delta_path), "--delete", "X:000"])
+    assert result.exit_code == 0, result.output
+    assert "Deleted: 1" in result.output
+    assert "Merged: 25" in result.output
+    result = runner.invoke(main, ["info", str(outpath)])
+    assert "Num embeddings: 25" in result.output
+    assert "Segments: 2" in result.output
+    result = runner.invoke(main, ["compact", str(outpath)])
+    assert result.exit_code == 0, result.output
+    assert "Num embeddings: 25" in result.output
@@ -0,0 +1,110 @@
+import shutil
+import threading
+import time
+
+import numpy as np
+import pytest
+import venomx as vx
+import yaml
+from click.testing import CliRunner
+from venomx.model.venomx import Model, ModelInputMethod
+from venomx.tools.cli import main
+from venomx.tools.embed import EmbeddingCache, EmbeddingPipeline, Encoder, HashingEncoder, input_text
+from venomx.tools.file_io import LoadMode, load_index
+
+from tests import OUTPUT_DIR
+
+
+class CountingEncoder(Encoder):
+    """Records the texts it is asked to embed, and the peak number of concurrent calls."""
+
+    def __init__(self, dimensions=8):
+        self.dimensions = dimensions
+        self.model = Model(name="counting", version="1")
+        self.inner = HashingEncoder(dimensions)
+        self.texts = []
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def encode(self, texts):
+        with self.lock:
+            self.texts.extend(texts)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+        return self.inner.encode(texts)
+
+
+def _objects(n, edited=()):
+    return [vx.NamedObject(id=f"X:{i}", label=f"term {i}{' edited' if i in edited else ''}") for i in range(n)]
+
+
+def test_input_text():
+    obj = vx.NamedObject(id="X:1", label="heart", metadata=["organ", ""])
+    assert input_text(obj) == "heart"
+    assert input_text(obj, ModelInputMethod(fields=["metadata", "label"])) == "organ; heart"
+    with pytest.raises(ValueError):
+        input_text(obj, ModelInputMethod(fields=["synonyms"]))
+
+
+def test_batches_are_bounded_and_ordered():
+    encoder = CountingEncoder()
+    pipeline = EmbeddingPipeline(encoder, batch_size=7, max_in_flight=3)
+    objects = _objects(100) + [vx.NamedObject(id="X:dup", label="term 0")]
+    ids, matrix = pipeline.embed_objects(objects)
+    assert ids.tolist() == [obj.id for obj in objects]
+    assert np.allclose(matrix, HashingEncoder(8).encode([obj.label for obj in objects]))
+    # the duplicate label is embedded once
+    assert len(encoder.texts) == 100
+    assert 1 < encoder.peak <= 3
+
+
+def test_cache_only_embeds_changed_objects():
+    cache_dir = OUTPUT_DIR / "embedding_cache"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    encoder = CountingEncoder()
+    EmbeddingPipeline(encoder, cache=EmbeddingCache(cache_dir)).embed_objects(_objects(50))
+    assert len(encoder.texts) == 50
+
+    encoder = CountingEncoder()
+    pipeline = EmbeddingPipeline(encoder, cache=EmbeddingCache(cache_dir))
+    ids, matrix = pipeline.embed_objects(_objects(52, edited={3}))
+    assert sorted(encoder.texts) == ["term 3 edited", "term 50", "term 51"]
+    assert (pipeline.num_encoded, pipeline.num_cached) == (3, 49)
+    assert np.allclose(matrix, HashingEncoder(8).encode([obj.label for obj in _objects(52, edited={3})]))
+
+    # another model does not share the cache entries
+    other = HashingEncoder(8)
+    pipeline = EmbeddingPipeline(other, cache=EmbeddingCache(cache_dir))
+    pipeline.embed_objects(_objects(5))
+    assert pipeline.num_cached == 0
+
+
+def test_embed_command():
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    input_path = OUTPUT_DIR / "to_embed.yaml"
+    output_path = OUTPUT_DIR / "embedded.vx.yaml"
+    cache_dir = OUTPUT_DIR / "embedding_cache_cli"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    metadata = {
+        "objects": [{"id": f"X:{i}", "label": f"term {i}", "metadata": ["x"]} for i in range(10)],
+        "embedding_input_method": {"fields": ["label", "metadata"]},
+    }
+    with open(input_path, "w") as stream:
+        yaml.safe_dump(metadata, stream)
+    runner = CliRunner()
+    args = ["embed", str(input_path), "-o", str(output_path), "--dimensions", "16", "--cache-dir", str(cache_dir)]
+    result = runner.invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert "Encoded: 10" in result.output
+    ix = load_index(output_path, mode=LoadMode.NUMPY)
+    assert ix.embedding_model.name == "hashing-16"
+    assert ix.embedding_input_method.fields == ["label", "metadata"]
+    assert ix.embeddings_frame["values"].shape == (10, 16)
+    assert np.allclose(ix.embeddings_frame["values"][0], HashingEncoder(16).encode(["term 0; x"])[0])
+    result = runner.invoke(main, args)
+    assert "Encoded: 0" in result.output
+    assert "Cached: 10" in result.output
@@ -1,9 +1,32 @@
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pytest
 import venomx as vx
-from venomx.tools.file_io import load_index, save_index
+import yaml
+from venomx.tools.file_io import (
+    EmbeddingFormat,
+    IndexWriter,
+    LoadMode,
+    content_md5,
+    embeddings_as_pandas,
+    embeddings_as_polars,
+    embeddings_matrix,
+    embeddings_table,
+    iter_embeddings,
+    load_index,
+    open_index,
+    read_embeddings_table,
+    save_index,
+    validate,
+    validate_file,
+)
+
+from venomx.tools.quantization import StorageDtype
 
-from tests import OUTPUT_DIR
+from tests import OUTPUT_DIR, TEMP_COMBINED_YAML
 
 ID = "id"
 NAME = "name"
@@ -28,6 +51,8 @@ def test_save_load():
     assert isinstance(first_arr[0], float)
     OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
     save_index(ix, outpath)
+    # the caller's frame is not modified
+    assert isinstance(ix.embeddings_frame["values"][0], list)
     ix2 = load_index(outpath)
     assert len(ix2.objects) == num_entities
     df2: pd.DataFrame = ix2.embeddings_frame
@@ -36,3 +61,335 @@ def test_save_load():
     assert df2["id"].equals(df["id"])
     assert np.isclose(first_arr[0], first_arr2[0])
     assert np.isclose(df2["values"].tolist(), df["values"].tolist()).all()
+
+
+def test_load_numpy_mode():
+    num_entities = 100
+    embedding_dim = 50
+
+    outpath = OUTPUT_DIR / "test_numpy.vx.yaml"
+    entities = [f"X:{i}" for i in range(num_entities)]
+    embeddings = np.random.rand(num_entities, embedding_dim)
+    df = pd.DataFrame({"id": entities, "values": embeddings.tolist()})
+    ix = vx.Index(objects=[vx.NamedObject(id=x) for x in entities])
+    ix.embeddings_frame = df
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    save_index(ix, outpath)
+    ix2 = load_index(outpath, mode=LoadMode.NUMPY)
+    frame = ix2.embeddings_frame
+    assert frame["values"].dtype == np.float32
+    assert frame["values"].shape == (num_entities, embedding_dim)
+    assert frame["values"].flags["C_CONTIGUOUS"]
+    assert frame["id"].tolist() == entities
+    assert np.allclose(frame["values"], embeddings.astype(np.float32))
+    assert ix2.embeddings_dimensions == embedding_dim
+    # numpy frames can be written back out
+    save_index(ix2, OUTPUT_DIR / "test_numpy2.vx.yaml")
+    ix3 = load_index(OUTPUT_DIR / "test_numpy2.vx.yaml")
+    assert np.allclose(ix3.embeddings_frame["values"].tolist(), frame["values"])
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW, EmbeddingFormat.YAML])
+def test_load_arrow_mode(format):
+    entities = [f"X:{i}" for i in range(100)]
+    embeddings = np.random.rand(100, 16).astype(np.float32)
+    ix = vx.Index(objects=[vx.NamedObject(id=x) for x in entities])
+    ix.embeddings_frame = {"id": np.array(entities, dtype=object), "values": embeddings}
+    outpath = OUTPUT_DIR / f"test_arrow_mode.{format.value}.vx.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    save_index(ix, outpath, format=format, row_group_size=30)
+    ix2 = load_index(outpath, format=format, mode=LoadMode.ARROW)
+    table = ix2.embeddings_frame
+    assert isinstance(table, pa.Table)
+    assert table.schema.field("values").type == pa.list_(pa.float32(), 16)
+    assert table.column("id").to_pylist() == entities
+    assert np.allclose(embeddings_matrix(ix2)[1], embeddings, atol=1e-6)
+    # arrow frames are saved as is, and keep their content md5
+    save_index(ix2, OUTPUT_DIR / "test_arrow_mode_copy.vx.yaml")
+    assert load_index(OUTPUT_DIR / "test_arrow_mode_copy.vx.yaml").md5 == content_md5(*embeddings_matrix(ix2))
+
+
+def test_frame_views():
+    matrix = np.random.rand(10, 4).astype(np.float32)
+    ix = vx.Index(embeddings_frame={"id": np.array([f"X:{i}" for i in range(10)]), "values": matrix})
+    table = embeddings_table(ix)
+    assert np.shares_memory(table.column("values").chunk(0).flatten().to_numpy(), matrix)
+
+    df = embeddings_as_pandas(ix)
+    assert isinstance(df["values"].dtype, pd.ArrowDtype)
+    ix2 = vx.Index(embeddings_frame=df)
+    ids, matrix2 = embeddings_matrix(ix2)
+    assert np.shares_memory(matrix2, matrix)
+    assert ids.tolist() == ix.embeddings_frame["id"].tolist()
+    assert validate(ix2).num_rows == 10
+
+    # list-valued arrow tables are converted chunk by chunk, without copying float32 values
+    chunked = pa.Table.from_batches(table.to_batches(max_chunksize=3)).cast(
+        pa.schema([("id", pa.string()), ("values", pa.list_(pa.float32()))])
+    )
+    assert embeddings_table(vx.Index(embeddings_frame=chunked)).equals(table)
+
+
+def test_frame_polars():
+    pl = pytest.importorskip("polars")
+    ix = vx.Index(embeddings_frame={"id": np.array(["A", "B"]), "values": np.eye(2, dtype=np.float32)})
+    df = embeddings_as_polars(ix)
+    assert isinstance(df, pl.DataFrame)
+    assert df["id"].to_list() == ["A", "B"]
+    assert df["values"].to_list() == [[1.0, 0.0], [0.0, 1.0]]
+
+
+@pytest.mark.parametrize("format,fixed_size", [(EmbeddingFormat.ARROW, True), (EmbeddingFormat.PARQUET, True)])
+def test_fixed_size_memory_map(format, fixed_size):
+    num_entities = 100
+    embedding_dim = 50
+
+    outpath = OUTPUT_DIR / f"test_fixed.{format.value}.vx.yaml"
+    entities = [f"X:{i}" for i in range(num_entities)]
+    embeddings = np.random.rand(num_entities, embedding_dim).astype(np.float32)
+    ix = vx.Index(objects=[vx.NamedObject(id=x) for x in entities])
+    ix.embeddings_frame = {"id": np.array(entities, dtype=object), "values": embeddings}
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    save_index(ix, outpath, format=format, fixed_size=fixed_size)
+    embeddings_path = Path(str(outpath).replace(".yaml", f".{format.value}"))
+    schema = read_embeddings_table(embeddings_path, format).schema
+    assert schema.field("values").type.list_size == embedding_dim
+    ix2 = load_index(outpath, format=format, mode=LoadMode.NUMPY, memory_map=True)
+    matrix = ix2.embeddings_frame["values"]
+    assert matrix.shape == (num_entities, embedding_dim)
+    assert np.array_equal(matrix, embeddings)
+    if format == EmbeddingFormat.ARROW:
+        # backed by the memory map, not a heap copy
+        assert not matrix.flags["OWNDATA"]
+        assert not matrix.flags["WRITEABLE"]
+    ix3 = load_index(outpath, format=format)
+    assert np.allclose(ix3.embeddings_frame["values"].tolist(), embeddings)
+
+
+def test_index_writer_streaming():
+    outpath = OUTPUT_DIR / "test_writer.vx.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    rng = np.random.default_rng(0)
+    batches = [rng.random((30, 8), dtype=np.float32) for _ in range(4)]
+    ix = vx.Index(id="streamed")
+    with IndexWriter(ix, outpath, row_group_size=40) as writer:
+        for i, batch in enumerate(batches):
+            writer.write_batch([f"X:{i}_{j}" for j in range(len(batch))], batch)
+    ix2 = load_index(outpath, mode=LoadMode.NUMPY)
+    assert ix2.embeddings_dimensions == 8
+    assert ix2.embeddings_count == 120
+    assert np.array_equal(ix2.embeddings_frame["values"], np.vstack(batches))
+    ix3 = vx.Index(id="saved")
+    ix3.embeddings_frame = ix2.embeddings_frame
+    save_index(ix3, OUTPUT_DIR / "test_writer2.vx.yaml")
+    assert load_index(OUTPUT_DIR / "test_writer2.vx.yaml").md5 == ix2.md5
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW])
+def test_empty_round_trip(format):
+    outpath = OUTPUT_DIR / f"test_empty.{format.value}.vx.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    ix = vx.Index()
+    ix.embeddings_frame = {"id": np.array([], dtype=object), "values": np.empty((0, 4), dtype=np.float32)}
+    save_index(ix, outpath, format=format)
+    ix2 = load_index(outpath, format=format, mode=LoadMode.NUMPY)
+    assert ix2.embeddings_count == 0
+    assert len(ix2.embeddings_frame["id"]) == len(ix2.embeddings_frame["values"]) == 0
+
+
+def test_index_writer_failure_writes_no_metadata():
+    outpath = OUTPUT_DIR / "test_writer_fail.vx.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    outpath.unlink(missing_ok=True)
+    with pytest.raises(ValueError):
+        with IndexWriter(vx.Index(), outpath) as writer:
+            writer.write_batch(["X:1"], np.zeros((1, 4)))
+            writer.write_batch(["X:2"], np.zeros((1, 5)))
+    assert not outpath.exists()
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW])
+def test_iter_embeddings(format):
+    outpath = OUTPUT_DIR / f"test_iter.{format.value}.vx.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    matrix = np.random.default_rng(0).random((250, 12), dtype=np.float32)
+    entities = np.array([f"X:{i}" for i in range(250)], dtype=object)
+    ix = vx.Index()
+    ix.embeddings_frame = {"id": entities, "values": matrix}
+    save_index(ix, outpath, format=format)
+    batches = list(iter_embeddings(outpath, batch_size=100, format=format))
+    assert [len(ids) for ids, _ in batches] == [100, 100, 50]
+    assert np.array_equal(np.vstack([m for _, m in batches]), matrix)
+    wanted = ["X:3", "X:120", "X:249"]
+    selected = list(iter_embeddings(outpath, batch_size=100, ids=wanted, format=format))
+    assert [x for ids, _ in selected for x in ids] == wanted
+    assert np.array_equal(np.vstack([m for _, m in selected]), matrix[[3, 120, 249]])
+    only_ids = list(iter_embeddings(outpath, columns=["id"], format=format))
+    assert only_ids[0][1] is None
+    with pytest.raises(ValueError):
+        list(iter_embeddings(outpath, dimensions=13, format=format))
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.YAML, EmbeddingFormat.JSON])
+def test_all_in_one_round_trip(format):
+    outpath = OUTPUT_DIR / f"test_all_in_one.{format.value}"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    matrix = np.random.default_rng(0).random((30, 6), dtype=np.float32)
+    entities = [f"X:{i}" for i in range(30)] + ['Y:"quoted"']
+    matrix = np.vstack([matrix, np.full((1, 6), 1e-30, dtype=np.float32)])
+    ix = vx.Index(id="aio", objects=[vx.NamedObject(id=x) for x in entities])
+    ix.embeddings_frame = {"id": np.array(entities, dtype=object), "values": matrix}
+    save_index(ix, outpath, format=format)
+    if format == EmbeddingFormat.YAML:
+        # one flow-style line per vector
+        assert "  values: [" in outpath.read_text()
+    ix2 = load_index(outpath, format=format, mode=LoadMode.NUMPY)
+    assert ix2.id == "aio"
+    assert ix2.embeddings_frame["id"].tolist() == entities
+    assert np.array_equal(ix2.embeddings_frame["values"], matrix)
+    ix3 = load_index(outpath, format=format)
+    assert ix3.embeddings_frame["id"].tolist() == entities
+
+
+def test_flow_style_yaml_bad_values():
+    outpath = OUTPUT_DIR / "test_bad_values.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    ix = vx.Index()
+    ix.embeddings_frame = {"id": np.array(["A", "B"], dtype=object), "values": np.ones((2, 3), dtype=np.float32)}
+    save_index(ix, outpath, format=EmbeddingFormat.YAML)
+    text = outpath.read_text()
+    # values that are not plain numbers are left to the YAML parser
+    outpath.write_text(text.replace("[1.0, 1.0, 1.0]", "[1.0, .nan, 1.0]", 1))
+    values = load_index(outpath, format=EmbeddingFormat.YAML, mode=LoadMode.NUMPY).embeddings_frame["values"]
+    assert np.isnan(values[0, 1]) and values[1].tolist() == [1.0, 1.0, 1.0]
+    for bad in ["[1.0, oops, 1.0]", "[1.0, , 1.0]", "[]"]:
+        outpath.write_text(text.replace("[1.0, 1.0, 1.0]", bad, 1))
+        with pytest.raises((ValueError, yaml.YAMLError)):
+            load_index(outpath, format=EmbeddingFormat.YAML, mode=LoadMode.NUMPY)
+
+
+def test_block_style_yaml():
+    ix = load_index(TEMP_COMBINED_YAML, format=EmbeddingFormat.YAML, mode=LoadMode.NUMPY)
+    assert ix.embeddings_frame["values"].shape == (10, 20)
+    assert np.isclose(ix.embeddings_frame["values"][0, 0], 0.6947795152664185)
+
+
+@pytest.mark.parametrize("format,fixed_size", [(EmbeddingFormat.PARQUET, False), (EmbeddingFormat.ARROW, True)])
+def test_open_index_is_lazy(format, fixed_size):
+    outpath = OUTPUT_DIR / f"test_lazy.{format.value}.vx.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    entities = [f"X:{i}" for i in range(100)]
+    ix = vx.Index(id="lazy", objects=[vx.NamedObject(id=x) for x in entities])
+    ix.embeddings_frame = {"id": np.array(entities, dtype=object), "values": np.random.rand(100, 7)}
+    save_index(ix, outpath, format=format, row_group_size=30)
+    lix = open_index(outpath, format=format)
+    summary = lix.summary()
+    assert summary["num_rows"] == 100
+    assert summary["num_objects"] == 100
+    assert summary["dimensions"] == 7
+    assert summary["num_bytes"] > 0
+    assert "values" in summary["schema"]
+    if format == EmbeddingFormat.PARQUET:
+        assert summary["num_row_groups"] == 4
+    assert lix._loaded is None
+    assert lix.index.id == "lazy"
+    assert len(lix.embeddings_frame["values"]) == 100
+    assert lix.load(mode=LoadMode.NUMPY).embeddings_frame["values"].shape == (100, 7)
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW, EmbeddingFormat.YAML])
+def test_validate_report(format):
+    outpath = OUTPUT_DIR / f"test_validate.{format.value}.vx.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    entities = [f"X:{i}" for i in range(100)]
+    ix = vx.Index(objects=[vx.NamedObject(id=x) for x in entities[:98]])
+    values = np.random.rand(100, 5) + 0.1
+    values[[3, 70]] = 0.0
+    values[50, 2] = np.nan
+    values[90, 0] = np.inf
+    entities[60] = "X:10"
+    ix.embeddings_frame = {"id": np.array(entities, dtype=object), "values": values}
+    report = validate(ix)
+    assert report.ok
+    save_index(ix, outpath, format=format, row_group_size=32)
+    report = validate_file(outpath, format=format, batch_size=32)
+    assert report.ok
+    assert report.num_rows == 100
+    assert report.dimensions == 5
+    issues = report.to_dict()["issues"]
+    assert issues["zero_vector"]["rows"] == [3, 70]
+    assert issues["non_finite"]["rows"] == [50, 90]
+    assert issues["duplicate_id"]["rows"] == [60]
+    assert issues["missing_object"]["rows"] == [98, 99]
+    assert all(v["severity"] == "warning" for v in issues.values())
+
+
+def test_validate_inconsistent_dimensions():
+    ix = vx.Index(embeddings_dimensions=3)
+    ix.embeddings_frame = pd.DataFrame(
+        {"id": ["A", "B", "C"], "values": [[1.0, 2.0, 3.0], [1.0, 2.0], [1.0, 2.0, 3.0]]}
+    )
+    report = validate(ix, raise_errors=False)
+    assert not report.ok
+    assert report.to_dict()["issues"]["inconsistent_dimensions"]["rows"] == [1]
+    with pytest.raises(ValueError, match="inconsistent_dimensions"):
+        validate(ix)
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW])
+@pytest.mark.parametrize("dtype,tolerance", [(StorageDtype.FLOAT16, 1e-3), (StorageDtype.INT8, 1e-2)])
+def test_reduced_precision_round_trip(format, dtype, tolerance):
+    outpath = OUTPUT_DIR / f"test_{dtype.value}.{format.value}.vx.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    entities = [f"X:{i}" for i in range(100)]
+    values = np.random.rand(100, 16).astype(np.float32)
+    ix = vx.Index()
+    ix.embeddings_frame = {"id": np.array(entities, dtype=object), "values": values}
+    save_index(ix, outpath, format=format, dtype=dtype)
+    assert open_index(outpath, format=format).summary()["dtype"] == dtype.value
+    ix2 = load_index(outpath, format=format, mode=LoadMode.NUMPY)
+    assert ix2.embeddings_dtype == dtype.value
+    assert ix2.embeddings_frame["values"].dtype == np.float32
+    assert np.abs(ix2.embeddings_frame["values"] - values).max() < tolerance
+    assert np.allclose(load_index(outpath, format=format).embeddings_frame["values"].tolist(), values, atol=tolerance)
+    raw = load_index(outpath, format=format, mode=LoadMode.NUMPY, dequantize=False)
+    assert raw.embeddings_frame["values"].dtype == np.dtype(dtype.value)
+    assert np.array_equal(embeddings_matrix(raw)[1], ix2.embeddings_frame["values"])
+    # converting back to float32 drops the quantization metadata
+    save_index(ix2, outpath, format=format)
+    assert load_index(outpath, format=format).quantization_scale == []
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW])
+def test_sharded_round_trip(format):
+    outpath = OUTPUT_DIR / f"test_sharded.{format.value}.vx.yaml"
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    entities = [f"X:{i:03d}" for i in range(100)]
+    values = np.random.rand(100, 8).astype(np.float32)
+    ix = vx.Index(objects=[vx.NamedObject(id=x) for x in entities])
+    ix.embeddings_frame = {"id": np.array(entities, dtype=object), "values": values}
+    save_index(ix, outpath, format=format, num_shards=4, row_group_size=10)
+    suffix = ".parquet" if format == EmbeddingFormat.PARQUET else ".arrow"
+    assert not outpath.with_suffix(suffix).exists()
+    ix2 = load_index(outpath, format=format, mode=LoadMode.NUMPY, workers=2)
+    assert [(s.count, s.min_id, s.max_id) for s in ix2.shards] == [
+        (25, "X:000", "X:024"),
+        (25, "X:025", "X:049"),
+        (25, "X:050", "X:074"),
+        (25, "X:075", "X:099"),
+    ]
+    assert ix2.embeddings_frame["id"].tolist() == entities
+    assert np.array_equal(ix2.embeddings_frame["values"], values)
+    assert len(load_index(outpath, format=format).embeddings_frame) == 100
+    batches = list(iter_embeddings(outpath, batch_size=10, format=format, workers=3))
+    assert np.concatenate([ids for ids, _ in batches]).tolist() == entities
+    assert np.array_equal(np.vstack([matrix for _, matrix in batches]), values)
+    summary = open_index(outpath, format=format).summary()
+    assert summary["num_shards"] == 4
+    assert summary["num_rows"] == 100
+    assert validate_file(outpath, format=format).ok
+    # the index md5 does not depend on the sharding, the chunk md5s follow the row groups of the shards
+    unsharded = OUTPUT_DIR / f"test_unsharded.{format.value}.vx.yaml"
+    save_index(ix, unsharded, format=format, row_group_size=10)
+    assert load_index(unsharded, format=format).md5 == ix2.md5
+    assert len(ix2.chunk_md5s) == (12 if format == EmbeddingFormat.PARQUET else 4)
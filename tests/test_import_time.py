@@ -0,0 +1,48 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# cumulative import time of the command line module; without numpy, pandas and pyarrow it is well under this
+IMPORT_BUDGET_SECONDS = 0.5
+HEAVY_MODULES = ["numpy", "pandas", "pyarrow", "yaml", "pydantic", "venomx.model.venomx"]
+
+
+def _run(code: str, *args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(  # noqa: S603 - runs this python
+        [sys.executable, *args, "-c", code], capture_output=True, text=True, check=True, timeout=60
+    )
+
+
+def _imported_after(code: str) -> list:
+    check = f"import sys\n{code}\nprint(__import__('json').dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    return json.loads(_run(check).stdout.strip().splitlines()[-1])
+
+
+def test_import_is_lazy():
+    assert _imported_after("import venomx") == []
+    assert _imported_after("import venomx.tools.cli") == []
+    # the models are imported on first access
+    assert "venomx.model.venomx" in _imported_after("import venomx; venomx.Index")
+
+
+def test_import_time_budget():
+    stderr = _run("import venomx.tools.cli", "-X", "importtime").stderr
+    # import time: self [us] | cumulative | imported package
+    rows = [line.split("|") for line in stderr.splitlines() if line.count("|") == 2]
+    cumulative = {row[2].strip(): int(row[1]) for row in rows if row[1].strip().isdigit()}
+    assert cumulative["venomx.tools.cli"] / 1e6 < IMPORT_BUDGET_SECONDS
+
+
+@pytest.mark.parametrize("command", ["--help", "info"])
+def test_command_imports(command, create_test_index_files):
+    args = ["--help"] if command == "--help" else [command, str(create_test_index_files)]
+    imported = _imported_after(
+        "from click.testing import CliRunner\n"
+        "from venomx.tools.cli import main\n"
+        f"assert CliRunner().invoke(main, {args!r}).exit_code == 0"
+    )
+    # info only reads the metadata and the footer, and creates no pydantic models
+    assert "pandas" not in imported
+    assert "pydantic" not in imported
@@ -0,0 +1,67 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import venomx as vx
+from venomx.tools.cli import main
+from venomx.tools.file_io import EmbeddingFormat, IndexWriter, load_index, save_index
+from venomx.tools.integrity import verify_index
+
+from tests import OUTPUT_DIR
+
+
+def _write(path, format=EmbeddingFormat.PARQUET, row_group_size=10):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    matrix = np.random.default_rng(1).random((35, 4), dtype=np.float32)
+    with IndexWriter(vx.Index(), path, format=format, row_group_size=row_group_size) as writer:
+        writer.write_batch([f"X:{i}" for i in range(35)], matrix)
+    return matrix
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW])
+def test_verify_ok(format):
+    path = OUTPUT_DIR / f"verify_ok.{format.value}.vx.yaml"
+    _write(path, format)
+    ix = load_index(path, format=format)
+    assert len(ix.chunk_md5s) == 4
+    assert verify_index(path, format=format) == []
+
+
+def test_md5_is_layout_independent():
+    path = OUTPUT_DIR / "verify_layout.vx.yaml"
+    matrix = _write(path, row_group_size=7)
+    ix = vx.Index()
+    ix.embeddings_frame = {"id": np.array([f"X:{i}" for i in range(35)]), "values": matrix}
+    save_index(ix, OUTPUT_DIR / "verify_layout2.vx.yaml", format=EmbeddingFormat.ARROW)
+    assert load_index(path).md5 == load_index(OUTPUT_DIR / "verify_layout2.vx.yaml", format="arrow").md5
+
+
+def test_verify_finds_corrupted_chunk(runner):
+    path = OUTPUT_DIR / "verify_bad.vx.yaml"
+    matrix = _write(path)
+    # rewrite the embeddings with one changed value in the third row group, same layout
+    matrix[22, 1] += 1.0
+    parquet_path = OUTPUT_DIR / "verify_bad.vx.parquet"
+    table = pq.read_table(parquet_path)
+    values = pa.ListArray.from_arrays(pa.array(np.arange(0, 36 * 4, 4, dtype=np.int32)), pa.array(matrix.ravel()))
+    pq.write_table(pa.table({"id": table.column("id"), "values": values}), parquet_path, row_group_size=10)
+    failures = verify_index(path)
+    assert [f["chunk"] for f in failures] == [2]
+    assert failures[0]["first_row"] == 20
+    result = runner.invoke(main, ["verify", str(path)])
+    assert result.exit_code != 0
+    assert "Corrupted chunk 2 (rows 20-29)" in result.output
+    _write(path)
+    result = runner.invoke(main, ["verify", str(path)])
+    assert result.exit_code == 0
+    assert "OK" in result.output
+
+
+def test_verify_sharded():
+    path = OUTPUT_DIR / "verify_sharded.vx.yaml"
+    matrix = _write(OUTPUT_DIR / "verify_unsharded.vx.yaml")
+    ix = vx.Index()
+    ix.embeddings_frame = {"id": np.array([f"X:{i}" for i in range(35)]), "values": matrix}
+    save_index(ix, path, num_shards=3, row_group_size=5)
+    assert load_index(path).md5 == load_index(OUTPUT_DIR / "verify_unsharded.vx.yaml").md5
+    assert verify_index(path) == []
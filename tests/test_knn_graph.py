@@ -0,0 +1,113 @@
+import numpy as np
+import pyarrow.parquet as pq
+import pytest
+import venomx as vx
+from venomx.tools.cli import main
+from venomx.tools.file_io import save_index
+from venomx.tools.knn_graph import SCORE, SOURCE_ID, TARGET_ID, knn_graph, save_knn_graph
+from venomx.tools.search import SearchMetric
+
+from tests import OUTPUT_DIR
+
+
+def _index(n=50, prefix="X", seed=0) -> vx.Index:
+    ix = vx.Index()
+    ids = np.array([f"{prefix}:{i}" for i in range(n)], dtype=object)
+    ix.embeddings_frame = {"id": ids, "values": np.random.default_rng(seed).random((n, 8), dtype=np.float32)}
+    return ix
+
+
+def _brute_force(source: vx.Index, target: vx.Index, k: int, metric: SearchMetric, exclude_self: bool) -> dict:
+    queries = source.embeddings_frame["values"]
+    matrix = target.embeddings_frame["values"]
+    if metric == SearchMetric.EUCLIDEAN:
+        scores = -np.linalg.norm(queries[:, None, :] - matrix[None, :, :], axis=2)
+    else:
+        normalized = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+        scores = queries @ normalized.T
+    if exclude_self:
+        np.fill_diagonal(scores, -np.inf)
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    target_ids = target.embeddings_frame["id"]
+    return {
+        source_id: set(target_ids[row]) for source_id, row in zip(source.embeddings_frame["id"], order, strict=True)
+    }
+
+
+def _neighbours(table) -> dict:
+    neighbours = {}
+    for source_id, target_id in zip(
+        table.column(SOURCE_ID).to_pylist(), table.column(TARGET_ID).to_pylist(), strict=True
+    ):
+        neighbours.setdefault(source_id, set()).add(target_id)
+    return neighbours
+
+
+@pytest.mark.parametrize("metric", [SearchMetric.COSINE, SearchMetric.EUCLIDEAN])
+def test_knn_graph_matches_brute_force(metric):
+    ix = _index()
+    table = knn_graph(ix, k=5, metric=metric)
+    assert table.num_rows == 50 * 5
+    assert table.column(SOURCE_ID).to_pylist() == [x for x in ix.embeddings_frame["id"] for _ in range(5)]
+    assert _neighbours(table) == _brute_force(ix, ix, 5, metric, exclude_self=True)
+    scores = table.column(SCORE).to_numpy().reshape(50, 5)
+    assert (
+        (np.diff(scores, axis=1) <= 0).all() if metric == SearchMetric.COSINE else (np.diff(scores, axis=1) >= 0).all()
+    )
+
+    # tiles of a few rows, scored by several workers, give the same graph
+    tiled = knn_graph(ix, k=5, metric=metric, memory_budget=16 * 7 * 7 * 3, workers=3)
+    assert tiled.column(SOURCE_ID).equals(table.column(SOURCE_ID))
+    assert _neighbours(tiled) == _neighbours(table)
+    np.testing.assert_allclose(tiled.column(SCORE).to_numpy(), table.column(SCORE).to_numpy(), rtol=1e-5)
+
+
+def test_knn_graph_cross_index():
+    source, target = _index(30, "A", seed=1), _index(40, "B", seed=2)
+    table = knn_graph(source, target, k=3, memory_budget=16 * 100)
+    assert table.num_rows == 30 * 3
+    assert _neighbours(table) == _brute_force(source, target, 3, SearchMetric.COSINE, exclude_self=False)
+
+    with pytest.raises(ValueError):
+        knn_graph(source, vx.Index(embeddings_frame={"id": np.array(["C:1"]), "values": np.ones((1, 4))}))
+
+
+def test_knn_graph_options():
+    ix = _index(20)
+    assert knn_graph(ix, k=30).num_rows == 20 * 19
+    included = knn_graph(ix, k=1, exclude_self=False)
+    assert included.column(TARGET_ID).to_pylist() == included.column(SOURCE_ID).to_pylist()
+    threshold = float(np.median(knn_graph(ix, k=3).column(SCORE).to_numpy()))
+    filtered = knn_graph(ix, k=3, threshold=threshold)
+    assert 0 < filtered.num_rows < 60
+    assert min(filtered.column(SCORE).to_pylist()) >= threshold
+
+
+def test_save_knn_graph():
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    path = OUTPUT_DIR / "knn_graph.parquet"
+    ix = _index()
+    assert save_knn_graph(ix, path, k=4, memory_budget=16 * 64) == 200
+    metadata = pq.read_metadata(path)
+    assert metadata.num_row_groups > 1
+    assert pq.read_table(path).equals(knn_graph(ix, k=4))
+
+
+def test_knn_graph_command(runner):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    source, target = OUTPUT_DIR / "knn_source.vx.yaml", OUTPUT_DIR / "knn_target.vx.yaml"
+    output = OUTPUT_DIR / "knn_cli.parquet"
+    save_index(_index(30, "A", seed=1), source)
+    save_index(_index(40, "B", seed=2), target)
+    result = runner.invoke(main, ["knn-graph", str(source), "-o", str(output), "-k", "3"])
+    assert result.exit_code == 0, result.output
+    assert "Pairs: 90" in result.output
+    table = pq.read_table(output)
+    assert table.column_names == [SOURCE_ID, TARGET_ID, SCORE]
+    assert all(x.startswith("A:") for x in table.column(TARGET_ID).to_pylist())
+
+    result = runner.invoke(
+        main, ["knn-graph", str(source), str(target), "-o", str(output), "-k", "2", "--metric", "euclidean"]
+    )
+    assert result.exit_code == 0, result.output
+    assert all(x.startswith("B:") for x in pq.read_table(output).column(TARGET_ID).to_pylist())
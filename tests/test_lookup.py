@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import venomx as vx
+from venomx.tools.file_io import LoadMode, load_index, save_index
+from venomx.tools.id_map import IdMap, hash_ids, id_map_path
+from venomx.tools.lookup import get_id_map, get_rows, get_vectors
+
+from tests import OUTPUT_DIR
+
+HP = "http://purl.obolibrary.org/obo/HP_"
+
+
+def test_id_map_collisions_and_probing():
+    ids = [f"X:{i}" for i in range(5000)]
+    m = IdMap.build(ids)
+    assert m.num_rows == 5000
+    assert len(m.slots) >= 10000
+    queries = ids[::-1] + ["nope"]
+    assert m.lookup(queries).tolist() == list(range(4999, -1, -1)) + [-1]
+    # hashes that map to the same slot are resolved by probing
+    m2 = IdMap.from_hashes(np.array([5, 13, 6], dtype=np.uint64))
+    assert len(m2.slots) == 8
+    assert m2.lookup_hashes(np.array([13, 5, 6, 21], dtype=np.uint64)).tolist() == [1, 0, 2, -1]
+    assert len(set(hash_ids(ids).tolist())) == len(ids)
+
+
+@pytest.mark.parametrize("mode", [LoadMode.PANDAS, LoadMode.NUMPY])
+def test_get_vectors_from_saved_index(mode):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    path = OUTPUT_DIR / "lookup.vx.yaml"
+    entities = [f"HP:{i:07d}" for i in range(300)]
+    matrix = np.random.default_rng(0).random((300, 6), dtype=np.float32)
+    ix = vx.Index(prefixes=[vx.model.venomx.Prefix(prefix="HP", namespace=HP)])
+    ix.embeddings_frame = {"id": np.array(entities, dtype=object), "values": matrix}
+    save_index(ix, path)
+    assert id_map_path(path).exists()
+    ix2 = load_index(path, mode=mode)
+    # the persisted, memory mapped map is used
+    assert isinstance(get_id_map(ix2).slots, np.memmap)
+    vectors = get_vectors(ix2, ["HP:0000007", f"{HP}0000123", "HP:0000299"])
+    assert np.array_equal(vectors, matrix[[7, 123, 299]])
+    with pytest.raises(KeyError):
+        get_vectors(ix2, ["HP:9999999"])
+    loose = get_vectors(ix2, ["HP:9999999", "HP:0000001"], strict=False)
+    assert np.isnan(loose[0]).all()
+    assert np.array_equal(loose[1], matrix[1])
+    assert get_rows(ix2, ["HP:0000002", "MP:1"]).tolist() == [2, -1]
@@ -0,0 +1,133 @@
+import time
+
+import numpy as np
+import pyarrow as pa
+import pytest
+import venomx as vx
+import yaml
+from venomx.model.objects_pa import ObjectTable
+from venomx.tools.cli import main
+from venomx.tools.delta import append, delete
+from venomx.tools.file_io import (
+    EmbeddingFormat,
+    _index_from_metadata,
+    load_index,
+    objects_table_path,
+    open_index,
+    save_index,
+    validate_file,
+)
+
+from tests import OUTPUT_DIR
+
+
+def _index(n=20):
+    ids = [f"X:{i}" for i in range(n)]
+    ix = vx.Index(objects=[vx.NamedObject(id=x, label=f"term {x}", metadata=["m"]) for x in ids])
+    ix.embeddings_frame = {"id": np.array(ids), "values": np.random.default_rng(0).random((n, 4))}
+    return ix
+
+
+def test_object_table():
+    objects = ObjectTable.from_records([{"id": "A", "label": "a", "metadata": ["x", "y"]}, {"id": "B"}, {"id": "C"}])
+    assert len(objects) == 3
+    assert objects[-1].id == "C"
+    assert objects[0] == vx.NamedObject(id="A", label="a", metadata=["x", "y"])
+    assert [obj.id for obj in objects[::2]] == ["A", "C"]
+    assert objects == [
+        vx.NamedObject(id="A", label="a", metadata=["x", "y"]),
+        vx.NamedObject(id="B"),
+        vx.NamedObject(id="C"),
+    ]
+    assert objects.labels.to_pylist() == ["a", None, None]
+    assert ObjectTable.from_objects(list(objects)) == objects
+    with pytest.raises(IndexError):
+        objects[3]
+    with pytest.raises(ValueError):
+        ObjectTable.from_records([{"id": "A", "synonyms": ["b"]}])
+    with pytest.raises(ValueError):
+        ObjectTable.from_records([{"label": "no id"}])
+    with pytest.raises(ValueError):
+        ObjectTable.from_records([{"id": "A", "metadata": "not a list"}])
+    ix = vx.Index(objects=objects)
+    assert ix.objects is objects
+
+
+def test_objects_loaded_as_table():
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    path = OUTPUT_DIR / "objects_inline.vx.yaml"
+    save_index(_index(), path)
+    ix = load_index(path)
+    assert isinstance(ix.objects, ObjectTable)
+    assert ix.objects == _index().objects
+    with open(path) as stream:
+        assert len(yaml.safe_load(stream)["objects"]) == 20
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW])
+def test_objects_table_file(format):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    path = OUTPUT_DIR / f"objects_table_{format.value}.vx.yaml"
+    save_index(_index(), path, format=format, objects_table=True)
+    with open(path) as stream:
+        metadata = yaml.safe_load(stream)
+    assert "objects" not in metadata
+    assert metadata["objects_path"] == objects_table_path(path).name
+    assert open_index(path, format=format).num_objects == 20
+    ix = load_index(path, format=format)
+    assert ix.objects == _index().objects
+
+    # an index loaded from an objects table keeps it
+    save_index(ix, path, format=format)
+    assert load_index(path, format=format).objects_path
+
+    # embeddings without objects are reported
+    ix.objects = ix.objects[:18]
+    save_index(ix, path, format=format)
+    report = validate_file(path, format=format)
+    assert report.to_dict()["issues"]["missing_object"]["count"] == 2
+
+    append(path, ["Y:1"], np.ones((1, 4)), objects=[vx.NamedObject(id="Y:1")], format=format)
+    delete(path, ["X:0"], format=format)
+    ids = load_index(path, format=format, check=False).objects.ids.to_pylist()
+    assert ids == [f"X:{i}" for i in range(1, 18)] + ["Y:1"]
+
+
+def test_convert_objects_table(runner):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    source = OUTPUT_DIR / "objects_convert.vx.yaml"
+    target = OUTPUT_DIR / "objects_convert_out.vx.yaml"
+    ix = _index()
+    ix.objects = ObjectTable(pa.table({"id": ix.embeddings_frame["id"]}))
+    save_index(ix, source)
+    result = runner.invoke(main, ["convert", str(source), "-t", "parquet", "-o", str(target), "--objects-table"])
+    assert result.exit_code == 0, result.output
+    assert objects_table_path(target).exists()
+    assert len(load_index(target).objects) == 20
+    result = runner.invoke(main, ["convert", str(target), "-t", "yaml", "-o", str(source)])
+    assert result.exit_code == 0, result.output
+    assert load_index(source, format=EmbeddingFormat.YAML).objects.ids.to_pylist() == ix.objects.ids.to_pylist()
+
+
+def test_object_table_not_validated_per_object(monkeypatch):
+    n = 100_000
+    records = [{"id": f"X:{i}", "label": f"term {i}"} for i in range(n)]
+    metadata = {"id": "big", "objects": records}
+    start = time.perf_counter()
+    ix = _index_from_metadata(metadata, OUTPUT_DIR / "big.vx.yaml")
+    assert time.perf_counter() - start < 2
+    assert isinstance(ix.objects, ObjectTable)
+    # assigning a table (validate_assignment) keeps it as is, without creating objects
+    monkeypatch.setattr(ObjectTable, "__iter__", lambda self: pytest.fail("objects were iterated"))
+    table = ix.objects
+    ix.objects = table
+    assert ix.objects is table
+    assert vx.Index(objects=table).objects is table
+    # the table is read without being converted either
+    source = OUTPUT_DIR / "big_objects.vx.yaml"
+    small = vx.Index(objects=table)
+    small.embeddings_frame = {"id": table.ids.to_numpy(zero_copy_only=False), "values": np.ones((n, 2))}
+    save_index(small, source, objects_table=True)
+    start = time.perf_counter()
+    assert len(load_index(source, mode="numpy").objects) == n
+    assert time.perf_counter() - start < 2
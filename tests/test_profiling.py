@@ -0,0 +1,49 @@
+import json
+
+from venomx.tools import profiling
+from venomx.tools.cli import main
+from venomx.tools.file_io import EmbeddingFormat, load_index, save_index
+
+from tests import INPUT_DIR, OUTPUT_DIR
+
+EXAMPLE = INPUT_DIR / "example.combined.yaml"
+
+
+def test_disabled_records_nothing():
+    assert profiling.get_profiler() is None
+    assert profiling.phase("x") is profiling.phase("y")
+    profiling.count(nbytes=10)
+    load_index(EXAMPLE, format=EmbeddingFormat.YAML)
+    assert profiling.get_profiler() is None
+
+
+def test_phases_of_load_and_save():
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    ix = load_index(EXAMPLE, format=EmbeddingFormat.YAML)
+    with profiling.profiling() as profiler:
+        save_index(ix, OUTPUT_DIR / "profiled.yaml", format=EmbeddingFormat.PARQUET)
+        load_index(OUTPUT_DIR / "profiled.yaml")
+    summary = {entry["name"]: entry for entry in profiler.summary()}
+    for name in ["save_index", "write_embeddings", "write_metadata", "load_index", "parse_metadata", "read_embeddings"]:
+        assert summary[name]["calls"] == 1, name
+    assert summary["save_index"]["depth"] == 0
+    assert summary["read_embeddings"]["depth"] == 1
+    assert summary["read_embeddings"]["rows"] == 10
+    assert summary["read_embeddings"]["bytes"] > 0
+    assert summary["write_metadata"]["bytes"] > 0
+    assert "read_embeddings" in str(profiler)
+    trace = profiler.to_chrome_trace()
+    assert {e["name"] for e in trace["traceEvents"]} >= set(summary)
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in trace["traceEvents"])
+
+
+def test_profile_option(runner):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    output = OUTPUT_DIR / "profile.trace.json"
+    args = ["--profile-output", str(output), "--profile-format", "chrome", "convert", "-f", "yaml", str(EXAMPLE)]
+    result = runner.invoke(main, args + ["-t", "parquet", "-o", str(OUTPUT_DIR / "profiled_cli.yaml")])
+    assert result.exit_code == 0, result.output
+    assert profiling.get_profiler() is None
+    with open(output) as stream:
+        trace = json.load(stream)
+    assert "load_index" in {e["name"] for e in trace["traceEvents"]}
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+import venomx as vx
+from venomx.tools.quantization import ScalarQuantizer
+from venomx.tools.search import (
+    ExactSearcher,
+    QuantizedSearcher,
+    SearchMetric,
+    ShardedSearcher,
+    clear_searcher_cache,
+    get_searcher,
+    search,
+)
+
+
+@pytest.fixture
+def index() -> vx.Index:
+    rng = np.random.default_rng(42)
+    ix = vx.Index()
+    ids = np.array([f"X:{i}" for i in range(200)], dtype=object)
+    ix.embeddings_frame = {"id": ids, "values": rng.random((200, 16), dtype=np.float32)}
+    return ix
+
+
+@pytest.mark.parametrize("metric", list(SearchMetric))
+def test_search_matches_full_sort(index, metric):
+    matrix = index.embeddings_frame["values"]
+    queries = matrix[:5] + 0.01
+    ids, scores = search(index, queries, k=7, metric=metric)
+    assert ids.shape == (5, 7)
+    assert scores.shape == (5, 7)
+    for q, query in enumerate(queries):
+        if metric == SearchMetric.COSINE:
+            expected = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query))
+            order = np.argsort(-expected)
+        elif metric == SearchMetric.DOT:
+            expected = matrix @ query
+            order = np.argsort(-expected)
+        else:
+            expected = np.linalg.norm(matrix - query, axis=1)
+            order = np.argsort(expected)
+        assert ids[q].tolist() == index.embeddings_frame["id"][order[:7]].tolist()
+        assert np.allclose(scores[q], expected[order[:7]], atol=1e-4)
+
+
+def test_searcher_is_cached(index):
+    s1 = get_searcher(index)
+    assert get_searcher(index) is s1
+    index.embeddings_frame = dict(index.embeddings_frame)
+    s2 = get_searcher(index)
+    assert s2 is not s1
+    # replacing an array of the frame in place is noticed
+    index.embeddings_frame["values"] = index.embeddings_frame["values"][::-1].copy()
+    s3 = get_searcher(index)
+    assert s3 is not s2
+    assert search(index, index.embeddings_frame["values"][0], k=1)[0].tolist() == [["X:0"]]
+    index.md5 = "changed"
+    assert get_searcher(index) is not s3
+    clear_searcher_cache(index)
+    assert get_searcher(index) is not s3
+
+
+@pytest.mark.parametrize("metric", list(SearchMetric))
+def test_search_in_tiles(index, metric):
+    matrix = index.embeddings_frame["values"]
+    queries = matrix[:5] + 0.01
+    searcher = ExactSearcher(index.embeddings_frame["id"], matrix, metric)
+    ids, scores = searcher.search(queries, k=7)
+    # tiles of 3 rows for a batch of 5 queries
+    tiled_ids, tiled_scores = searcher.search(queries, k=7, memory_budget=5 * 3 * 16)
+    assert tiled_ids.tolist() == ids.tolist()
+    assert np.allclose(tiled_scores, scores)
+
+
+def test_search_dimension_mismatch(index):
+    with pytest.raises(ValueError):
+        search(index, np.zeros((1, 3)))
+
+
+@pytest.mark.parametrize("metric", list(SearchMetric))
+def test_quantized_search_matches_dequantized(index, metric):
+    matrix = index.embeddings_frame["values"]
+    quantizer = ScalarQuantizer.fit(matrix)
+    quantized = vx.Index(
+        embeddings_dtype="int8",
+        quantization_scale=quantizer.scale.tolist(),
+        quantization_offset=quantizer.offset.tolist(),
+    )
+    quantized.embeddings_frame = {"id": index.embeddings_frame["id"], "values": quantizer.encode(matrix)}
+    assert isinstance(get_searcher(quantized, metric), QuantizedSearcher)
+    queries = matrix[:5] + 0.01
+    ids, scores = search(quantized, queries, k=7, metric=metric)
+    expected = ExactSearcher(index.embeddings_frame["id"], quantizer.decode(quantizer.encode(matrix)), metric)
+    expected_ids, expected_scores = expected.search(queries, k=7)
+    assert ids.tolist() == expected_ids.tolist()
+    assert np.allclose(scores, expected_scores, atol=1e-3)
+
+
+@pytest.mark.parametrize("metric", list(SearchMetric))
+def test_sharded_search_matches_unsharded(index, metric):
+    sharded = vx.Index(shards=[{"path": "a", "count": 70}, {"path": "b", "count": 70}, {"path": "c", "count": 60}])
+    sharded.embeddings_frame = index.embeddings_frame
+    assert isinstance(get_searcher(sharded, metric), ShardedSearcher)
+    queries = index.embeddings_frame["values"][:5] + 0.01
+    ids, scores = search(sharded, queries, k=7, metric=metric)
+    expected_ids, expected_scores = search(index, queries, k=7, metric=metric)
+    assert ids.tolist() == expected_ids.tolist()
+    assert np.allclose(scores, expected_scores, atol=1e-5)
+    # the thread pool is kept between searches, and not used with one worker
+    searcher = ShardedSearcher(get_searcher(sharded, metric).searchers, workers=2)
+    assert searcher.search(queries, k=7)[0].tolist() == expected_ids.tolist()
+    pool = searcher._pool
+    assert pool is not None
+    searcher.search(queries, k=7)
+    assert searcher._pool is pool
+    searcher.close()
+    assert searcher._pool is None
+    single = ShardedSearcher(searcher.searchers, workers=1)
+    assert single.search(queries, k=7)[0].tolist() == expected_ids.tolist()
+    assert single._pool is None
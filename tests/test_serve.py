@@ -0,0 +1,196 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+import venomx as vx
+from venomx.tools.cli import main
+from venomx.tools.file_io import save_index
+from venomx.tools.search import search
+from venomx.tools.serve import IndexServer
+
+from tests import OUTPUT_DIR
+
+HP = "http://purl.obolibrary.org/obo/HP_"
+
+
+@pytest.fixture
+def index() -> vx.Index:
+    ix = vx.Index(prefixes=[{"prefix": "HP", "namespace": HP}])
+    ids = np.array([f"HP:{i}" for i in range(100)], dtype=object)
+    ix.embeddings_frame = {"id": ids, "values": np.random.default_rng(0).random((100, 8), dtype=np.float32)}
+    return ix
+
+
+def test_routes(index):
+    server = IndexServer({"hp": index})
+
+    async def _requests():
+        return [
+            await server.handle("GET", "/health"),
+            await server.handle("GET", "/indexes"),
+            await server.handle("POST", "/indexes/hp/lookup", {"ids": ["HP:1", f"{HP}2", "HP:999"]}),
+            await server.handle("POST", "/indexes/hp/search", {"id": "HP:3", "k": 2}),
+            await server.handle("POST", "/indexes/hp/search", {"vector": [1.0, 2.0]}),
+            await server.handle("POST", "/indexes/hp/search", {"id": "HP:999"}),
+            await server.handle("POST", "/indexes/mondo/search", {"id": "HP:3"}),
+            await server.handle("GET", "/indexes/hp/search"),
+        ]
+
+    health, indexes, lookup, by_id, bad_vector, missing, unknown, get = asyncio.run(_requests())
+    server.close()
+    assert health == (200, {"status": "ok"})
+    assert indexes == (200, {"hp": {"count": 100, "dimensions": 8}})
+    vectors = lookup[1]["vectors"]
+    assert np.allclose(vectors[:2], index.embeddings_frame["values"][[1, 2]])
+    assert vectors[2] is None
+    assert by_id[0] == 200
+    assert [r["id"] for r in by_id[1]["results"]][0] == "HP:3"
+    assert len(by_id[1]["results"]) == 2
+    assert [bad_vector[0], missing[0], unknown[0], get[0]] == [400, 404, 404, 405]
+
+    metrics = server.metrics.summary()
+    assert metrics["endpoints"]["search"]["requests"] == 5
+    assert metrics["endpoints"]["search"]["errors"] == 4
+    assert metrics["endpoints"]["lookup"]["latency_ms"]["p50"] > 0
+
+
+def test_invalid_search(index):
+    server = IndexServer({"hp": index})
+    bodies = [
+        {"id": "HP:3", "k": 0},
+        {"id": "HP:3", "k": -1},
+        {"id": "HP:3", "k": None},
+        {"id": "HP:3", "k": "many"},
+        {"vector": ["a"] * 8},
+        {"vector": [[1.0]] * 8},
+        {"vector": [float("nan")] * 8},
+        {"vector": "1.0"},
+    ]
+
+    async def _requests():
+        return [await server.handle("POST", "/indexes/hp/search", body) for body in bodies]
+
+    responses = asyncio.run(_requests())
+    server.close()
+    assert [status for status, _ in responses] == [400] * len(bodies)
+
+
+def test_micro_batching(index):
+    server = IndexServer({"hp": index}, window=0.05, max_batch_size=32)
+    queries = np.random.default_rng(1).random((50, 8), dtype=np.float32)
+
+    async def _search():
+        requests = [
+            server.handle("POST", "/indexes/hp/search", {"vector": q.tolist(), "k": 3 + i % 3})
+            for i, q in enumerate(queries)
+        ]
+        return await asyncio.gather(*requests)
+
+    responses = asyncio.run(_search())
+    server.close()
+    expected_ids, expected_scores = search(index, queries, k=5)
+    for i, (status, response) in enumerate(responses):
+        assert status == 200
+        assert [r["id"] for r in response["results"]] == expected_ids[i, : 3 + i % 3].tolist()
+        assert np.allclose([r["score"] for r in response["results"]], expected_scores[i, : 3 + i % 3], atol=1e-6)
+    batches = server.metrics.summary()["batches"]
+    # a full batch is scored at once, the rest after the window
+    assert batches["count"] == 2
+    assert batches["max_size"] == 32
+
+
+async def _http(reader, writer, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+    await writer.drain()
+    status_line = await reader.readline()
+    headers = {}
+    while (line := await reader.readline()) != b"\r\n":
+        key, _, value = line.decode().partition(":")
+        headers[key.lower()] = value.strip()
+    payload = await reader.readexactly(int(headers["content-length"]))
+    return int(status_line.split()[1]), json.loads(payload)
+
+
+@pytest.mark.parametrize("transport", ["tcp", "unix"])
+def test_http(index, transport, tmp_path):
+    server = IndexServer({"hp": index})
+    socket_path = str(tmp_path / "venomx.sock") if transport == "unix" else None
+
+    async def _run():
+        aio_server = await server.start(port=0, socket_path=socket_path)
+        async with aio_server:
+            if socket_path:
+                reader, writer = await asyncio.open_unix_connection(socket_path)
+            else:
+                reader, writer = await asyncio.open_connection(*aio_server.sockets[0].getsockname()[:2])
+            # several requests over one kept-alive connection
+            results = [
+                await _http(reader, writer, "POST", "/indexes/hp/search", {"id": f"{HP}5", "k": 1}),
+                await _http(reader, writer, "GET", "/metrics"),
+                await _http(reader, writer, "GET", "/nothing"),
+            ]
+            writer.close()
+            return results
+
+    search_response, metrics, not_found = asyncio.run(_run())
+    server.close()
+    assert search_response == (200, {"results": [{"id": "HP:5", "score": pytest.approx(1.0, abs=1e-5)}]})
+    assert metrics[1]["endpoints"]["search"]["requests"] == 1
+    assert not_found[0] == 404
+
+
+def test_invalid_content_length(index):
+    server = IndexServer({"hp": index})
+
+    async def _run():
+        aio_server = await server.start(port=0)
+        async with aio_server:
+            reader, writer = await asyncio.open_connection(*aio_server.sockets[0].getsockname()[:2])
+            writer.write(b"POST /indexes/hp/search HTTP/1.1\r\nContent-Length: ten\r\n\r\n{}")
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response
+
+    response = asyncio.run(_run())
+    server.close()
+    assert response.startswith(b"HTTP/1.1 400 ")
+    assert b"Invalid Content-Length" in response
+
+
+def test_oversized_header(index):
+    server = IndexServer({"hp": index})
+
+    async def _run():
+        aio_server = await server.start(port=0)
+        async with aio_server:
+            reader, writer = await asyncio.open_connection(*aio_server.sockets[0].getsockname()[:2])
+            header = b"X-Padding: " + b"x" * 2**17 + b"\r\n"
+            writer.write(b"GET /health HTTP/1.1\r\n" + header + b"\r\n")
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response
+
+    response = asyncio.run(_run())
+    server.close()
+    assert response.startswith(b"HTTP/1.1 431 ")
+    assert b"Request header too large" in response
+
+
+def test_serve_command(runner, index, monkeypatch):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    path = OUTPUT_DIR / "served.vx.yaml"
+    save_index(index, path)
+    served = {}
+    monkeypatch.setattr("venomx.tools.serve.serve", lambda indexes, **kwargs: served.update(indexes, **kwargs))
+    result = runner.invoke(main, ["serve", str(path), f"other={path}", "--port", "9000", "--batch-window", "5"])
+    assert result.exit_code == 0, result.output
+    assert served["served"].embeddings_count == 100
+    assert served["other"].embeddings_count == 100
+    assert served["port"] == 9000
+    assert served["window"] == pytest.approx(0.005)
+    result = runner.invoke(main, ["serve", str(path), f"served={path}"])
+    assert result.exit_code != 0
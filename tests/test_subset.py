@@ -0,0 +1,110 @@
+import numpy as np
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+import venomx as vx
+from venomx.model.objects_pa import ObjectTable
+from venomx.tools.cli import main
+from venomx.tools.delta import append
+from venomx.tools.file_io import EmbeddingFormat, LoadMode, load_index, save_index
+from venomx.tools.subset import id_filter, load_subset, read_filtered
+
+from tests import OUTPUT_DIR
+
+HP = "http://purl.obolibrary.org/obo/HP_"
+PREFIXES = ["GO", "HP", "MONDO", "UBERON", "CHEBI"]
+
+
+def _index(per_prefix=200) -> vx.Index:
+    # rows of the prefixes interleaved, so only sorting groups them
+    ids = [f"{prefix}:{i:05d}" for i in range(per_prefix) for prefix in PREFIXES]
+    ix = vx.Index(
+        prefixes=[{"prefix": "HP", "namespace": HP}],
+        objects=[vx.NamedObject(id=x, metadata=["obsolete"] if x.endswith("7") else []) for x in ids],
+    )
+    ix.embeddings_frame = {"id": np.array(ids), "values": np.random.default_rng(0).random((len(ids), 4))}
+    return ix
+
+
+@pytest.mark.parametrize("format", [EmbeddingFormat.PARQUET, EmbeddingFormat.ARROW, EmbeddingFormat.YAML])
+def test_subset(format):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    path = OUTPUT_DIR / f"subset_{format.value}.vx.yaml"
+    ix = _index()
+    save_index(ix, path, format=format, sort_ids=format != EmbeddingFormat.YAML)
+
+    hp = load_subset(path, format=format, prefixes=["HP"])
+    assert hp.embeddings_count == 200
+    assert all(x.startswith("HP:") for x in hp.embeddings_frame["id"])
+    assert [obj.id for obj in hp.objects] == sorted(hp.embeddings_frame["id"].tolist())
+    assert hp.md5 is None
+
+    full = load_index(path, format=format, mode=LoadMode.NUMPY)
+    rows = {x: i for i, x in enumerate(full.embeddings_frame["id"])}
+    expected = full.embeddings_frame["values"][[rows[x] for x in hp.embeddings_frame["id"]]]
+    assert np.array_equal(hp.embeddings_frame["values"], expected)
+
+    # CURIEs and URIs match either form
+    selected = load_subset(path, format=format, ids=[f"{HP}00003", "GO:00003", "X:1"], mode=LoadMode.ARROW)
+    assert sorted(selected.embeddings_frame.column("id").to_pylist()) == ["GO:00003", "HP:00003"]
+    assert load_subset(path, format=format, prefixes=[HP]).embeddings_count == 200
+
+    # criteria are combined
+    obsolete = load_subset(path, format=format, prefixes=["HP:"], metadata=["obsolete"])
+    assert obsolete.embeddings_count == 20
+    assert load_subset(path, format=format, prefixes=["NCIT"]).embeddings_count == 0
+
+
+def test_subset_skips_row_groups():
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    path = OUTPUT_DIR / "subset_row_groups.vx.yaml"
+    embeddings_path = OUTPUT_DIR / "subset_row_groups.vx.parquet"
+    ix = _index(per_prefix=1000)
+    save_index(ix, path, row_group_size=100, sort_ids=True)
+    metadata = pq.read_metadata(embeddings_path)
+    assert metadata.num_row_groups == 50
+    assert metadata.row_group(0).column(0).statistics.has_min_max
+
+    expression = id_filter(ix, prefixes=["HP"])
+    assert read_filtered([embeddings_path], EmbeddingFormat.PARQUET, expression).num_rows == 1000
+    # a prefix of 20% of the rows is in 10 of the 50 row groups, the others are skipped
+    fragment = next(ds.dataset(str(embeddings_path)).get_fragments())
+    assert len(fragment.split_by_row_group(expression)) == 10
+
+    # unsorted, every row group holds some of each prefix
+    save_index(ix, path, row_group_size=100)
+    fragment = next(ds.dataset(str(embeddings_path)).get_fragments())
+    assert len(fragment.split_by_row_group(expression)) == 50
+
+
+def test_subset_objects_table_and_segments():
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    path = OUTPUT_DIR / "subset_segments.vx.yaml"
+    ix = _index(20)
+    save_index(ix, path, objects_table=True, sort_ids=True)
+    append(path, ["HP:99999"], np.ones((1, 4)), objects=[vx.NamedObject(id="HP:99999")])
+    hp = load_subset(path, prefixes=["HP"])
+    assert hp.embeddings_count == 21
+    assert isinstance(hp.objects, ObjectTable)
+    assert len(hp.objects) == 21
+    assert not hp.segments
+
+
+def test_subset_command(runner, tmp_path):
+    OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+    source = OUTPUT_DIR / "subset_cli.vx.yaml"
+    target = OUTPUT_DIR / "subset_cli_hp.vx.yaml"
+    save_index(_index(), source)
+    result = runner.invoke(main, ["convert", str(source), "-o", str(source), "--sort-ids"])
+    assert result.exit_code == 0, result.output
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("GO:00001\nHP:00001\n\n")
+    result = runner.invoke(main, ["subset", str(source), "-o", str(target), "--ids-file", str(ids_file)])
+    assert result.exit_code == 0, result.output
+    assert "Embeddings: 2" in result.output
+    result = runner.invoke(main, ["subset", str(source), "-o", str(target), "--prefix", "HP", "--sort-ids"])
+    assert result.exit_code == 0, result.output
+    ix = load_index(target, mode=LoadMode.NUMPY)
+    assert ix.embeddings_count == 200
+    assert ix.md5
+    assert len(ix.objects) == 200